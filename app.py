@@ -1,22 +1,31 @@
 import json
 import os
+import threading
+import time
 import uuid
 from datetime import datetime, timedelta
 from functools import wraps
 
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+from flask import Flask, Response, render_template, request, redirect, url_for, session, jsonify, flash, stream_with_context
 from werkzeug.utils import secure_filename
-from utils.ai_exam_converter import extract_text_from_docx, convert_exam_with_ai, validate_exam_data
+from utils.ai_exam_converter import complete_hybrid_import, plan_hybrid_import
 
 import re
 from docx import Document
 from utils.gemini_api import get_gemini_response
 
 from utils.auth import register_user, login_user, get_user_by_id
-from utils.database import Database
+from utils.background_tasks import BackgroundTasks
+from utils.comment_tree import REPLY_PREVIEW_SIZE, ROOT_PAGE_SIZE, build_comment_tree
+from utils.database import create_database
 from utils.exam_parser import ExamParseError, parse_docx_exam
-from utils.gemini_api import chat_with_gemini
+from utils.exam_stats import summarize_stats
+from utils.gemini_api import chat_with_gemini, response_cache, stream_chat_with_gemini
+from utils.exam_analytics import analyze_exam
+from utils.grading import get_answer_key
+from utils.job_queue import JobQueue
+from utils.regrade import regrade_exam
 
 app = Flask(__name__)
 load_dotenv()
@@ -26,6 +35,10 @@ app.config['SESSION_COOKIE_SECURE'] = os.getenv('SESSION_COOKIE_SECURE', 'false'
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = os.getenv('SESSION_COOKIE_SAMESITE', 'Lax')
 
+# Phân tích AI "pending" quá lâu (worker tạo nó đã dừng) hoặc lỗi từ quá lâu thì được giao lại
+AI_ANALYSIS_STALE_AFTER = 120
+AI_ANALYSIS_MAX_ATTEMPTS = 3
+
 FORUM_UPLOAD_FOLDER = os.getenv('FORUM_UPLOAD_FOLDER', 'static/uploads/forum')
 EXAM_UPLOAD_FOLDER = os.getenv('EXAM_UPLOAD_FOLDER', 'static/uploads/exams')
 ALLOWED_EXAM_EXTENSIONS = {'docx'}
@@ -39,7 +52,9 @@ GRADE_LABELS = {
 }
 AVAILABLE_GRADES = ['6', '7', '8', '9']
 DEFAULT_GRADE = '6'
-db = Database()
+db = create_database()
+background_tasks = BackgroundTasks()
+job_queue = JobQueue()
 ####
 
 def login_required(f):
@@ -196,9 +211,9 @@ def student_dashboard():
 def teacher_dashboard():
     my_courses = db.get_courses_by_teacher(session['user_id'])
     
+    all_progress = db.get_all_progress()
     course_stats = []
     for course in my_courses:
-        all_progress = db._load_json(db.progress_file)
         students_enrolled = len([p for p in all_progress if p['course_id'] == course['id']])
         
         course_stats.append({
@@ -313,9 +328,7 @@ def delete_course(course_id):
     if course['teacher_id'] != session['user_id']:
         return jsonify({'success': False, 'message': 'Bạn không có quyền xóa khóa học này'})
     
-    courses = db.get_all_courses()
-    courses = [c for c in courses if c['id'] != course_id]
-    db._save_json(db.courses_file, courses)
+    db.delete_course(course_id)
     
     return jsonify({'success': True, 'message': 'Xóa khóa học thành công'})
 
@@ -339,7 +352,7 @@ def exercises():
                 })
     
     try:
-        all_submissions = db._load_json(db.submissions_file) if hasattr(db, 'submissions_file') else []
+        all_submissions = db.get_all_submissions()
     except:
         all_submissions = []
     
@@ -694,6 +707,46 @@ def chat():
         return jsonify({'success': False, 'response': f'Xin lỗi, có lỗi xảy ra: {str(e)}'})
 
 
+@app.route('/api/chat/answer-stream', methods=['POST'])
+@login_required
+def chat_answer_stream():
+    """
+    Chatbot dạng Server-Sent Events: 'chunk' cho từng đoạn câu trả lời, rồi 'done' (hoặc 'error').
+    Client đọc bằng fetch + ReadableStream vì EventSource không gửi được POST.
+    """
+    data = request.get_json(silent=True) or {}
+    message = (data.get('message') or '').strip()
+    if not message:
+        return jsonify({'success': False, 'response': 'Vui lòng nhập tin nhắn'})
+
+    def sse(event_type, payload):
+        return f'event: {event_type}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n'
+
+    def generate():
+        try:
+            for text in stream_chat_with_gemini(message):
+                yield sse('chunk', {'text': text})
+        except Exception as e:
+            yield sse('error', {'message': f'Xin lỗi, có lỗi xảy ra: {str(e)}'})
+            return
+        yield sse('done', {})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+@app.route('/api/chat/cache-stats')
+@teacher_required
+def chat_cache_stats():
+    """Thống kê cache câu trả lời AI (tỉ lệ trúng, số mục) - dùng chung cho mọi worker"""
+    try:
+        return jsonify({'success': True, 'stats': response_cache.stats()})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Lỗi: {str(e)}'})
+
+
 @app.route('/update_progress', methods=['POST'])
 @login_required
 def update_progress():
@@ -723,7 +776,7 @@ def students_progress():
     teacher_courses = db.get_courses_by_teacher(session['user_id'])
     teacher_course_ids = [c['id'] for c in teacher_courses]
     
-    all_progress = db._load_json(db.progress_file)
+    all_progress = db.get_all_progress()
     filtered_progress = [p for p in all_progress if p['course_id'] in teacher_course_ids]
     
     progress_with_details = []
@@ -756,16 +809,15 @@ def teacher_exams():
     exams_by_grade = {}
 
     for grade in AVAILABLE_GRADES:
-        bank = db.load_exam_bank(grade)
         grade_exams = []
 
-        for exam in bank.get('exams', []):
+        for exam in db.get_exam_manifest(grade):
             exam_copy = {
                 'id': exam.get('id'),
                 'title': exam.get('title', 'Không có tiêu đề'),
                 'description': exam.get('description', ''),
                 'time_limit': exam.get('time_limit', 15),
-                'question_count': len(exam.get('questions', [])),
+                'question_count': exam.get('question_count', 0),
                 'created_at': exam.get('created_at'),
                 'allow_multiple_answers': exam.get('allow_multiple_answers', False),
                 'created_by': exam.get('created_by'),
@@ -773,6 +825,8 @@ def teacher_exams():
                 'grade': grade,
             }
             exam_copy['is_owner'] = exam_copy['created_by'] == teacher_id or exam_copy['created_by'] is None
+            # Số liệu lấy từ bảng tổng hợp, không quét lại toàn bộ kết quả
+            exam_copy['stats'] = summarize_stats(db.get_exam_stats(grade, exam_copy['id']))
             grade_exams.append(exam_copy)
 
         exams_by_grade[grade] = grade_exams
@@ -795,8 +849,7 @@ def delete_exam():
         if grade not in AVAILABLE_GRADES or not exam_id:
             return jsonify({'success': False, 'message': 'Thiếu thông tin đề thi'}), 400
 
-        bank = db.load_exam_bank(grade)
-        exam = next((e for e in bank.get('exams', []) if e.get('id') == exam_id), None)
+        exam = db.get_exam(grade, exam_id)
 
         if not exam:
             return jsonify({'success': False, 'message': 'Không tìm thấy đề thi'}), 404
@@ -819,6 +872,67 @@ def delete_exam():
         return jsonify({'success': False, 'message': f'Lỗi: {exc}'}), 500
 
 
+@app.route('/teacher/exams/<grade>/<exam_id>/analytics')
+@login_required
+@teacher_required
+def exam_analytics(grade, exam_id):
+    """Thống kê câu hỏi của một đề: độ khó, độ phân biệt, phương án nhiễu, phổ điểm"""
+    if grade not in AVAILABLE_GRADES:
+        flash('Khối lớp không hợp lệ', 'danger')
+        return redirect(url_for('teacher_exams'))
+
+    exam = db.get_exam(grade, exam_id)
+    if not exam:
+        flash('Không tìm thấy đề thi', 'danger')
+        return redirect(url_for('teacher_exams'))
+
+    analytics = analyze_exam(exam, db.get_exam_results(exam_id=exam_id, grade=grade))
+
+    return render_template('exam_analytics.html',
+                           exam=exam,
+                           grade=grade,
+                           grade_label=GRADE_LABELS.get(grade, grade),
+                           analytics=analytics,
+                           username=session.get('username'))
+
+
+@app.route('/teacher/exams/regrade', methods=['POST'])
+@login_required
+@teacher_required
+def regrade_exam_results():
+    """Chấm lại toàn bộ kết quả của một đề sau khi giáo viên sửa đáp án"""
+    try:
+        data = request.get_json() or {}
+        grade = str(data.get('grade', '')).strip()
+        exam_id = data.get('exam_id')
+
+        if grade not in AVAILABLE_GRADES or not exam_id:
+            return jsonify({'success': False, 'message': 'Thiếu thông tin đề thi'}), 400
+
+        exam = db.get_exam(grade, exam_id)
+
+        if not exam:
+            return jsonify({'success': False, 'message': 'Không tìm thấy đề thi'}), 404
+
+        owner_id = exam.get('created_by')
+        if owner_id and owner_id != session.get('user_id'):
+            return jsonify({'success': False, 'message': 'Bạn chỉ có thể chấm lại đề thi do mình tạo'}), 403
+
+        stats = regrade_exam(db, grade, exam_id)
+        if stats is None:
+            return jsonify({'success': False, 'message': 'Không tìm thấy đề thi'}), 404
+
+        print(f"✅ Regraded exam {exam_id}: {stats['regraded']} results, {stats['changed']} changed")
+
+        return jsonify({
+            'success': True,
+            'message': f"Đã chấm lại {stats['regraded']} bài, {stats['changed']} bài thay đổi điểm.",
+            **stats
+        })
+    except Exception as exc:
+        return jsonify({'success': False, 'message': f'Lỗi: {exc}'}), 500
+
+
 @app.route('/teacher/view_submissions')
 @teacher_required
 def view_submissions():
@@ -826,7 +940,7 @@ def view_submissions():
     teacher_course_ids = [c['id'] for c in teacher_courses]
     
     try:
-        all_submissions = db._load_json(db.submissions_file) if hasattr(db, 'submissions_file') else []
+        all_submissions = db.get_all_submissions()
     except:
         all_submissions = []
     
@@ -882,125 +996,110 @@ def lam_bai_tracnghiem(grade, exam_id):
         flash('Lớp không hợp lệ', 'danger')
         return redirect(url_for('tracnghiem'))
     
-    json_file = f'data/lop{grade}.json'
-    
     try:
-        with open(json_file, 'r', encoding='utf-8') as f:
-            exams_data = json.load(f)
-            exams = exams_data.get('exams', [])
-            
-            exam = next((e for e in exams if e['id'] == exam_id), None)
-            
-            if not exam:
-                flash('Đề thi không tồn tại', 'danger')
-                return redirect(url_for('tracnghiem'))
-            
-            time_limit = exam.get('time_limit', 15)
-            
-            if not isinstance(time_limit, (int, float)) or time_limit <= 0:
-                time_limit = 15
-                print(f"Warning: Invalid time_limit in exam {exam_id}, using default 15 minutes")
-            
-            session_key = f'exam_start_{grade}_{exam_id}'
-            reset_param = request.args.get('reset', 'no')
-            
-            if not session.permanent:
-                session.permanent = True
-                session.modified = True
-            
-
-            should_create_new_session = False
-            remaining_time = time_limit * 60  # Mặc định
-            
-            if reset_param == 'yes':
-                should_create_new_session = True
-                print(f"Reset session for exam {exam_id}")
-            
-            elif session_key not in session:
-                should_create_new_session = True
-                print(f"New session for exam {exam_id}")
-            else:
-                try:
-                    start_time_str = session.get(session_key)
-                    if not start_time_str or not isinstance(start_time_str, str):
-                        raise ValueError("Invalid start_time format")
-                    
-                    start_time = datetime.fromisoformat(start_time_str)
-                    current_time = datetime.now()
-                    
-                    elapsed_seconds = (current_time - start_time).total_seconds()
-                    
-                    if elapsed_seconds < 0:
-                        print(f"ERROR: Negative elapsed time for exam {exam_id}")
-                        should_create_new_session = True
-                    elif elapsed_seconds > (time_limit * 60 * 2):
-                        print(f"WARNING: Session too old for exam {exam_id}")
-                        should_create_new_session = True
-                    else:
-                        remaining_time = (time_limit * 60) - elapsed_seconds
-                        
+        exam = db.get_exam(grade, exam_id)
+        
+        if not exam:
+            flash('Đề thi không tồn tại', 'danger')
+            return redirect(url_for('tracnghiem'))
+        
+        time_limit = exam.get('time_limit', 15)
+        
+        if not isinstance(time_limit, (int, float)) or time_limit <= 0:
+            time_limit = 15
+            print(f"Warning: Invalid time_limit in exam {exam_id}, using default 15 minutes")
+        
+        session_key = f'exam_start_{grade}_{exam_id}'
+        reset_param = request.args.get('reset', 'no')
+        
+        if not session.permanent:
+            session.permanent = True
+            session.modified = True
+        
 
-                        if remaining_time <= 0:
-                            flash('⏰ Đã hết thời gian làm bài! Vui lòng làm lại từ đầu.', 'warning')
-                            # Xóa session cũ
-                            session.pop(session_key, None)
-                            session.modified = True
-                            return redirect(url_for('tracnghiem'))
-                        
-                        print(f"Exam {exam_id}: {int(remaining_time)}s remaining")
+        should_create_new_session = False
+        remaining_time = time_limit * 60  # Mặc định
+        
+        if reset_param == 'yes':
+            should_create_new_session = True
+            print(f"Reset session for exam {exam_id}")
+        
+        elif session_key not in session:
+            should_create_new_session = True
+            print(f"New session for exam {exam_id}")
+        else:
+            try:
+                start_time_str = session.get(session_key)
+                if not start_time_str or not isinstance(start_time_str, str):
+                    raise ValueError("Invalid start_time format")
                 
-                except (ValueError, KeyError, TypeError, AttributeError) as e:
-                    print(f"Session error for exam {exam_id}: {e}")
-                    should_create_new_session = True
-            
-            if should_create_new_session:
+                start_time = datetime.fromisoformat(start_time_str)
                 current_time = datetime.now()
-                session[session_key] = current_time.isoformat()
-                session.permanent = True
-                session.modified = True
-                remaining_time = time_limit * 60
-                print(f"Created new session for exam {exam_id}, expires in {time_limit} minutes")
-            
+                
+                elapsed_seconds = (current_time - start_time).total_seconds()
+                
+                if elapsed_seconds < 0:
+                    print(f"ERROR: Negative elapsed time for exam {exam_id}")
+                    should_create_new_session = True
+                elif elapsed_seconds > (time_limit * 60 * 2):
+                    print(f"WARNING: Session too old for exam {exam_id}")
+                    should_create_new_session = True
+                else:
+                    remaining_time = (time_limit * 60) - elapsed_seconds
+                    
 
-            remaining_time = max(1, min(remaining_time, time_limit * 60))
-            remaining_time = int(remaining_time)  # Convert to integer
-            
-            # . LOG (cho debug)
-            print(f"""
-            ===== EXAM SESSION INFO =====
-            Exam: {exam_id} | Grade: {grade}
-            Time Limit: {time_limit} minutes
-            Remaining: {remaining_time} seconds ({remaining_time//60}m {remaining_time%60}s)
-            Session Key: {session_key}
-            Session Permanent: {session.permanent}
-            ============================
-            """)
+                    if remaining_time <= 0:
+                        flash('⏰ Đã hết thời gian làm bài! Vui lòng làm lại từ đầu.', 'warning')
+                        # Xóa session cũ
+                        session.pop(session_key, None)
+                        session.modified = True
+                        return redirect(url_for('tracnghiem'))
+                    
+                    print(f"Exam {exam_id}: {int(remaining_time)}s remaining")
             
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                print(f"Session error for exam {exam_id}: {e}")
+                should_create_new_session = True
+        
+        if should_create_new_session:
+            current_time = datetime.now()
+            session[session_key] = current_time.isoformat()
+            session.permanent = True
+            session.modified = True
+            remaining_time = time_limit * 60
+            print(f"Created new session for exam {exam_id}, expires in {time_limit} minutes")
+        
+
+        remaining_time = max(1, min(remaining_time, time_limit * 60))
+        remaining_time = int(remaining_time)  # Convert to integer
+        
+        # . LOG (cho debug)
+        print(f"""
+        ===== EXAM SESSION INFO =====
+        Exam: {exam_id} | Grade: {grade}
+        Time Limit: {time_limit} minutes
+        Remaining: {remaining_time} seconds ({remaining_time//60}m {remaining_time%60}s)
+        Session Key: {session_key}
+        Session Permanent: {session.permanent}
+        ============================
+        """)
+        
+
+        for question in exam.get('questions', []):
+            if isinstance(question, dict):
+                question.setdefault('type', 'tl1')
+                if question.get('type') == 'tl2' and isinstance(question.get('correct_answer'), str):
+                    question['correct_answer'] = [question['correct_answer']]
+        has_tl2 = any(q.get('type') == 'tl2' for q in exam.get('questions', []))
+
+        return render_template('baitap.html',
+                             exam=exam,
+                             grade=grade,
+                             time_limit=time_limit,
+                             remaining_time=remaining_time,
+                             username=session.get('username'),
+                             has_tl2=has_tl2)
 
-            for question in exam.get('questions', []):
-                if isinstance(question, dict):
-                    question.setdefault('type', 'tl1')
-                    if question.get('type') == 'tl2' and isinstance(question.get('correct_answer'), str):
-                        question['correct_answer'] = [question['correct_answer']]
-            has_tl2 = any(q.get('type') == 'tl2' for q in exam.get('questions', []))
-
-            return render_template('baitap.html',
-                                 exam=exam,
-                                 grade=grade,
-                                 time_limit=time_limit,
-                                 remaining_time=remaining_time,
-                                 username=session.get('username'),
-                                 has_tl2=has_tl2)
-    
-    except FileNotFoundError:
-        flash(' Không tìm thấy dữ liệu đề thi', 'danger')
-        return redirect(url_for('tracnghiem'))
-    
-    except json.JSONDecodeError as e:
-        flash(' Dữ liệu đề thi bị lỗi định dạng', 'danger')
-        print(f"JSON decode error: {e}")
-        return redirect(url_for('tracnghiem'))
-    
     except Exception as e:
         flash(f' Lỗi không xác định: {str(e)}', 'danger')
         print(f"Unexpected error in lam_bai_tracnghiem: {e}")
@@ -1028,22 +1127,17 @@ def api_check_exam_time(grade, exam_id):
         })
     
     try:
-        json_file = f'data/lop{grade}.json'
-        with open(json_file, 'r', encoding='utf-8') as f:
-            exams_data = json.load(f)
-            exams = exams_data.get('exams', [])
-            exam = next((e for e in exams if e['id'] == exam_id), None)
-            
-            if not exam:
-                return jsonify({
-                    'success': False,
-                    'message': 'Đề thi không tồn tại',
-                    'is_expired': True,
-                    'remaining_time': 0
-                })
-            
-            time_limit = exam.get('time_limit', 15)
+        exam = db.get_exam(grade, exam_id)
         
+        if not exam:
+            return jsonify({
+                'success': False,
+                'message': 'Đề thi không tồn tại',
+                'is_expired': True,
+                'remaining_time': 0
+            })
+        
+        time_limit = exam.get('time_limit', 15)
 
         start_time = datetime.fromisoformat(session[session_key])
         elapsed_seconds = (datetime.now() - start_time).total_seconds()
@@ -1106,23 +1200,13 @@ def tracnghiem():
 
         # Đọc đề thi từ tất cả các khối
         for grade in AVAILABLE_GRADES:
-            json_file = f'data/lop{grade}.json'
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    exams_data = json.load(f)
-                    exams = exams_data.get('exams', [])
-
-                    for exam in exams:
-                        exam['grade'] = grade
-                    exams_by_grade[grade].extend(exams)
-                    print(f"✓ Loaded {len(exams)} exams from grade {grade}")
-
-            except FileNotFoundError:
-                print(f"✗ File {json_file} không tồn tại")
-                continue
-            except json.JSONDecodeError:
-                print(f"✗ File {json_file} bị lỗi định dạng")
-                continue
+            # Chỉ đọc manifest (metadata), không parse câu hỏi của từng đề
+            exams = db.get_exam_manifest(grade)
+
+            for exam in exams:
+                exam['grade'] = grade
+            exams_by_grade[grade].extend(exams)
+            print(f"✓ Loaded {len(exams)} exams from grade {grade}")
 
         total_exams = sum(len(exams) for exams in exams_by_grade.values())
         print(f"Total exams: {total_exams}")
@@ -1151,22 +1235,9 @@ def ket_qua_tracnghiem(grade, exam_id):
     """
     try:
         user_id = session.get('user_id')
-        results_file = 'data/exam_results.json'
-        
-        try:
-            with open(results_file, 'r', encoding='utf-8') as f:
-                all_results = json.load(f)
-        except FileNotFoundError:
-            flash('Không tìm thấy kết quả bài làm', 'warning')
-            return redirect(url_for('tracnghiem'))
         
         # Lấy kết quả phù hợp
-        matching_results = [
-            r for r in all_results 
-            if r.get('user_id') == user_id 
-            and r.get('grade') == grade 
-            and r.get('exam_id') == exam_id
-        ]
+        matching_results = db.get_exam_results(user_id=user_id, exam_id=exam_id, grade=grade)
         
         if not matching_results:
             flash('Không tìm thấy kết quả bài làm', 'warning')
@@ -1175,47 +1246,47 @@ def ket_qua_tracnghiem(grade, exam_id):
         result = matching_results[-1]
         
         # ===== LẤY ĐỀ THI ĐỂ HIỂN THỊ CHI TIẾT CÂU SAI =====
-        json_file = f'data/lop{grade}.json'
         wrong_answers = []
         
         try:
-            with open(json_file, 'r', encoding='utf-8') as f:
-                exams_data = json.load(f)
-                exams = exams_data.get('exams', [])
-                exam = next((e for e in exams if e['id'] == exam_id), None)
+            exam = db.get_exam(grade, exam_id)
+            
+            if exam:
+                questions = exam.get('questions', [])
+                details = result.get('details', [])
                 
-                if exam:
-                    questions = exam.get('questions', [])
-                    details = result.get('details', [])
-                    
-                    for detail in details:
-                        if not detail.get('is_correct', True):  # Câu sai
-                            q_id = str(detail.get('question_id'))
-                            question = next((q for q in questions if str(q.get('id')) == q_id), None)
-                            
-                            if question:
-                                wrong_answers.append({
-                                    'question_number': question.get('number', q_id),
-                                    'question_text': question.get('question', ''),
-                                    'user_answer': format_answer(detail.get('user_answer')),
-                                    'correct_answer': format_answer(detail.get('correct_answer')),
-                                    'explanation': question.get('explanation', '')
-                                })
+                for detail in details:
+                    if not detail.get('is_correct', True):  # Câu sai
+                        q_id = str(detail.get('question_id'))
+                        question = next((q for q in questions if str(q.get('id')) == q_id), None)
+                        
+                        if question:
+                            wrong_answers.append({
+                                'question_number': question.get('number', q_id),
+                                'question_text': question.get('question', ''),
+                                'user_answer': format_answer(detail.get('user_answer')),
+                                'correct_answer': format_answer(detail.get('correct_answer')),
+                                'explanation': question.get('explanation', '')
+                            })
         except Exception as e:
             print(f"⚠️ Không thể tải chi tiết câu sai: {e}")
         
-        # ===== TẠO AI ANALYSIS =====
+        # ===== AI ANALYSIS =====
+        # Phân tích được tạo nền sau khi nộp bài; chưa xong thì hiện bản dự phòng và trang tự cập nhật
         ai_analysis = None
+        analysis_pending = False
         if result.get('score') is not None:
-            try:
-                ai_analysis = generate_ai_analysis(result)
-                print(f"✅ Generated AI analysis for exam {exam_id}")
-            except Exception as ai_error:
-                print(f"⚠️ AI analysis failed: {ai_error}")
+            stored = db.get_result_analysis(result.get('id')) if result.get('id') else None
+            if stored and stored.get('status') == 'ready':
+                ai_analysis = stored['analysis']
+            else:
+                ai_analysis = create_fallback_analysis(result['score'], result_percentage(result))
+                analysis_pending = bool(result.get('id')) and schedule_result_analysis(result, stored)
         
         return render_template('ketqua.html', 
                              result=result,
                              ai_analysis=ai_analysis,
+                             analysis_pending=analysis_pending,
                              wrong_answers=wrong_answers,  # ← THÊM DÒNG NÀY
                              username=session.get('username'))
     
@@ -1227,6 +1298,66 @@ def ket_qua_tracnghiem(grade, exam_id):
         return redirect(url_for('tracnghiem'))
 
 
+def result_percentage(result):
+    total_questions = result.get('total_questions') or 0
+    return result.get('correct_count', 0) / total_questions * 100 if total_questions > 0 else 0
+
+
+def schedule_result_analysis(result, stored=None):
+    """
+    Đưa việc tạo phân tích AI của một bài làm vào hàng đợi nền (nếu chưa có worker nào đang làm).
+    Trả về True khi phân tích đang được tạo - trang kết quả sẽ hỏi lại qua /tracnghiem/phan-tich.
+    """
+    if result.get('score') is None:
+        return False  # Bài có câu tự luận chờ giáo viên chấm
+    if stored and stored.get('status') == 'failed' and stored.get('attempts', 1) >= AI_ANALYSIS_MAX_ATTEMPTS:
+        return False  # Đã thử đủ số lần -> giữ bản dự phòng
+    if stored and time.time() - stored.get('requested_at', 0) < AI_ANALYSIS_STALE_AFTER:
+        return stored.get('status') == 'pending'  # Vừa lỗi thì chờ hết hạn mới thử lại
+    attempts = (stored.get('attempts', 1) if stored else 0) + 1
+    pending = {'status': 'pending', 'user_id': result.get('user_id'), 'requested_at': time.time(), 'attempts': attempts}
+    if db.claim_result_analysis(result['id'], pending, AI_ANALYSIS_STALE_AFTER):
+        background_tasks.submit(result['id'], run_result_analysis, result, attempts)
+    return True
+
+
+def run_result_analysis(result, attempts=1):
+    try:
+        analysis = generate_ai_analysis(result)
+    except Exception as e:
+        # Không lưu bản dự phòng như kết quả cuối: lần xem sau (quá AI_ANALYSIS_STALE_AFTER) sẽ thử lại
+        db.save_result_analysis(result['id'], {
+            'status': 'failed',
+            'user_id': result.get('user_id'),
+            'requested_at': time.time(),
+            'attempts': attempts,
+            'error': str(e)
+        })
+        print(f"⚠️ AI analysis for result {result['id']} failed (lần {attempts}): {e}")
+        return
+    db.save_result_analysis(result['id'], {
+        'status': 'ready',
+        'user_id': result.get('user_id'),
+        'analysis': analysis,
+        'generated_at': datetime.now().isoformat()
+    })
+    print(f"✅ Generated AI analysis for result {result['id']}")
+
+
+@app.route('/tracnghiem/phan-tich/<result_id>')
+@login_required
+def result_analysis_status(result_id):
+    """Trạng thái phân tích AI của một bài làm (trang kết quả gọi định kỳ tới khi xong)"""
+    stored = db.get_result_analysis(result_id)
+    if not stored or (stored.get('user_id') != session.get('user_id') and session.get('role') != 'teacher'):
+        return jsonify({'success': False, 'message': 'Không tìm thấy phân tích'}), 404
+    if stored.get('status') == 'failed':
+        return jsonify({'success': True, 'ready': False, 'failed': True})
+    if stored.get('status') != 'ready':
+        return jsonify({'success': True, 'ready': False})
+    return jsonify({'success': True, 'ready': True, 'analysis': stored['analysis']})
+
+
 def format_answer(answer):
     """Format đáp án để hiển thị"""
     if isinstance(answer, list):
@@ -1242,19 +1373,18 @@ def generate_ai_analysis(result):
         result: Dict chứa thông tin kết quả bài thi
         
     Returns:
-        Dict chứa AI analysis hoặc None nếu lỗi
+        Dict chứa AI analysis; ném exception nếu AI lỗi, quá tải hoặc trả về sai định dạng
     """
-    try:
-        score = result.get('score', 0)
-        correct_count = result.get('correct_count', 0)
-        total_questions = result.get('total_questions', 1)
-        exam_title = result.get('exam_title', 'bài thi')
-        
-        # Tính phần trăm đúng
-        percentage = (correct_count / total_questions * 100) if total_questions > 0 else 0
-        
-        # Tạo prompt cho AI
-        prompt = f"""Bạn là trợ lý AI giáo dục chuyên nghiệp. Hãy phân tích kết quả bài thi của học sinh.
+    score = result.get('score', 0)
+    correct_count = result.get('correct_count', 0)
+    total_questions = result.get('total_questions', 1)
+    exam_title = result.get('exam_title', 'bài thi')
+    
+    # Tính phần trăm đúng
+    percentage = (correct_count / total_questions * 100) if total_questions > 0 else 0
+    
+    # Tạo prompt cho AI
+    prompt = f"""Bạn là trợ lý AI giáo dục chuyên nghiệp. Hãy phân tích kết quả bài thi của học sinh.
 
 **THÔNG TIN BÀI THI:**
 - Đề thi: {exam_title}
@@ -1298,32 +1428,25 @@ Hãy tạo một bản phân tích chi tiết, khuyến khích và xây dựng v
 
 Chỉ trả về JSON, không giải thích thêm."""
 
-        # Gọi Gemini API
-        response = get_gemini_response(prompt)
+    # Gọi Gemini API
+    response = get_gemini_response(prompt)
+    
+    # Parse JSON
+    import re
+    json_match = re.search(r'\{[^{}]*"overall_assessment"[^{}]*\}', response, re.DOTALL)
+    
+    if json_match:
+        analysis = json.loads(json_match.group(0))
         
-        # Parse JSON
-        import re
-        json_match = re.search(r'\{[^{}]*"overall_assessment"[^{}]*\}', response, re.DOTALL)
+        # Validate các trường bắt buộc
+        required_fields = ['overall_assessment', 'strengths', 'weaknesses', 'study_plan', 'encouragement']
+        for field in required_fields:
+            if field not in analysis or not analysis[field]:
+                raise ValueError(f"Missing field: {field}")
         
-        if json_match:
-            analysis = json.loads(json_match.group(0))
-            
-            # Validate các trường bắt buộc
-            required_fields = ['overall_assessment', 'strengths', 'weaknesses', 'study_plan', 'encouragement']
-            for field in required_fields:
-                if field not in analysis or not analysis[field]:
-                    raise ValueError(f"Missing field: {field}")
-            
-            return analysis
-        else:
-            # Fallback: tạo analysis cơ bản
-            return create_fallback_analysis(score, percentage)
-    
-    except Exception as e:
-        print(f"Error generating AI analysis: {e}")
-        # Trả về fallback analysis
-        return create_fallback_analysis(result.get('score', 0), 
-                                       (result.get('correct_count', 0) / result.get('total_questions', 1) * 100))
+        return analysis
+    else:
+        raise ValueError("AI trả về phân tích không đúng định dạng JSON")
 
 
 def create_fallback_analysis(score, percentage):
@@ -1370,19 +1493,8 @@ def lich_su_tracnghiem():
     """
     try:
         user_id = session.get('user_id')
-        results_file = 'data/exam_results.json'
-        
-        try:
-            with open(results_file, 'r', encoding='utf-8') as f:
-                all_results = json.load(f)
-        except FileNotFoundError:
-            all_results = []
-        except json.JSONDecodeError:
-            print("ERROR: exam_results.json bị lỗi định dạng")
-            all_results = []
-        
 
-        user_results = [r for r in all_results if r.get('user_id') == user_id]
+        user_results = db.get_exam_results(user_id=user_id)
         user_results.sort(key=lambda x: x.get('submitted_at', ''), reverse=True)
         
         print(f"User {user_id} có {len(user_results)} bài đã làm")
@@ -1439,81 +1551,24 @@ def nop_bai_tracnghiem():
         answers = data.get('answers', {})
         user_id = session.get('user_id')
         
-        # Đọc đề thi để chấm điểm
-        json_file = f'data/lop{grade}.json'
-        
-        try:
-            with open(json_file, 'r', encoding='utf-8') as f:
-                exams_data = json.load(f)
-                exams = exams_data.get('exams', [])
-                exam = next((e for e in exams if e['id'] == exam_id), None)
-                
-                if not exam:
-                    return jsonify({
-                        'success': False,
-                        'message': 'Đề thi không tồn tại'
-                    }), 404
+        # Đáp án đã biên dịch được cache theo (khối, mã đề, phiên bản đề)
+        exam_version = db.get_exam_version(grade, exam_id)
+        answer_key = None
+        if exam_version is not None:
+            answer_key = get_answer_key(grade, exam_id, exam_version, lambda: db.get_exam(grade, exam_id))
         
-        except FileNotFoundError:
+        if not answer_key:
             return jsonify({
                 'success': False,
-                'message': 'File đề thi không tồn tại'
+                'message': 'Đề thi không tồn tại'
             }), 404
         
         # Chấm điểm
-        questions = exam.get('questions', [])
-        total_questions = len(questions)
-        correct_count = 0
-        total_score_float = 0.0
-        details = []
-        
-        for q in questions:
-            q_id = str(q.get('id'))
-            q_type = q.get('type', 'tl1')
-            correct_answer = q.get('correct_answer')
-            user_answer = answers.get(q_id)
-            
-            is_correct = False
-            score_for_question = 0.0
-            
-            if q_type == 'tl2':
-                # Câu TL2: tính điểm theo số sai
-                if isinstance(correct_answer, list) and isinstance(user_answer, list):
-                    correct_set = set(correct_answer)
-                    user_set = set(user_answer)
-                    mistakes = len(correct_set.symmetric_difference(user_set))
-                    score_for_question = calculate_tl2_score(mistakes)
-                    
-                    if mistakes == 0:
-                        is_correct = True
-                        correct_count += 1
-                
-                total_score_float += score_for_question
-            
-            else:
-                # Câu TL1: đúng/sai
-                if isinstance(correct_answer, list):
-                    is_correct = set(user_answer) == set(correct_answer) if isinstance(user_answer, list) else False
-                else:
-                    is_correct = str(user_answer).strip().upper() == str(correct_answer).strip().upper()
-                
-                if is_correct:
-                    correct_count += 1
-                    score_for_question = 1.0
-                
-                total_score_float += score_for_question
-            
-            details.append({
-                'question_id': q_id,
-                'user_answer': user_answer,
-                'correct_answer': correct_answer,
-                'is_correct': is_correct,
-                'score': score_for_question,
-                'type': q_type
-            })
-        
-        # Tính điểm thang 10
-        score = round((total_score_float / total_questions * 10) if total_questions > 0 else 0, 1)
+        graded = answer_key.grade(answers)
+        score = graded['score']
+        correct_count = graded['correct_count']
+        total_questions = graded['total_questions']
+        details = graded['details']
         
         # Lưu kết quả vào file
         result_record = {
@@ -1522,7 +1577,7 @@ def nop_bai_tracnghiem():
             'username': session.get('username'),
             'grade': grade,
             'exam_id': exam_id,
-            'exam_title': exam.get('title', 'Đề thi'),
+            'exam_title': answer_key.title,
             'answers': answers,
             'score': score,
             'correct_count': correct_count,
@@ -1531,22 +1586,11 @@ def nop_bai_tracnghiem():
             'submitted_at': datetime.now().isoformat()
         }
         
-        # Đọc file kết quả hiện tại
-        results_file = 'data/exam_results.json'
-        
-        try:
-            with open(results_file, 'r', encoding='utf-8') as f:
-                all_results = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            all_results = []
-        
-        # Thêm kết quả mới
-        all_results.append(result_record)
+        # Lưu kết quả
+        db.add_exam_result(result_record)
         
-        # Lưu lại file
-        ensure_directory('data')
-        with open(results_file, 'w', encoding='utf-8') as f:
-            json.dump(all_results, f, ensure_ascii=False, indent=2)
+        # Tạo phân tích AI nền ngay sau khi lưu, trang kết quả chỉ việc đọc lại
+        schedule_result_analysis(result_record)
         
         # Xóa session thời gian làm bài
         session_key = f'exam_start_{grade}_{exam_id}'
@@ -1579,6 +1623,8 @@ def nop_bai_tracnghiem():
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'doc', 'docx', 'txt', 'zip', 'rar'}
 MAX_FILE_SIZE = 10 * 1024 * 1024
+FORUM_PAGE_SIZE = 20
+FORUM_MAX_PAGE_SIZE = 50
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -1610,29 +1656,22 @@ def format_correct_answer(value):
         return ', '.join(str(v).strip() for v in value if str(v).strip())
     return str(value).strip()
 
-def calculate_tl2_score(mistakes_count):
-    if mistakes_count <= 0:
-        return 1.0
-    if mistakes_count == 1:
-        return 0.5
-    if mistakes_count == 2:
-        return 0.25
-    if mistakes_count == 3:
-        return 0.1
-    return 0.0
-
 @app.route('/forum')
 @login_required
 def forum():
     search_query = request.args.get('search', '').strip()
     filter_type = request.args.get('filter', 'all')
+    before = parse_forum_cursor(request.args.get('before'))
+    limit = request.args.get('limit', FORUM_PAGE_SIZE, type=int) or FORUM_PAGE_SIZE
+    limit = max(1, min(limit, FORUM_MAX_PAGE_SIZE))
+    next_cursor = None
     
     if search_query:
         posts = db.search_forum_posts(search_query)
-    elif filter_type == 'my_posts':
-        posts = db.get_forum_posts_by_user(session['user_id'])
     else:
-        posts = db.get_all_forum_posts()
+        # Phân trang theo con trỏ (created_at, id): chỉ đọc và định dạng đúng một trang
+        author_id = session['user_id'] if filter_type == 'my_posts' else None
+        posts, next_cursor = db.get_forum_posts_page(before=before, limit=limit, author_id=author_id)
     
     for post in posts:
         post['created_at_formatted'] = format_datetime(post['created_at'])
@@ -1643,6 +1682,9 @@ def forum():
                          posts=posts,
                          search_query=search_query,
                          filter_type=filter_type,
+                         is_first_page=before is None,
+                         next_cursor=','.join(next_cursor) if next_cursor else None,
+                         limit=limit,
                          username=session.get('username'))
 
 
@@ -1659,19 +1701,21 @@ def forum_post_detail(post_id):
     db.increment_post_views(post_id)
     
     comments = db.get_comments_by_post(post_id)
+    roots, _ = load_comment_tree(comments)
     
     post['created_at_formatted'] = format_datetime(post['created_at'])
     if post.get('updated_at'):
         post['updated_at_formatted'] = format_datetime(post['updated_at'])
     
-    for comment in comments:
-        comment['created_at_formatted'] = format_datetime(comment['created_at'])
-    
     is_author = post['author_id'] == session['user_id']
     
+    # Chỉ gửi kèm các bình luận gốc đầu tiên, phần còn lại tải qua forum_more_comments
     return render_template('forum_post_detail.html',
                          post=post,
-                         comments=comments,
+                         comment_roots=roots[:ROOT_PAGE_SIZE],
+                         next_offset=ROOT_PAGE_SIZE if len(roots) > ROOT_PAGE_SIZE else None,
+                         comments_total=len(comments),
+                         reply_preview=REPLY_PREVIEW_SIZE,
                          is_author=is_author,
                          current_user_id=session['user_id'],  # ✅ THÊM DÒNG NÀY
                          username=session.get('username'))
@@ -1847,6 +1891,11 @@ def forum_add_comment(post_id):
         if not content:
             return jsonify({'success': False, 'message': 'Vui lòng nhập nội dung bình luận'})
         
+        if parent_id:
+            parent = db.get_comment_by_id(parent_id)
+            if not parent or parent.get('post_id') != post_id:
+                return jsonify({'success': False, 'message': 'Bình luận được phản hồi không tồn tại'})
+        
         attachments = []
         if 'files' in request.files:
             files = request.files.getlist('files')
@@ -1893,8 +1942,7 @@ def forum_add_comment(post_id):
 @app.route('/forum/delete-comment/<comment_id>', methods=['POST'])
 @login_required
 def forum_delete_comment(comment_id):
-    comments = db._load_json(db.forum_comments_file)
-    comment = next((c for c in comments if c['id'] == comment_id), None)
+    comment = db.get_comment_by_id(comment_id)
     
     if not comment:
         return jsonify({'success': False, 'message': 'Bình luận không tồn tại'})
@@ -1914,6 +1962,60 @@ def forum_delete_comment(comment_id):
     return jsonify({'success': True, 'message': 'Xóa bình luận thành công'})
 
 
+@app.route('/forum/post/<post_id>/comments')
+@login_required
+def forum_more_comments(post_id):
+    """Các bình luận gốc tiếp theo (kèm phản hồi xem trước) dưới dạng HTML"""
+    if not db.get_forum_post_by_id(post_id):
+        return jsonify({'success': False, 'message': 'Bài viết không tồn tại'})
+    
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    roots, _ = load_comment_tree(db.get_comments_by_post(post_id))
+    end = offset + ROOT_PAGE_SIZE
+    
+    return jsonify({
+        'success': True,
+        'html': render_comment_fragment(roots[offset:end]),
+        'next_offset': end if end < len(roots) else None
+    })
+
+
+@app.route('/forum/comment/<comment_id>/replies')
+@login_required
+def forum_comment_replies(comment_id):
+    """Toàn bộ phản hồi trực tiếp của một bình luận dưới dạng HTML"""
+    comment = db.get_comment_by_id(comment_id)
+    
+    if not comment:
+        return jsonify({'success': False, 'message': 'Bình luận không tồn tại'})
+    
+    _, nodes = load_comment_tree(db.get_comments_by_post(comment['post_id']))
+    node = nodes.get(comment_id)
+    
+    return jsonify({'success': True, 'html': render_comment_fragment(node['replies'] if node else [])})
+
+
+def load_comment_tree(comments):
+    for comment in comments:
+        comment['created_at_formatted'] = format_datetime(comment['created_at'])
+    return build_comment_tree(comments)
+
+
+def render_comment_fragment(comments):
+    return render_template('forum_comments_fragment.html',
+                           comments=comments,
+                           reply_preview=REPLY_PREVIEW_SIZE,
+                           current_user_id=session['user_id'])
+
+
+def parse_forum_cursor(value):
+    """Con trỏ phân trang diễn đàn dạng '<created_at>,<post_id>' -> tuple, sai định dạng thì bỏ qua"""
+    if not value or ',' not in value:
+        return None
+    created_at, post_id = value.rsplit(',', 1)
+    return (created_at, post_id)
+
+
 def format_datetime(iso_string):
     try:
         dt = datetime.fromisoformat(iso_string)
@@ -1921,19 +2023,48 @@ def format_datetime(iso_string):
     except:
         return iso_string
 #######
+CHAT_ROOM_SIZE = 50      # số tin hiển thị khi mở phòng chat
+CHAT_HISTORY_PAGE = 50   # số tin mỗi lần cuộn xem tin cũ
+
+
 @app.route('/chat')
 @login_required
 def chat_room():
-    messages = db.get_all_chat_messages()
+    messages = db.get_recent_chat_messages(CHAT_ROOM_SIZE)
     
     for msg in messages:
         msg['created_at_formatted'] = format_datetime(msg['created_at'])
     
     return render_template('chat_room.html',
                          messages=messages,
+                         has_older=len(messages) == CHAT_ROOM_SIZE,
                          username=session.get('username'))
 
 
+@app.route('/api/chat/history')
+@login_required
+def get_chat_history():
+    """Tin cũ hơn tin `before` để cuộn ngược, đọc cả lịch sử đã lưu trữ"""
+    try:
+        before = request.args.get('before', '').strip()
+        if not before:
+            return jsonify({'success': False, 'message': 'Thiếu tham số before'})
+        
+        messages = db.get_chat_messages_before(before, CHAT_HISTORY_PAGE)
+        
+        for msg in messages:
+            msg['created_at_formatted'] = format_datetime(msg['created_at'])
+        
+        return jsonify({
+            'success': True,
+            'messages': messages,
+            'has_more': len(messages) == CHAT_HISTORY_PAGE
+        })
+    
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Lỗi: {str(e)}'})
+
+
 @app.route('/api/chat/send', methods=['POST'])
 @login_required
 def send_chat_message():
@@ -1987,6 +2118,65 @@ def get_chat_messages():
         return jsonify({'success': False, 'message': f'Lỗi: {str(e)}'})
 
 
+CHAT_STREAM_HEARTBEAT = 15   # giây - gửi dòng chú thích để proxy không cắt kết nối rảnh
+CHAT_STREAM_MAX_AGE = 90     # giây - đóng luồng định kỳ, trình duyệt tự kết nối lại kèm Last-Event-ID
+# Mỗi luồng SSE giữ một thread của worker gthread suốt thời gian mở: chỉ cho tối đa ngần này luồng
+# mỗi worker (thấp hơn hẳn --threads) để nộp bài, đăng nhập... luôn còn thread. Vượt quá thì trả 503,
+# trang chat chuyển sang hỏi định kỳ 3 giây như trước
+CHAT_STREAM_MAX_CLIENTS = int(os.getenv('CHAT_STREAM_MAX_CLIENTS', '8'))
+chat_stream_slots = threading.BoundedSemaphore(CHAT_STREAM_MAX_CLIENTS)
+
+
+def format_chat_event(broadcaster, seq, event_type, data):
+    if event_type == 'message':
+        data = dict(data, created_at_formatted=format_datetime(data['created_at']))
+    payload = json.dumps(data, ensure_ascii=False)
+    return f'id: {broadcaster.format_id(seq)}\nevent: {event_type}\ndata: {payload}\n\n'
+
+
+@app.route('/api/chat/stream')
+@login_required
+def chat_stream():
+    """
+    Server-Sent Events cho phòng chat: sự kiện 'message' (tin mới), 'delete' (tin bị xóa)
+    và 'reset' khi không thể nhận bù từ Last-Event-ID - client tự tải lại qua /api/chat/messages.
+    """
+    if not chat_stream_slots.acquire(blocking=False):
+        return jsonify({'success': False, 'message': 'Quá nhiều kết nối trực tiếp, chuyển sang tải định kỳ'}), 503
+    broadcaster = db.chat_broadcaster
+    last_event_id = request.headers.get('Last-Event-ID')
+    after_seq = broadcaster.parse_id(last_event_id)
+
+    def generate():
+        cursor = after_seq
+        yield 'retry: 3000\n\n'
+        if cursor is None:
+            cursor = broadcaster.head()
+            if last_event_id:
+                yield f'id: {broadcaster.format_id(cursor)}\nevent: reset\ndata: {{}}\n\n'
+
+        started = time.monotonic()
+        while time.monotonic() - started < CHAT_STREAM_MAX_AGE:
+            events = broadcaster.wait_for_events(cursor, CHAT_STREAM_HEARTBEAT)
+            if events is None:
+                cursor = broadcaster.head()
+                yield f'id: {broadcaster.format_id(cursor)}\nevent: reset\ndata: {{}}\n\n'
+            elif not events:
+                yield ': ping\n\n'
+            else:
+                for seq, event_type, data in events:
+                    yield format_chat_event(broadcaster, seq, event_type, data)
+                cursor = events[-1][0]
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Trả lượt khi máy chủ đóng phản hồi - cả khi client ngắt giữa chừng hay luồng chưa kịp chạy
+    response.call_on_close(chat_stream_slots.release)
+    return response
+
+
 @app.route('/api/chat/delete/<message_id>', methods=['POST'])
 @login_required
 def delete_chat_message(message_id):
@@ -2058,34 +2248,40 @@ def import_exam_ai():
             exam_file.save(temp_path)
             
             try:
-                # Đọc nội dung Word
-                docx_text = extract_text_from_docx(temp_path)
-                
-                if not docx_text or len(docx_text) < 50:
-                    raise ValueError("File Word không có nội dung hoặc nội dung quá ngắn")
-                
-                # Chuyển đổi bằng AI
-                exam_data = convert_exam_with_ai(docx_text, title, description)
-                
-                # Validate
-                validation_errors = validate_exam_data(exam_data)
-                if validation_errors:
-                    raise ValueError("Lỗi dữ liệu: " + " | ".join(validation_errors))
-                
-                # Xóa file tạm
+                # Parser cục bộ đọc trước các câu đúng mẫu (nhanh, không tốn lượt gọi AI)
+                blocks = plan_hybrid_import(temp_path)
+            finally:
                 os.remove(temp_path)
-                
+            
+            leftovers = [block['text'] for block in blocks if 'text' in block]
+            if len(blocks) == len(leftovers) and len(''.join(leftovers).strip()) < 50:
+                raise ValueError("File Word không có nội dung hoặc nội dung quá ngắn")
+            
+            # Đọc được hết mọi câu -> trả về ngay, không cần AI
+            if not leftovers:
+                exam_data = complete_hybrid_import(blocks, title, description)
                 return jsonify({
                     'success': True,
                     'exam_data': exam_data,
-                    'message': f'AI đã tạo {len(exam_data["questions"])} câu hỏi'
+                    'message': import_report_message(exam_data)
                 })
             
-            except Exception as e:
-                # Xóa file tạm nếu lỗi
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                raise e
+            # Phần còn lại chuyển đổi bằng AI chạy nền - trình duyệt hỏi trạng thái qua job_id
+            job_id = job_queue.enqueue('import_exam_ai', {
+                'blocks': blocks,
+                'title': title,
+                'description': description
+            }, owner=session.get('user_id'))
+            
+            if len(blocks) == len(leftovers):
+                message = 'Đã nhận file, AI đang chuyển đổi...'
+            else:
+                message = f'Đã nhận file, AI đang chuyển đổi {len(leftovers)} phần chưa đọc được...'
+            return jsonify({
+                'success': True,
+                'job_id': job_id,
+                'message': message
+            })
         
         except Exception as e:
             return jsonify({
@@ -2099,6 +2295,77 @@ def import_exam_ai():
                          grade_labels=GRADE_LABELS)
 
 
+def import_report_message(exam_data):
+    report = exam_data.get('import_report') or {}
+    message = f'Đã tạo {len(exam_data["questions"])} câu hỏi'
+    if report.get('ai_blocks'):
+        message += f': {report["local_questions"]} câu đọc trực tiếp từ file, {report["ai_questions"]} câu do AI chuyển đổi'
+    elif report:
+        message += ' (đọc trực tiếp từ file, không cần AI)'
+    if report.get('skipped_blocks'):
+        message += f'. AI không chuyển đổi được, cần nhập tay: {", ".join(report["skipped_blocks"])}'
+    return message
+
+
+def run_import_exam_job(payload):
+    # Job tạo trước khi có import kết hợp chỉ mang toàn bộ nội dung đề
+    blocks = payload.get('blocks') or [{'text': payload['docx_text']}]
+    return complete_hybrid_import(blocks, payload['title'], payload['description'])
+
+
+job_queue.register('import_exam_ai', run_import_exam_job)
+# Thread xử lý chạy ngay khi worker nạp app: job còn trong hàng đợi từ trước khi khởi động lại được làm tiếp
+job_queue.start()
+
+
+def get_own_import_job(job_id):
+    job = job_queue.get(job_id)
+    if not job or job['kind'] != 'import_exam_ai' or job['owner'] != session.get('user_id'):
+        return None
+    return job
+
+
+@app.route('/teacher/import_exam_ai/jobs/<job_id>')
+@teacher_required
+def import_exam_ai_status(job_id):
+    """Trạng thái job chuyển đổi đề thi: queued / running / done (kèm exam_data) / failed / cancelled"""
+    job = get_own_import_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': 'Không tìm thấy yêu cầu chuyển đổi'}), 404
+    
+    response = {
+        'success': True,
+        'status': job['status'],
+        'attempts': job['attempts'],
+        'max_attempts': job['max_attempts'],
+        'error': job['error']
+    }
+    if job['status'] == 'done':
+        response['exam_data'] = job['result']
+        response['message'] = import_report_message(job['result'])
+    return jsonify(response)
+
+
+@app.route('/teacher/import_exam_ai/jobs/<job_id>/cancel', methods=['POST'])
+@teacher_required
+def cancel_import_exam_ai(job_id):
+    if not get_own_import_job(job_id):
+        return jsonify({'success': False, 'message': 'Không tìm thấy yêu cầu chuyển đổi'}), 404
+    if not job_queue.cancel(job_id):
+        return jsonify({'success': False, 'message': 'Yêu cầu đã kết thúc, không thể hủy'})
+    return jsonify({'success': True, 'message': 'Đã hủy chuyển đổi'})
+
+
+@app.route('/teacher/import_exam_ai/jobs/<job_id>/retry', methods=['POST'])
+@teacher_required
+def retry_import_exam_ai(job_id):
+    if not get_own_import_job(job_id):
+        return jsonify({'success': False, 'message': 'Không tìm thấy yêu cầu chuyển đổi'}), 404
+    if not job_queue.retry(job_id):
+        return jsonify({'success': False, 'message': 'Chỉ thử lại được yêu cầu đã lỗi hoặc đã hủy'})
+    return jsonify({'success': True, 'message': 'Đang chuyển đổi lại'})
+
+
 @app.route('/teacher/save_exam_ai', methods=['POST'])
 @teacher_required
 def save_exam_ai():
@@ -2124,13 +2391,19 @@ def save_exam_ai():
             q['id'] = idx
             q['number'] = idx
         
+        # Câu do parser cục bộ đọc có thể có nhiều đáp án đúng hoặc là câu Đúng/Sai (TL2)
+        allow_multiple_answers = any(
+            q.get('type') == 'tl2' or len(normalize_correct_answers(q.get('correct_answer'))) > 1
+            for q in exam_data['questions']
+        )
+        
         exam_record = {
             'id': exam_id,
             'title': exam_data.get('title', 'Đề thi'),
             'description': exam_data.get('description', ''),
             'time_limit': exam_data.get('time_limit', 15),
             'questions': exam_data['questions'],
-            'allow_multiple_answers': False,  # Không có câu nhiều đáp án
+            'allow_multiple_answers': allow_multiple_answers,
             'created_by': session.get('user_id'),
             'created_by_name': session.get('username'),
             'created_at': datetime.now().isoformat(),
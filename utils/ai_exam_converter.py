@@ -1,7 +1,27 @@
 import json
+import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from docx import Document
+from utils.exam_parser import QUESTION_PATTERN, parse_docx_exam_partial
 from utils.gemini_api import get_gemini_response
+from utils.gemini_client import GEMINI_BATCH_QUEUE_TIMEOUT, GEMINI_BATCH_TIMEOUT, GEMINI_MAX_CONCURRENCY, is_transient_error
+
+# Mỗi phần gửi cho AI tối đa ngần này token đầu vào (JSON đầu ra dài gấp mấy lần, giới hạn 8192 token)
+CHUNK_TOKEN_BUDGET = int(os.getenv('AI_CHUNK_TOKEN_BUDGET', '2000'))
+# ... và tối đa ngần này câu, để JSON trả về (~150 token mỗi câu) không bị cắt
+CHUNK_MAX_QUESTIONS = 25
+# Số phần được chuyển đổi song song trong mỗi worker (mọi lần import cộng lại); luôn nhỏ hơn
+# GEMINI_MAX_CONCURRENCY để chatbot và phân tích kết quả vẫn còn lượt gọi AI
+AI_CONVERT_CONCURRENCY = max(1, min(int(os.getenv('AI_CONVERT_CONCURRENCY', '2')), GEMINI_MAX_CONCURRENCY - 1))
+CHUNK_ATTEMPTS = 3
+CHUNK_RETRY_DELAY = 5  # giây, nhân đôi sau mỗi lần AI quá tải/hết hạn
+
+_convert_slots = threading.BoundedSemaphore(AI_CONVERT_CONCURRENCY)
+# Đề không tách được theo câu thì gửi nguyên một phần, cắt bớt nếu quá dài
+MAX_SINGLE_INPUT_LENGTH = 15000
 
 
 def extract_text_from_docx(docx_path):
@@ -31,17 +51,106 @@ def extract_text_from_docx(docx_path):
         raise Exception(f"Lỗi khi đọc file Word: {str(e)}")
 
 
+def estimate_tokens(text):
+    # Ước lượng thô: ~4 byte UTF-8 một token (chữ có dấu tốn nhiều byte hơn)
+    return len(text.encode('utf-8')) // 4 + 1
+
+
+def split_exam_text(docx_text, token_budget=CHUNK_TOKEN_BUDGET, max_questions=CHUNK_MAX_QUESTIONS):
+    """
+    Tách nội dung đề thành các phần theo ranh giới câu hỏi ("Câu 1: ..."), mỗi phần không quá
+    token_budget (trừ khi riêng một câu đã dài hơn) và max_questions câu.
+    Phần mở đầu trước câu 1 đi cùng phần đầu tiên.
+    Không tìm thấy câu hỏi nào thì trả về [docx_text].
+    """
+    blocks = []
+    current = []
+    for line in docx_text.split('\n'):
+        if QUESTION_PATTERN.match(line.strip()) and current:
+            blocks.append('\n'.join(current))
+            current = []
+        current.append(line)
+    if current:
+        blocks.append('\n'.join(current))
+    
+    if len(blocks) <= 1:
+        return [docx_text]
+    
+    # Phần mở đầu (tiêu đề, hướng dẫn) không phải một câu -> gộp vào câu đầu tiên
+    if not QUESTION_PATTERN.match(blocks[0].split('\n', 1)[0].strip()):
+        blocks[1] = blocks[0] + '\n' + blocks[1]
+        del blocks[0]
+    
+    chunks = []
+    chunk, chunk_tokens = [], 0
+    for block in blocks:
+        block_tokens = estimate_tokens(block)
+        if chunk and (chunk_tokens + block_tokens > token_budget or len(chunk) >= max_questions):
+            chunks.append('\n'.join(chunk))
+            chunk, chunk_tokens = [], 0
+        chunk.append(block)
+        chunk_tokens += block_tokens
+    if chunk:
+        chunks.append('\n'.join(chunk))
+    return chunks
+
+
 def convert_exam_with_ai(docx_text, exam_title="", exam_description=""):
     """
-    Sử dụng AI Gemini để chuyển đổi đề thi thành format JSON
+    Sử dụng AI Gemini để chuyển đổi đề thi thành format JSON.
+    Đề dài được tách theo câu hỏi thành nhiều phần, chuyển đổi song song rồi ghép lại,
+    nên không bị cắt bớt câu và chỉ mất khoảng thời gian của một phần.
     """
+    chunks = split_exam_text(docx_text)
+    
+    if len(chunks) == 1:
+        if len(docx_text) > MAX_SINGLE_INPUT_LENGTH:
+            docx_text = docx_text[:MAX_SINGLE_INPUT_LENGTH]
+            print(f"⚠️ Không tách được đề theo câu hỏi, đã cắt nội dung xuống {MAX_SINGLE_INPUT_LENGTH} ký tự")
+        parts = [_convert_chunk_with_retry(docx_text, exam_title, exam_description)]
+    else:
+        print(f"✂️ Chia đề thi thành {len(chunks)} phần để chuyển đổi song song")
+        with ThreadPoolExecutor(max_workers=min(AI_CONVERT_CONCURRENCY, len(chunks))) as executor:
+            parts = list(executor.map(
+                lambda chunk: _convert_chunk_with_retry(chunk, exam_title, exam_description), chunks
+            ))
+    
+    exam_data = parts[0]
+    exam_data['questions'] = [question for part in parts for question in part['questions']]
+    for idx, question in enumerate(exam_data['questions'], start=1):
+        question['number'] = idx
+        question['id'] = idx
     
-    # Giới hạn độ dài input để tránh vượt quá token limit
-    max_input_length = 15000
-    if len(docx_text) > max_input_length:
-        docx_text = docx_text[:max_input_length]
-        print(f"⚠️ Đã cắt nội dung đề thi xuống {max_input_length} ký tự")
+    validation_errors = validate_exam_data(exam_data)
+    if validation_errors:
+        raise ValueError("Lỗi dữ liệu: " + " | ".join(validation_errors))
     
+    print(f"✅ AI đã tạo {len(exam_data['questions'])} câu hỏi ({len(parts)} phần)")
+    return exam_data
+
+
+def _convert_chunk_with_retry(docx_text, exam_title, exam_description):
+    # AI đôi khi trả JSON hỏng/thiếu: thử lại riêng phần đó thay vì làm lại cả đề.
+    # AI quá tải/hết hạn thì chờ tăng dần rồi mới thử lại, thử ngay chỉ làm tắc thêm
+    for attempt in range(1, CHUNK_ATTEMPTS + 1):
+        try:
+            with _convert_slots:
+                return _convert_chunk(docx_text, exam_title, exam_description)
+        except Exception as e:
+            if attempt == CHUNK_ATTEMPTS:
+                raise
+            if is_transient_error(e):
+                delay = CHUNK_RETRY_DELAY * 2 ** (attempt - 1)
+                print(f"⚠️ AI bận khi chuyển đổi một phần đề thi, thử lại sau {delay} giây: {e}")
+                time.sleep(delay)
+            else:
+                print(f"⚠️ Chuyển đổi một phần đề thi lỗi, thử lại: {e}")
+
+
+def _convert_chunk(docx_text, exam_title="", exam_description=""):
+    """
+    Chuyển đổi một phần đề thi (hoặc cả đề ngắn) bằng một lần gọi Gemini
+    """
     prompt = f"""
 Bạn là trợ lý AI chuyên chuyển đổi đề thi. Hãy phân tích nội dung đề thi dưới đây và chuyển thành format JSON.
 
@@ -65,7 +174,7 @@ Bạn là trợ lý AI chuyên chuyển đổi đề thi. Hãy phân tích nội
 5. **GIỮ NỘI DUNG NGẮN GỌN:**
    - `question`: Chỉ lấy nội dung chính, bỏ phần dài dòng
    - `explanation`: Tối đa 1-2 câu, bỏ nếu không cần thiết
-   - Nếu đề có >20 câu, chỉ lấy 20 câu đầu tiên
+   - Chuyển đổi TẤT CẢ câu hỏi có trong nội dung, không bỏ câu nào
 
 6. Format JSON trả về (KHÔNG có markdown backticks):
 
@@ -103,7 +212,6 @@ Bạn là trợ lý AI chuyên chuyển đổi đề thi. Hãy phân tích nội
 {docx_text}
 
 **LƯU Ý QUAN TRỌNG:**
-- Nếu đề thi quá dài, chỉ convert tối đa 20 câu đầu tiên
 - Trả về ĐÚNG format JSON như trên
 - TUYỆT ĐỐI KHÔNG thêm markdown backticks (```) hoặc text giải thích
 - CHỈ TRẢ VỀ JSON thuần túy
@@ -112,8 +220,9 @@ Bạn là trợ lý AI chuyên chuyển đổi đề thi. Hãy phân tích nội
 """
 
     try:
-        # Gọi AI với max_tokens cao hơn
-        response = get_gemini_response(prompt, temperature=0.5, max_tokens=8192)
+        # Gọi AI với max_tokens cao hơn; JSON dài sinh lâu nên dùng thời hạn của việc nền
+        response = get_gemini_response(prompt, temperature=0.5, max_tokens=8192,
+                                       timeout=GEMINI_BATCH_TIMEOUT, queue_timeout=GEMINI_BATCH_QUEUE_TIMEOUT)
         
         # Làm sạch response
         response = response.strip()
@@ -220,8 +329,6 @@ Last 300 chars: {response[-300:]}
         if 'time_limit' not in exam_data:
             exam_data['time_limit'] = 15
         
-        print(f"✅ AI đã tạo {len(exam_data['questions'])} câu hỏi")
-        
         return exam_data
     
     except json.JSONDecodeError as e:
@@ -243,12 +350,105 @@ Last 500 chars:
         raise ValueError(f"AI trả về JSON không hợp lệ. Vui lòng thử lại hoặc chọn đề thi ngắn hơn.")
     
     except Exception as e:
+        if is_transient_error(e):
+            raise  # để _convert_chunk_with_retry chờ rồi thử lại
         print(f"❌ Error in convert_exam_with_ai: {str(e)}")
         import traceback
         traceback.print_exc()
         raise Exception(f"Lỗi khi xử lý với AI: {str(e)}")
 
 
+def plan_hybrid_import(docx_path):
+    """
+    Đọc đề bằng parser cục bộ trước: trả về các khối theo thứ tự trong đề, {'question': ...} cho câu
+    đọc được trọn vẹn và {'text': ...} cho phần phải nhờ AI. Không đọc được câu nào (đề không theo
+    mẫu "Câu 1: ...", câu hỏi nằm trong bảng...) thì gửi toàn bộ nội dung cho AI như trước.
+    """
+    blocks = parse_docx_exam_partial(docx_path)
+    if not any('question' in block for block in blocks):
+        return [{'text': extract_text_from_docx(docx_path)}]
+    return blocks
+
+
+def _normalize_local_question(question):
+    # Cùng dạng với câu AI tạo: đáp án là một chữ cái, hoặc danh sách khi nhiều đáp án / câu TL2
+    answers = question.get('correct_answer')
+    answers = sorted({str(a).strip().upper() for a in (answers if isinstance(answers, list) else [answers]) if a})
+    normalized = dict(question)
+    normalized['correct_answer'] = answers if question.get('type') == 'tl2' or len(answers) > 1 else answers[0]
+    normalized.setdefault('explanation', '')
+    return normalized
+
+
+def complete_hybrid_import(blocks, exam_title="", exam_description=""):
+    """
+    Ghép câu parser cục bộ đã đọc với câu AI chuyển đổi từ các khối còn lại (giữ thứ tự trong đề).
+    Mỗi khối còn lại là đúng một câu ("Câu N: ...") nên được chuyển đổi riêng và đặt lại đúng chỗ;
+    khối AI không chuyển đổi được thì bỏ qua và ghi tên vào import_report['skipped_blocks'].
+    Không đọc được câu nào (cả đề là một khối) thì chuyển đổi cả đề như convert_exam_with_ai.
+    Trả về exam_data kèm import_report: số câu mỗi đường tạo ra.
+    """
+    leftovers = [block['text'] for block in blocks if 'text' in block]
+    skipped = []
+    if len(leftovers) == len(blocks):
+        questions = convert_exam_with_ai('\n'.join(leftovers), exam_title, exam_description)['questions']
+        ai_count = len(questions)
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, min(AI_CONVERT_CONCURRENCY, len(leftovers)))) as executor:
+            converted = iter(executor.map(
+                lambda text: _convert_leftover_block(text, exam_title, exam_description), leftovers
+            ))
+            questions = []
+            ai_count = 0
+            for block in blocks:
+                if 'question' in block:
+                    questions.append(_normalize_local_question(block['question']))
+                    continue
+                block_questions = next(converted)
+                if block_questions is None:
+                    skipped.append(block['text'].split('\n', 1)[0].strip())
+                    continue
+                questions.extend(block_questions)
+                ai_count += len(block_questions)
+    
+    for idx, question in enumerate(questions, start=1):
+        question['number'] = idx
+        question['id'] = idx
+    
+    exam_data = {
+        'title': exam_title or 'Đề thi',
+        'description': exam_description,
+        'time_limit': 15,
+        'questions': questions
+    }
+    validation_errors = validate_exam_data(exam_data)
+    if validation_errors:
+        raise ValueError("Lỗi dữ liệu: " + " | ".join(validation_errors))
+    
+    local_count = len(questions) - ai_count
+    exam_data['import_report'] = {
+        'local_questions': local_count,
+        'ai_questions': ai_count,
+        'ai_blocks': len(leftovers),
+        'skipped_blocks': skipped
+    }
+    print(f"📄 Import đề: {local_count} câu đọc trực tiếp, {ai_count} câu do AI chuyển đổi "
+          f"({len(leftovers)} đoạn, bỏ qua {len(skipped)})")
+    return exam_data
+
+
+def _convert_leftover_block(text, exam_title, exam_description):
+    """Câu AI tạo từ một khối còn lại, hoặc None nếu AI không chuyển đổi được"""
+    try:
+        return _convert_chunk_with_retry(text, exam_title, exam_description)['questions']
+    except Exception as e:
+        if is_transient_error(e):
+            raise  # AI quá tải/hết hạn: để job thử lại cả lần import thay vì bỏ câu
+        heading = text.split('\n', 1)[0].strip()
+        print(f"⚠️ Bỏ qua '{heading}': AI không chuyển đổi được ({e})")
+        return None
+
+
 def validate_exam_data(exam_data):
     """
     Kiểm tra tính hợp lệ của đề thi sau khi convert
@@ -271,32 +471,32 @@ def validate_exam_data(exam_data):
         if not q.get('question'):
             errors.append(f"Câu {idx}: Thiếu nội dung câu hỏi")
         
-        if q_type == 'tl1':
-            # Kiểm tra trắc nghiệm
+        if q_type in ('tl1', 'tl2'):
+            # Kiểm tra trắc nghiệm (tl2: Đúng/Sai 4 ý, đáp án là danh sách ý đúng)
             if 'options' not in q or not isinstance(q['options'], dict):
                 errors.append(f"Câu {idx}: Câu trắc nghiệm thiếu đáp án")
                 continue
             
             options = q['options']
-            if len(options) < 4:
-                errors.append(f"Câu {idx}: Thiếu đáp án (cần 4 đáp án ABCD)")
-            
-            required_keys = {'A', 'B', 'C', 'D'}
-            if not required_keys.issubset(set(options.keys())):
-                missing = required_keys - set(options.keys())
-                errors.append(f"Câu {idx}: Thiếu đáp án {', '.join(missing)}")
+            if q_type == 'tl2' and len(options) != 4:
+                errors.append(f"Câu {idx}: Câu Đúng/Sai cần đúng 4 ý")
+            elif len(options) < 2:
+                errors.append(f"Câu {idx}: Thiếu đáp án (cần ít nhất 2 lựa chọn)")
             
             correct = q.get('correct_answer')
-            if not correct:
+            answers = correct if isinstance(correct, list) else [correct]
+            answers = [str(answer).strip().upper() for answer in answers if answer]
+            if not answers:
                 errors.append(f"Câu {idx}: Thiếu đáp án đúng")
-            elif str(correct).strip().upper() not in options:
-                errors.append(f"Câu {idx}: Đáp án đúng '{correct}' không nằm trong A/B/C/D")
+            for answer in answers:
+                if answer not in options:
+                    errors.append(f"Câu {idx}: Đáp án đúng '{answer}' không nằm trong các lựa chọn")
         
         elif q_type == 'essay':
             # Câu tự luận không cần validate nhiều
             pass
         
         else:
-            errors.append(f"Câu {idx}: Loại câu hỏi '{q_type}' không hợp lệ (chỉ chấp nhận 'tl1' hoặc 'essay')")
+            errors.append(f"Câu {idx}: Loại câu hỏi '{q_type}' không hợp lệ (chỉ chấp nhận 'tl1', 'tl2' hoặc 'essay')")
     
     return errors
\ No newline at end of file
@@ -1,57 +1,71 @@
 from werkzeug.security import generate_password_hash, check_password_hash
-import json
-import os
 from datetime import datetime
 
+from utils.database import get_storage_backend
+from utils.user_directory import UserDirectory
+
 USERS_FILE = 'data/users.json'
 
+# Chỉ mục user trong bộ nhớ cho backend JSON: tra theo id / username / email là O(1)
+user_directory = UserDirectory(USERS_FILE)
+
+def _sqlite_store():
+    """Trả về SQLiteDatabase nếu STORAGE_BACKEND=sqlite, ngược lại None (dùng file JSON)"""
+    if get_storage_backend() != 'sqlite':
+        return None
+    from utils.sqlite_database import get_sqlite_database
+    return get_sqlite_database()
+
 def load_users():
     """Load users từ file JSON"""
-    if not os.path.exists(USERS_FILE):
-        return []
-    with open(USERS_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    store = _sqlite_store()
+    if store:
+        return store.load_users()
+    return user_directory.all()
 
 def save_users(users):
     """Lưu users vào file JSON"""
-    with open(USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
+    store = _sqlite_store()
+    if store:
+        store.save_users(users)
+        return
+    user_directory.save(users)
 
 def register_user(username, password, email, role='student'):
     """
     Đăng ký user mới
     role: 'student' hoặc 'teacher' (teacher được admin tạo riêng)
     """
-    users = load_users()
-    
-    # Kiểm tra username đã tồn tại
-    if any(u['username'] == username for u in users):
-        return {'success': False, 'message': 'Tên đăng nhập đã tồn tại'}
-    
-    # Kiểm tra email đã tồn tại
-    if any(u['email'] == email for u in users):
-        return {'success': False, 'message': 'Email đã được sử dụng'}
-    
-    # Tạo user mới
-    user_id = str(len(users) + 1)
     new_user = {
-        'id': user_id,
         'username': username,
         'password': generate_password_hash(password),
         'email': email,
         'role': role,  # student hoặc teacher
         'created_at': datetime.now().isoformat()
     }
-    
-    users.append(new_user)
-    save_users(users)
-    
+
+    # Kiểm tra trùng username / email và thêm user trong cùng một lần khóa
+    # (SQLite: một giao dịch, JSON: chỉ mục của user_directory)
+    store = _sqlite_store()
+    if store:
+        _, conflict = store.create_user(new_user)
+    else:
+        _, conflict = user_directory.create(new_user)
+
+    if conflict == 'username':
+        return {'success': False, 'message': 'Tên đăng nhập đã tồn tại'}
+    if conflict == 'email':
+        return {'success': False, 'message': 'Email đã được sử dụng'}
+
     return {'success': True, 'message': 'Đăng ký thành công'}
 
 def login_user(username, password):
     """Đăng nhập user (hỗ trợ cả hash và plaintext cho bản demo)"""
-    users = load_users()
-    user = next((u for u in users if u['username'] == username), None)
+    store = _sqlite_store()
+    if store:
+        user = store.get_user_by_username(username)
+    else:
+        user = user_directory.get_by_username(username)
 
     if not user:
         return {'success': False, 'message': 'Tên đăng nhập không tồn tại'}
@@ -78,8 +92,10 @@ def login_user(username, password):
 
 def get_user_by_id(user_id):
     """Lấy thông tin user theo ID"""
-    users = load_users()
-    return next((u for u in users if u['id'] == user_id), None)
+    store = _sqlite_store()
+    if store:
+        return store.get_user_by_id(user_id)
+    return user_directory.get_by_id(user_id)
 
 def create_teacher_account(username, password, email):
     """Tạo tài khoản giáo viên (admin dùng)"""
@@ -0,0 +1,46 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Số việc nền (gọi AI...) chạy song song trong một worker
+BACKGROUND_WORKERS = int(os.getenv('BACKGROUND_WORKERS', '2'))
+
+
+class BackgroundTasks:
+    """
+    Hàng đợi việc nền trong tiến trình: submit() trả về ngay, việc chạy trên thread pool.
+    Mỗi khóa chỉ có một việc đang chờ/chạy, gọi trùng thì bỏ qua.
+    """
+
+    def __init__(self, max_workers=BACKGROUND_WORKERS):
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Thread của pool không sống sót qua fork -> mỗi worker gunicorn tạo pool riêng
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='background')
+            self._active = set()
+            self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, key, fn, *args):
+        with self._lock:
+            executor = self._get_executor()
+            if key in self._active:
+                return False
+            self._active.add(key)
+        executor.submit(self._run, key, fn, args)
+        return True
+
+    def _run(self, key, fn, args):
+        try:
+            fn(*args)
+        except Exception as exc:
+            print(f"⚠️ Background task {key} failed: {exc}")
+        finally:
+            with self._lock:
+                self._active.discard(key)
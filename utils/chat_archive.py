@@ -0,0 +1,176 @@
+import bisect
+import gzip
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+from utils.sequence import id_seq
+
+# Số đoạn lưu trữ đã giải nén được giữ trong bộ nhớ (cuộn ngược thường đọc lại vài ngày gần nhất)
+SEGMENT_CACHE_SIZE = 8
+
+
+class ChatArchive:
+    """
+    Lịch sử chat cũ, chia đoạn theo ngày: `{directory}/{YYYY-MM-DD}.jsonl.gz`, mỗi dòng một tin nhắn.
+    Thêm tin vào đoạn bằng cách nối thêm một gzip member vào cuối file (không phải nén lại cả đoạn).
+    `index.json` ghi khoảng số thứ tự tin (first_seq..last_seq) và số byte đã ghi xong (size) của
+    từng đoạn; người đọc bỏ qua member cuối chưa ghi xong.
+    Nơi gọi phải giữ khóa của file chat đang sống khi ghi (append / delete).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_file = os.path.join(directory, 'index.json')
+        self._cache = OrderedDict()  # đường dẫn đoạn -> (signature, danh sách tin)
+        self._lock = threading.Lock()
+
+    def _segment_path(self, day):
+        return os.path.join(self.directory, f'{day}.jsonl.gz')
+
+    def load_index(self):
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, FileNotFoundError):
+            return []
+
+    @staticmethod
+    def _replace_file(path, data):
+        # Ghi file tạm rồi os.replace để tiến trình khác không đọc phải đoạn đang ghi dở
+        temp_file = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(data)
+        os.replace(temp_file, path)
+
+    @staticmethod
+    def _compress(messages):
+        return gzip.compress(''.join(json.dumps(m, ensure_ascii=False) + '\n' for m in messages).encode('utf-8'))
+
+    @staticmethod
+    def _decompress(data):
+        """Giải nén các gzip member nối tiếp nhau; member cuối còn dở (đang được nối thêm) bị bỏ qua"""
+        chunks = []
+        while data:
+            decompressor = zlib.decompressobj(wbits=31)
+            chunk = decompressor.decompress(data)
+            if not decompressor.eof:
+                break
+            chunks.append(chunk)
+            data = decompressor.unused_data
+        return b''.join(chunks)
+
+    def _save_index(self, segments):
+        self._replace_file(self.index_file, json.dumps(segments, ensure_ascii=False, indent=2).encode('utf-8'))
+
+    def last_seq(self):
+        segments = self.load_index()
+        return max((s['last_seq'] for s in segments), default=0)
+
+    def append(self, messages):
+        """Chuyển các tin (theo thứ tự thời gian) vào đoạn của ngày tương ứng"""
+        if not messages:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        segments = {s['day']: s for s in self.load_index()}
+
+        by_day = OrderedDict()
+        for message in messages:
+            by_day.setdefault((message.get('created_at') or '')[:10] or 'unknown', []).append(message)
+
+        for day, day_messages in by_day.items():
+            segment = segments.get(day)
+            with open(self._segment_path(day), 'ab') as f:
+                # Lần trước có thể đã dừng sau khi nối mà chưa kịp lưu index: cắt bỏ phần index chưa
+                # ghi nhận (các tin đó vẫn còn trong file chat đang sống). Index cũ không có size thì giữ nguyên
+                recorded = segment.get('size') if segment else 0
+                if recorded is not None and os.fstat(f.fileno()).st_size > recorded:
+                    f.truncate(recorded)
+                f.write(self._compress(day_messages))
+                f.flush()
+                os.fsync(f.fileno())
+                size = os.fstat(f.fileno()).st_size
+            seqs = [id_seq(m) for m in day_messages]
+            segment = segments.setdefault(day, {
+                'day': day, 'first_seq': min(seqs), 'last_seq': max(seqs), 'count': 0
+            })
+            segment['first_seq'] = min(segment['first_seq'], *seqs)
+            segment['last_seq'] = max(segment['last_seq'], *seqs)
+            segment['count'] += len(day_messages)
+            segment['size'] = size
+
+        self._save_index(sorted(segments.values(), key=lambda s: s['first_seq']))
+
+    def read_segment(self, day):
+        """Các tin của một đoạn - CHỈ ĐỌC (dùng chung trong cache)"""
+        path = self._segment_path(day)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return []
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        with self._lock:
+            entry = self._cache.get(path)
+            if entry and entry[0] == signature:
+                self._cache.move_to_end(path)
+                return entry[1]
+        with open(path, 'rb') as f:
+            lines = self._decompress(f.read()).decode('utf-8').split('\n')
+        messages = [json.loads(line) for line in lines if line.strip()]
+        with self._lock:
+            self._cache[path] = (signature, messages)
+            while len(self._cache) > SEGMENT_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return messages
+
+    def _segment_for(self, seq):
+        segments = self.load_index()
+        position = bisect.bisect_right([s['first_seq'] for s in segments], seq) - 1
+        if position >= 0 and seq <= segments[position]['last_seq']:
+            return segments[position]
+        return None
+
+    def get(self, message_id):
+        segment = self._segment_for(id_seq(message_id))
+        if segment is None:
+            return None
+        return next((m for m in self.read_segment(segment['day']) if m['id'] == message_id), None)
+
+    def messages_before(self, before_seq, limit):
+        """Tối đa `limit` tin có số thứ tự nhỏ hơn before_seq, theo thứ tự thời gian"""
+        collected = []
+        for segment in reversed(self.load_index()):
+            if segment['first_seq'] >= before_seq:
+                continue
+            older = [m for m in self.read_segment(segment['day']) if id_seq(m) < before_seq]
+            collected = older[-(limit - len(collected)):] + collected
+            if len(collected) >= limit:
+                break
+        return collected
+
+    def delete(self, message_id):
+        """Xóa một tin đã lưu trữ: nén lại riêng đoạn chứa nó"""
+        segment = self._segment_for(id_seq(message_id))
+        if segment is None:
+            return False
+        messages = self.read_segment(segment['day'])
+        remaining = [m for m in messages if m['id'] != message_id]
+        if len(remaining) == len(messages):
+            return False
+
+        data = self._compress(remaining)
+        self._replace_file(self._segment_path(segment['day']), data)
+
+        segments = self.load_index()
+        for entry in segments:
+            if entry['day'] == segment['day']:
+                entry['count'] = len(remaining)
+                entry['size'] = len(data)
+        self._save_index(segments)
+        return True
+
+    def iter_messages(self):
+        for segment in self.load_index():
+            yield from self.read_segment(segment['day'])
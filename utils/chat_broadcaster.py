@@ -0,0 +1,73 @@
+import itertools
+import threading
+import uuid
+from collections import deque
+
+from utils.message_bus import create_message_bus
+
+# Số sự kiện gần nhất được giữ lại để client kết nối lại (Last-Event-ID) nhận bù
+CHAT_EVENT_HISTORY = 500
+
+
+class ChatBroadcaster:
+    """
+    Phát sự kiện phòng chat (tin nhắn mới / tin nhắn bị xóa) tới các kết nối SSE.
+    Sự kiện đi qua message bus (xem utils.message_bus) nên tới được mọi worker, rồi mỗi worker
+    đánh số thứ tự tăng dần cho kết nối của mình; id gửi cho client kèm mã của tiến trình để
+    id của tiến trình khác (hoặc trước khi khởi động lại) bị coi là không hợp lệ.
+    """
+
+    def __init__(self, history=CHAT_EVENT_HISTORY, bus=None):
+        self._token = uuid.uuid4().hex[:8]
+        self._events = deque(maxlen=history)  # (seq, loại sự kiện, dữ liệu)
+        self._seq = 0
+        self._condition = threading.Condition()
+        # Bus khởi động ngay (và tự khởi động lại trong mỗi worker sau fork); lỗi khởi động chỉ
+        # làm bus lùi về giao tin trong worker này, không làm hỏng việc ghi tin nhắn
+        self._bus = bus or create_message_bus()
+        self._bus.start(self._deliver)
+
+    def publish(self, event_type, data):
+        self._bus.start(self._deliver)
+        self._bus.publish({'type': event_type, 'data': data})
+
+    def _deliver(self, event):
+        with self._condition:
+            self._seq += 1
+            self._events.append((self._seq, event['type'], event['data']))
+            self._condition.notify_all()
+
+    def head(self):
+        self._bus.start(self._deliver)
+        with self._condition:
+            return self._seq
+
+    def format_id(self, seq):
+        return f'{self._token}-{seq}'
+
+    def parse_id(self, event_id):
+        """Last-Event-ID -> số thứ tự, hoặc None nếu id không thuộc tiến trình này"""
+        token, _, seq = (event_id or '').partition('-')
+        if token != self._token or not seq.isdigit():
+            return None
+        seq = int(seq)
+        return seq if seq <= self.head() else None
+
+    def _events_after(self, seq):
+        if not self._events or seq >= self._seq:
+            return []
+        first_seq = self._events[0][0]
+        if seq < first_seq - 1:
+            return None  # đã trôi khỏi lịch sử
+        return list(itertools.islice(self._events, seq - first_seq + 1, None))
+
+    def wait_for_events(self, after_seq, timeout):
+        """
+        Chờ tối đa `timeout` giây cho tới khi có sự kiện sau `after_seq`.
+        Trả về danh sách sự kiện (rỗng nếu hết giờ), hoặc None nếu client đã lỡ
+        quá nhiều sự kiện và phải tải lại tin nhắn từ storage.
+        """
+        self._bus.start(self._deliver)
+        with self._condition:
+            self._condition.wait_for(lambda: self._seq > after_seq, timeout)
+            return self._events_after(after_seq)
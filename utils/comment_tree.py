@@ -0,0 +1,33 @@
+# Phản hồi sâu hơn MAX_REPLY_DEPTH được hiển thị ngang hàng ở độ sâu MAX_REPLY_DEPTH
+MAX_REPLY_DEPTH = 3
+# Trang bài viết chỉ gửi kèm ROOT_PAGE_SIZE bình luận gốc đầu tiên, phần còn lại tải khi cần
+ROOT_PAGE_SIZE = 20
+# Mỗi bình luận hiển thị sẵn tối đa REPLY_PREVIEW_SIZE phản hồi, bấm "Xem thêm" để tải hết
+REPLY_PREVIEW_SIZE = 3
+
+
+def build_comment_tree(comments, max_depth=MAX_REPLY_DEPTH):
+    """
+    Dựng cây bình luận trong O(n) từ danh sách bình luận đã sắp theo thời gian.
+
+    Mỗi nút là bản sao bình luận kèm 'depth' (gốc = 0) và 'replies'. Vì phản hồi luôn
+    đến sau bình luận cha, một lần duyệt là đủ; parent_id không hợp lệ (cha đã bị xóa,
+    hoặc trỏ tới bình luận đến sau) thì bình luận được coi là bình luận gốc.
+    Trả về (danh sách gốc, dict id -> nút).
+    """
+    roots = []
+    nodes = {}
+    anchors = {}  # id -> nút nhận phản hồi của id này (chính nó, hoặc cha nếu đã ở độ sâu tối đa)
+    for comment in comments:
+        node = dict(comment, replies=[])
+        parent = anchors.get(comment.get('parent_id'))
+        if parent is None:
+            node['depth'] = 0
+            roots.append(node)
+        else:
+            node['depth'] = parent['depth'] + 1
+            parent['replies'].append(node)
+        nodes[node['id']] = node
+        anchors[node['id']] = node if node['depth'] < max_depth else parent
+    return roots, nodes
+
@@ -1,8 +1,132 @@
+import bisect
 import json
 import os
+import re
+import shutil
+import threading
 from datetime import datetime
 
+from utils.chat_archive import ChatArchive
+from utils.chat_broadcaster import ChatBroadcaster
+from utils.exam_stats import aggregate_results, apply_result, empty_stats
+from utils.file_lock import file_lock
+from utils.forum_search import ForumSearchIndex
+from utils.result_journal import ResultJournal
+from utils.sequence import SequenceAllocator, id_seq
+from utils.view_counter import ViewCounter
+
 SUPPORTED_GRADES = ['6', '7', '8', '9']
+EXAM_ID_PATTERN = re.compile(r'^[A-Za-z0-9_\-]+$')
+EXAM_SUMMARY_FIELDS = [
+    'id', 'title', 'description', 'time_limit', 'allow_multiple_answers',
+    'created_by', 'created_by_name', 'created_at', 'created_by_ai'
+]
+
+
+def _copy_json(value):
+    """Sao chép nhanh dữ liệu JSON (dict/list/giá trị đơn), nhanh hơn copy.deepcopy"""
+    if isinstance(value, dict):
+        return {key: _copy_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy_json(item) for item in value]
+    return value
+
+
+def get_storage_backend():
+    """Backend lưu trữ: 'json' (mặc định) hoặc 'sqlite', chọn bằng biến môi trường STORAGE_BACKEND"""
+    return os.getenv('STORAGE_BACKEND', 'json').strip().lower()
+
+
+def create_database():
+    if get_storage_backend() == 'sqlite':
+        from utils.sqlite_database import get_sqlite_database
+        return get_sqlite_database()
+    return Database()
+
+
+def normalize_exam(exam):
+    """Bổ sung giá trị mặc định cho đề thi cũ (dùng chung cho mọi backend)"""
+    exam.setdefault('questions', [])
+    exam.setdefault('allow_multiple_answers', False)
+    for question in exam.get('questions', []):
+        if not isinstance(question, dict):
+            continue
+        question.setdefault('type', 'standard')
+        if question.get('type') == 'tl2' and isinstance(question.get('correct_answer'), str):
+            question['correct_answer'] = [question['correct_answer']]
+    return exam
+
+
+def exam_summary(exam):
+    """Metadata của đề thi dùng cho manifest / danh sách đề (không kèm câu hỏi)"""
+    summary = {field: exam[field] for field in EXAM_SUMMARY_FIELDS if field in exam}
+    summary['question_count'] = len(exam.get('questions', []))
+    return summary
+
+
+# Phòng chat giữ tối đa CHAT_LIVE_LIMIT tin gần nhất trong chat_messages.json; khi vượt quá
+# CHAT_LIVE_LIMIT + CHAT_ARCHIVE_BATCH thì phần cũ được chuyển một lượt sang data/chat_archive
+CHAT_LIVE_LIMIT = 500
+CHAT_ARCHIVE_BATCH = 100
+
+
+def forum_post_key(post):
+    """Khóa sắp xếp bài viết (created_at, id) - cũng là con trỏ phân trang"""
+    return (post.get('created_at') or '', post.get('id') or '')
+
+
+def _is_sorted(keys):
+    """Tăng ngặt: khóa trùng nhau thì tìm nhị phân theo khóa không còn xác định được một vị trí"""
+    return all(keys[i] < keys[i + 1] for i in range(len(keys) - 1))
+
+
+def _build_forum_order(posts):
+    """Bài viết theo thứ tự (created_at, id) tăng dần và chỉ mục theo tác giả"""
+    keys = [forum_post_key(post) for post in posts]
+    if keys != sorted(keys):
+        # File cũ chưa đúng thứ tự (bình thường create_forum_post đã chèn đúng chỗ)
+        pairs = sorted(zip(keys, posts), key=lambda pair: pair[0])
+        keys = [key for key, _ in pairs]
+        posts = [post for _, post in pairs]
+    by_author = {}
+    for key, post in zip(keys, posts):
+        author_keys, author_posts = by_author.setdefault(post.get('author_id'), ([], []))
+        author_keys.append(key)
+        author_posts.append(post)
+    return {'keys': keys, 'posts': posts, 'by_author': by_author}
+
+
+def forum_comment_key(comment):
+    return comment.get('created_at') or ''
+
+
+def _build_comments_by_post(comments):
+    """post_id -> (khóa created_at, danh sách bình luận) theo thứ tự thời gian"""
+    grouped = {}
+    for comment in comments:
+        grouped.setdefault(comment.get('post_id'), []).append(comment)
+    by_post = {}
+    for post_id, post_comments in grouped.items():
+        # sort ổn định: cùng thời điểm thì giữ thứ tự trong file như trước
+        post_comments.sort(key=forum_comment_key)
+        by_post[post_id] = ([forum_comment_key(c) for c in post_comments], post_comments)
+    return by_post
+
+
+def _file_signature(filename):
+    """
+    Chữ ký (mtime, ctime, size, inode) để biết file đã thay đổi hay chưa.
+    os.replace đổi ctime của file đích, nên file mới dùng lại inode cũ, cùng kích thước và ghi trong
+    cùng một nhịp mtime vẫn có chữ ký khác. Nếu hệ thống file có độ phân giải thời gian thô (vài ms
+    trở lên), worker khác vẫn có thể đọc dữ liệu cũ trong khoảng đó; tiến trình tự ghi thì không,
+    vì _save_json cập nhật luôn cache của chính file đó.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size, stat.st_ino)
+
 
 class Database:
     def __init__(self):
@@ -14,6 +138,22 @@ class Database:
         self.forum_posts_file = 'data/forum_posts.json'
         self.forum_comments_file = 'data/forum_comments.json'
         self.chat_messages_file = 'data/chat_messages.json'
+        self.forum_version_file = 'data/forum_version.json'
+        self.exam_results_file = 'data/exam_results.jsonl'
+        self.legacy_exam_results_file = 'data/exam_results.json'
+        self.exams_dir = 'data/exams'
+        self.exam_stats_dir = 'data/exam_stats'
+        self.result_analysis_dir = 'data/result_analysis'
+        self.chat_archive = ChatArchive('data/chat_archive')
+        self.sequences = SequenceAllocator('data/sequences.json')
+        self._cache = {}
+        self._derived = {}
+        self._cache_lock = threading.Lock()
+        self.forum_index = ForumSearchIndex()
+        self.view_counter = ViewCounter(self._apply_view_deltas)
+        self.chat_broadcaster = ChatBroadcaster()
+        self.cache_hits = 0
+        self.cache_misses = 0
         self._init_files()
     
     def _init_files(self):
@@ -31,106 +171,374 @@ class Database:
             if not os.path.exists(file):
                 with open(file, 'w', encoding='utf-8') as f:
                     json.dump([], f)
+        self.result_journal = ResultJournal(self.exam_results_file, legacy_path=self.legacy_exam_results_file)
+        self.migrate_exam_banks()
+        self._init_exam_stats()
+        self._sort_forum_posts()
+
+    def _sort_forum_posts(self):
+        # forum_posts.json được giữ theo thứ tự (created_at, id); file cũ thì sắp xếp lại một lần
+        posts = self._load_json_shared(self.forum_posts_file)
+        keys = [forum_post_key(post) for post in posts]
+        if keys != sorted(keys):
+            self._save_json(self.forum_posts_file, sorted(_copy_json(posts), key=forum_post_key))
     
     def _load_json(self, filename):
+        """
+        Đọc file JSON qua cache trong tiến trình.
+        Cache kiểm tra chữ ký file (xem _file_signature) nên vẫn thấy thay đổi do worker khác ghi.
+        Luôn trả về bản sao để route có sửa dữ liệu cũng không làm hỏng cache.
+        """
+        return _copy_json(self._load_json_shared(filename))
+
+    def _load_json_shared(self, filename):
+        """Trả về chính đối tượng trong cache - CHỈ ĐỌC, không được sửa"""
+        signature = _file_signature(filename)
+        if signature is None:
+            with self._cache_lock:
+                self._cache.pop(filename, None)
+                self.cache_misses += 1
+            return []
+
+        with self._cache_lock:
+            entry = self._cache.get(filename)
+            if entry and entry[0] == signature:
+                self.cache_hits += 1
+                return entry[1]
+            self.cache_misses += 1
+
         try:
             with open(filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                data = json.load(f)
         except (json.JSONDecodeError, FileNotFoundError):
             return []
-    
+
+        with self._cache_lock:
+            self._cache[filename] = (signature, data)
+        return data
+
+    def _load_derived_shared(self, filename, name, build):
+        """
+        Cấu trúc dẫn xuất từ nội dung file (chỉ mục theo id, thứ tự sắp xếp...),
+        chỉ dựng lại khi file đổi - CHỈ ĐỌC.
+        """
+        records = self._load_json_shared(filename)
+        key = (filename, name)
+        with self._cache_lock:
+            entry = self._derived.get(key)
+            # Cache file trả về đối tượng mới mỗi khi file đổi -> so sánh bằng `is`
+            if entry and entry[0] is records:
+                return entry[1]
+        derived = build(records)
+        with self._cache_lock:
+            self._derived[key] = (records, derived)
+        return derived
+
+    def _load_id_map_shared(self, filename):
+        """dict id -> bản ghi của file - CHỈ ĐỌC"""
+        return self._load_derived_shared(
+            filename, 'by_id',
+            lambda records: {record.get('id'): record for record in records if isinstance(record, dict)}
+        )
+
+    def _carry_derived(self, filename, previous, updates):
+        """
+        Sau khi chính tiến trình này ghi file: chuyển cấu trúc dẫn xuất đã dựng cho dữ liệu cũ
+        (`previous`) sang dữ liệu mới bằng hàm cập nhật tăng dần thay vì dựng lại toàn bộ.
+        Hàm cập nhật phải trả về đối tượng mới, không sửa đối tượng cũ (thread khác có thể đang đọc).
+        """
+        with self._cache_lock:
+            entry = self._cache.get(filename)
+            if entry is None:
+                return
+            for name, update in updates.items():
+                key = (filename, name)
+                derived = self._derived.get(key)
+                if derived and derived[0] is previous:
+                    self._derived[key] = (entry[1], update(derived[1]))
+
     def _save_json(self, filename, data):
-        with open(filename, 'w', encoding='utf-8') as f:
+        # Ghi ra file tạm rồi os.replace để worker khác không đọc phải file đang ghi dở
+        temp_file = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, filename)
+
+        signature = _file_signature(filename)
+        with self._cache_lock:
+            if signature is None:
+                self._cache.pop(filename, None)
+            else:
+                self._cache[filename] = (signature, _copy_json(data))
+
+    def get_cache_stats(self):
+        with self._cache_lock:
+            total = self.cache_hits + self.cache_misses
+            return {
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'hit_rate': round(self.cache_hits / total, 4) if total else 0.0,
+                'cached_files': len(self._cache)
+            }
     
     def _get_exam_file(self, grade):
+        """File lopN.json cũ (cả khối trong một file) - chỉ còn dùng để migrate"""
         grade_str = str(grade)
         return f'data/lop{grade_str}.json'
 
+    def _get_exam_dir(self, grade):
+        return os.path.join(self.exams_dir, f'lop{grade}')
+
+    def _get_manifest_file(self, grade):
+        return os.path.join(self._get_exam_dir(grade), 'manifest.json')
+
+    def _get_exam_path(self, grade, exam_id):
+        # exam_id lấy từ URL nên phải chặn path traversal
+        if not isinstance(exam_id, str) or not EXAM_ID_PATTERN.match(exam_id):
+            return None
+        return os.path.join(self._get_exam_dir(grade), f'{exam_id}.json')
+
+    def migrate_exam_banks(self):
+        """
+        Tách data/lopN.json thành manifest.json + một file cho mỗi đề.
+        Chỉ chạy với khối chưa có manifest. File cũ (có trong git) chỉ là đầu vào của lần migrate
+        đầu tiên, không bao giờ bị ghi lại; data/exams/ là dữ liệu lúc chạy, không commit.
+        """
+        for grade in SUPPORTED_GRADES:
+            manifest_file = self._get_manifest_file(grade)
+            with file_lock(manifest_file):
+                if os.path.exists(manifest_file):
+                    continue
+                os.makedirs(self._get_exam_dir(grade), exist_ok=True)
+                data = self._load_json(self._get_exam_file(grade))
+                exams = data.get('exams', []) if isinstance(data, dict) else data
+                exams = [exam for exam in exams if isinstance(exam, dict)]
+                # Mã đề phải dùng được làm tên file; đề có mã lạ được giữ lại trong file cũ, không chuyển
+                skipped = [exam.get('id') for exam in exams if not self._get_exam_path(grade, exam.get('id'))]
+                if skipped:
+                    print(f"⚠️ Skipped {len(skipped)} exams with invalid ids in {self._get_exam_file(grade)}: {skipped}")
+                exams = [exam for exam in exams if self._get_exam_path(grade, exam.get('id'))]
+                self._write_exam_bank(grade, exams)
+                if exams:
+                    print(f"✓ Migrated {len(exams)} exams from {self._get_exam_file(grade)}")
+
+    def _write_exam_bank(self, grade, exams):
+        # Kiểm tra hết trước khi ghi để mã đề sai không để lại bộ đề ghi dở
+        for exam in exams:
+            if not self._get_exam_path(grade, exam.get('id')):
+                raise ValueError(f"Mã đề thi không hợp lệ: {exam.get('id')}")
+        keep = set()
+        for exam in exams:
+            exam_path = self._get_exam_path(grade, exam.get('id'))
+            self._save_json(exam_path, exam)
+            keep.add(os.path.basename(exam_path))
+        self._save_json(self._get_manifest_file(grade), [exam_summary(exam) for exam in exams])
+
+        for filename in os.listdir(self._get_exam_dir(grade)):
+            if filename.endswith('.json') and filename != 'manifest.json' and filename not in keep:
+                os.remove(os.path.join(self._get_exam_dir(grade), filename))
+
+    def get_exam_manifest(self, grade):
+        """Danh sách metadata các đề của một khối (không có câu hỏi) - file nhỏ, đọc nhanh"""
+        return self._load_json(self._get_manifest_file(grade))
+
+    def get_exam(self, grade, exam_id):
+        """Chỉ đọc đúng file của một đề thi"""
+        exam_path = self._get_exam_path(grade, exam_id)
+        if not exam_path:
+            return None
+        exam = self._load_json(exam_path)
+        if not isinstance(exam, dict) or exam.get('id') != exam_id:
+            return None
+        return normalize_exam(exam)
+
+    def get_exam_version(self, grade, exam_id):
+        """Phiên bản của đề = chữ ký file đề; None nếu đề không tồn tại"""
+        exam_path = self._get_exam_path(grade, exam_id)
+        return _file_signature(exam_path) if exam_path else None
+
     def load_exam_bank(self, grade):
-        filename = self._get_exam_file(grade)
-        if not os.path.exists(filename):
-            return {'exams': []}
-        try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    data.setdefault('exams', [])
-                    exams = data.get('exams', [])
-                if isinstance(data, list):
-                    exams = data
-                    data = {'exams': exams}
-                if not isinstance(data, dict):
-                    return {'exams': []}
-
-                normalized_exams = []
-                for exam in data.get('exams', []):
-                    if not isinstance(exam, dict):
-                        continue
-                    exam.setdefault('questions', [])
-                    exam.setdefault('allow_multiple_answers', False)
-                    for question in exam.get('questions', []):
-                        if not isinstance(question, dict):
-                            continue
-                        question.setdefault('type', 'standard')
-                        if question.get('type') == 'tl2' and isinstance(question.get('correct_answer'), str):
-                            question['correct_answer'] = [question['correct_answer']]
-                    normalized_exams.append(exam)
-                data['exams'] = normalized_exams
-                return data
-        except (json.JSONDecodeError, FileNotFoundError):
-            return {'exams': []}
+        exams = []
+        for summary in self.get_exam_manifest(grade):
+            exam = self.get_exam(grade, summary.get('id'))
+            if exam:
+                exams.append(exam)
+        return {'exams': exams}
 
     def save_exam_bank(self, grade, data):
-        filename = self._get_exam_file(grade)
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
         if not isinstance(data, dict):
             data = {'exams': data or []}
-        elif 'exams' not in data:
-            data['exams'] = []
-        self._save_json(filename, data)
+        os.makedirs(self._get_exam_dir(grade), exist_ok=True)
+        with file_lock(self._get_manifest_file(grade)):
+            self._write_exam_bank(grade, [exam for exam in data.get('exams', []) if isinstance(exam, dict)])
 
     def add_exam(self, grade, exam_data):
-        exams_data = self.load_exam_bank(grade)
-        exams = exams_data.setdefault('exams', [])
-        exams.append(exam_data)
-        self.save_exam_bank(grade, exams_data)
+        exam_path = self._get_exam_path(grade, exam_data.get('id'))
+        if not exam_path:
+            raise ValueError(f"Mã đề thi không hợp lệ: {exam_data.get('id')}")
+        os.makedirs(self._get_exam_dir(grade), exist_ok=True)
+        manifest_file = self._get_manifest_file(grade)
+        with file_lock(manifest_file):
+            self._save_json(exam_path, exam_data)
+            manifest = self._load_json(manifest_file)
+            manifest.append(exam_summary(exam_data))
+            self._save_json(manifest_file, manifest)
         return exam_data.get('id')
 
     def delete_exam(self, grade, exam_id):
-        exams_data = self.load_exam_bank(grade)
-        exams = exams_data.get('exams', [])
-        new_exams = [exam for exam in exams if exam.get('id') != exam_id]
-        if len(new_exams) == len(exams):
-            return False
-        exams_data['exams'] = new_exams
-        self.save_exam_bank(grade, exams_data)
+        manifest_file = self._get_manifest_file(grade)
+        with file_lock(manifest_file):
+            manifest = self._load_json(manifest_file)
+            remaining = [summary for summary in manifest if summary.get('id') != exam_id]
+            if len(remaining) == len(manifest):
+                return False
+            self._save_json(manifest_file, remaining)
+            exam_path = self._get_exam_path(grade, exam_id)
+            if exam_path and os.path.exists(exam_path):
+                os.remove(exam_path)
         return True
 
+    def _get_exam_stats_file(self, grade, exam_id):
+        grade = str(grade)
+        if not EXAM_ID_PATTERN.match(grade) or not isinstance(exam_id, str) or not EXAM_ID_PATTERN.match(exam_id):
+            return None
+        return os.path.join(self.exam_stats_dir, f'lop{grade}', f'{exam_id}.json')
+
+    def get_exam_stats(self, grade, exam_id):
+        """Bảng tổng hợp (lượt làm, phổ điểm, tỉ lệ đúng từng câu) - không đọc kết quả gốc"""
+        stats_file = self._get_exam_stats_file(grade, exam_id)
+        stats = self._load_json_shared(stats_file) if stats_file else None
+        return _copy_json(stats) if isinstance(stats, dict) else empty_stats(grade, exam_id)
+
+    def _save_exam_stats(self, stats):
+        stats_file = self._get_exam_stats_file(stats['grade'], stats['exam_id'])
+        if not stats_file:
+            return
+        os.makedirs(os.path.dirname(stats_file), exist_ok=True)
+        self._save_json(stats_file, stats)
+
+    def _remove_exam_stats(self, exam_id, grade):
+        stats_file = self._get_exam_stats_file(grade, exam_id)
+        if stats_file and os.path.exists(stats_file):
+            os.remove(stats_file)
+
+    # Bảng tổng hợp chỉ được sửa khi đang giữ khóa của exam_results.jsonl,
+    # nên luôn khớp với thứ tự ghi của nhật ký
+
     def delete_exam_results(self, exam_id, grade=None):
-        results = self._load_json('data/exam_results.json')
-        if not results:
-            return 0
-        filtered = [
-            result for result in results
-            if not (
-                result.get('exam_id') == exam_id and
-                (grade is None or str(result.get('grade')) == str(grade))
-            )
-        ]
-        removed = len(results) - len(filtered)
-        if removed:
-            self._save_json('data/exam_results.json', filtered)
+        # Chỉ ghi tombstone, file nhật ký được dọn lại ở luồng nền
+        with file_lock(self.exam_results_file):
+            removed = self.result_journal.delete(exam_id, grade)
+            # Xóa toàn bộ kết quả của đề -> bảng tổng hợp trừ về 0, bỏ luôn file
+            if grade is not None:
+                grades = [grade]
+            elif os.path.isdir(self.exam_stats_dir):
+                grades = [name[len('lop'):] for name in os.listdir(self.exam_stats_dir)]
+            else:
+                grades = []
+            for stats_grade in grades:
+                self._remove_exam_stats(exam_id, stats_grade)
         return removed
 
+    def add_exam_result(self, result_record):
+        # Ghi nối một dòng vào exam_results.jsonl: O(1), không ghi lại toàn bộ lịch sử
+        with file_lock(self.exam_results_file):
+            self.result_journal.append(result_record)
+            stats = self.get_exam_stats(result_record.get('grade'), result_record.get('exam_id'))
+            self._save_exam_stats(apply_result(stats, result_record))
+        return result_record.get('id')
+
+    def rewrite_exam_results(self, exam_id, grade, transform):
+        # Ghi lại toàn bộ kết quả của đề trong một lượt (dùng khi chấm lại)
+        rewritten = []
+
+        def transform_and_collect(records):
+            updated = transform(records)
+            rewritten.extend(updated)
+            return updated
+
+        with file_lock(self.exam_results_file):
+            count = self.result_journal.rewrite(exam_id, grade, transform_and_collect)
+            if count:
+                self._remove_exam_stats(exam_id, grade)
+                for stats in aggregate_results(rewritten).values():
+                    self._save_exam_stats(stats)
+        return count
+
+    def _init_exam_stats(self):
+        # Lần đầu chạy (chưa có thư mục tổng hợp) thì dựng từ kết quả đã có
+        with file_lock(self.exam_results_file):
+            if not os.path.isdir(self.exam_stats_dir):
+                rebuilt = self.rebuild_exam_stats()
+                if rebuilt:
+                    print(f"✓ Built statistics for {rebuilt} exams in {self.exam_stats_dir}")
+
+    def rebuild_exam_stats(self):
+        """Dựng lại mọi bảng tổng hợp từ nhật ký kết quả (khi file tổng hợp hỏng hoặc lệch)"""
+        with file_lock(self.exam_results_file):
+            aggregates = aggregate_results(self.iter_exam_results())
+            if os.path.isdir(self.exam_stats_dir):
+                shutil.rmtree(self.exam_stats_dir)
+            os.makedirs(self.exam_stats_dir, exist_ok=True)
+            for stats in aggregates.values():
+                self._save_exam_stats(stats)
+        return len(aggregates)
+
+    def iter_exam_results(self):
+        return self.result_journal.iter_records()
+
+    def get_exam_results(self, user_id=None, exam_id=None, grade=None):
+        return [
+            r for r in self.iter_exam_results()
+            if (user_id is None or r.get('user_id') == user_id)
+            and (exam_id is None or r.get('exam_id') == exam_id)
+            and (grade is None or str(r.get('grade')) == str(grade))
+        ]
+
+    # Phân tích AI của từng bài làm: mỗi kết quả một file nhỏ, không phải ghi lại nhật ký kết quả
+
+    def _get_result_analysis_file(self, result_id):
+        if not isinstance(result_id, str) or not EXAM_ID_PATTERN.match(result_id):
+            return None
+        return os.path.join(self.result_analysis_dir, f'{result_id}.json')
+
+    def get_result_analysis(self, result_id):
+        analysis_file = self._get_result_analysis_file(result_id)
+        record = self._load_json_shared(analysis_file) if analysis_file else None
+        return _copy_json(record) if isinstance(record, dict) else None
+
+    def save_result_analysis(self, result_id, record):
+        analysis_file = self._get_result_analysis_file(result_id)
+        if not analysis_file:
+            return
+        os.makedirs(self.result_analysis_dir, exist_ok=True)
+        self._save_json(analysis_file, record)
+
+    def claim_result_analysis(self, result_id, pending_record, stale_after):
+        """
+        Ghi trạng thái 'pending' nếu chưa có phân tích (hoặc lần tạo trước đã treo/lỗi quá stale_after giây).
+        Trả về True nếu nơi gọi được giao việc tạo phân tích - các worker khác sẽ không tạo trùng.
+        """
+        analysis_file = self._get_result_analysis_file(result_id)
+        if not analysis_file:
+            return False
+        with file_lock(analysis_file):
+            current = self.get_result_analysis(result_id)
+            if current and (current.get('status') == 'ready'
+                            or pending_record['requested_at'] - current.get('requested_at', 0) < stale_after):
+                return False
+            self.save_result_analysis(result_id, pending_record)
+        return True
+
     def get_exams_by_teacher(self, teacher_id):
         exams_by_grade = {}
         for grade in SUPPORTED_GRADES:
-            bank = self.load_exam_bank(grade)
             exams = [
-                exam for exam in bank.get('exams', [])
-                if exam.get('created_by') == teacher_id
+                self.get_exam(grade, summary.get('id'))
+                for summary in self.get_exam_manifest(grade)
+                if summary.get('created_by') == teacher_id
             ]
+            exams = [exam for exam in exams if exam]
             if exams:
                 exams_by_grade[grade] = exams
         return exams_by_grade
@@ -139,12 +547,13 @@ class Database:
         return self._load_json(self.courses_file)
     
     def get_course_by_id(self, course_id):
-        courses = self.get_all_courses()
-        return next((c for c in courses if c['id'] == course_id), None)
+        courses = self._load_json_shared(self.courses_file)
+        course = next((c for c in courses if c['id'] == course_id), None)
+        return _copy_json(course)
     
     def get_courses_by_teacher(self, teacher_id):
-        courses = self.get_all_courses()
-        return [c for c in courses if c['teacher_id'] == teacher_id]
+        courses = self._load_json_shared(self.courses_file)
+        return [_copy_json(c) for c in courses if c['teacher_id'] == teacher_id]
     
     def create_course(self, course_data, teacher_id):
         courses = self.get_all_courses()
@@ -173,6 +582,14 @@ class Database:
                 return True
         return False
     
+    def delete_course(self, course_id):
+        courses = self.get_all_courses()
+        remaining = [c for c in courses if c['id'] != course_id]
+        if len(remaining) == len(courses):
+            return False
+        self._save_json(self.courses_file, remaining)
+        return True
+    
     def get_all_exercises(self):
         return self._load_json(self.exercises_file)
     
@@ -192,13 +609,17 @@ class Database:
         self._save_json(self.submissions_file, submissions)
         return submission['id']
     
+    def get_all_progress(self):
+        return self._load_json(self.progress_file)
+    
     def get_student_progress(self, user_id):
-        progress_list = self._load_json(self.progress_file)
-        return [p for p in progress_list if p['user_id'] == user_id]
+        progress_list = self._load_json_shared(self.progress_file)
+        return [_copy_json(p) for p in progress_list if p['user_id'] == user_id]
     
     def get_course_progress(self, user_id, course_id):
-        progress_list = self._load_json(self.progress_file)
-        return next((p for p in progress_list if p['user_id'] == user_id and p['course_id'] == course_id), None)
+        progress_list = self._load_json_shared(self.progress_file)
+        progress = next((p for p in progress_list if p['user_id'] == user_id and p['course_id'] == course_id), None)
+        return _copy_json(progress)
     
     def update_progress(self, user_id, course_id, lesson_id, completed, **kwargs):
         progress_list = self._load_json(self.progress_file)
@@ -263,22 +684,51 @@ class Database:
         submissions = self.get_all_submissions()
         return [s for s in submissions if s.get('course_id') == course_id]
     
+    def _forum_order(self):
+        return self._load_derived_shared(self.forum_posts_file, 'forum_order', _build_forum_order)
+
     def get_all_forum_posts(self):
-        posts = self._load_json(self.forum_posts_file)
-        posts.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-        return posts
+        # File đã được giữ theo thứ tự thời gian khi thêm bài -> chỉ cần đảo ngược
+        posts = [_copy_json(post) for post in reversed(self._forum_order()['posts'])]
+        return self.view_counter.merge_into(posts)
+
+    def get_forum_posts_page(self, before=None, limit=20, author_id=None):
+        """
+        Một trang bài viết mới nhất có khóa (created_at, id) nhỏ hơn con trỏ `before`.
+        Trả về (danh sách bài, con trỏ trang sau hoặc None nếu đã hết).
+        """
+        order = self._forum_order()
+        if author_id is None:
+            keys, posts = order['keys'], order['posts']
+        else:
+            keys, posts = order['by_author'].get(author_id, ([], []))
+        end = bisect.bisect_left(keys, tuple(before)) if before else len(keys)
+        start = max(0, end - limit)
+        # Dữ liệu cũ có thể trùng (created_at, id): không cắt trang giữa các bài cùng khóa,
+        # nếu không con trỏ sẽ làm mất hoặc lặp bài ở trang sau
+        while 0 < start < end and keys[start - 1] == keys[start]:
+            start -= 1
+        page = [_copy_json(post) for post in reversed(posts[start:end])]
+        return self.view_counter.merge_into(page), (keys[start] if start > 0 else None)
     
     def get_forum_post_by_id(self, post_id):
-        posts = self._load_json(self.forum_posts_file)
-        return next((p for p in posts if p['id'] == post_id), None)
+        post = _copy_json(self._load_id_map_shared(self.forum_posts_file).get(post_id))
+        if post:
+            self.view_counter.merge_into([post])
+        return post
     
     def get_forum_posts_by_user(self, user_id):
-        posts = self.get_all_forum_posts()
-        return [p for p in posts if p['author_id'] == user_id]
+        _, posts = self._forum_order()['by_author'].get(user_id, ([], []))
+        return self.view_counter.merge_into([_copy_json(post) for post in reversed(posts)])
     
     def create_forum_post(self, post_data):
+        with file_lock(self.forum_posts_file):
+            return self._create_forum_post(post_data)
+
+    def _create_forum_post(self, post_data):
         posts = self._load_json(self.forum_posts_file)
-        post_id = f"post_{len(posts) + 1:04d}"
+        seq = self.sequences.next('forum_posts', seed=lambda: max(map(id_seq, posts), default=0))
+        post_id = f"post_{seq:04d}"
         
         new_post = {
             'id': post_id,
@@ -295,11 +745,21 @@ class Database:
             'comments_count': 0
         }
         
-        posts.append(new_post)
+        # Chèn đúng vị trí theo (created_at, id) - thường là cuối danh sách
+        new_key = forum_post_key(new_post)
+        position = len(posts)
+        while position > 0 and forum_post_key(posts[position - 1]) > new_key:
+            position -= 1
+        posts.insert(position, new_post)
         self._save_json(self.forum_posts_file, posts)
+        self._bump_forum_version(lambda index: index.index_post(new_post))
         return post_id
     
     def update_forum_post(self, post_id, post_data):
+        with file_lock(self.forum_posts_file):
+            return self._update_forum_post(post_id, post_data)
+
+    def _update_forum_post(self, post_id, post_data):
         posts = self._load_json(self.forum_posts_file)
         
         for i, post in enumerate(posts):
@@ -315,51 +775,107 @@ class Database:
                 
                 posts[i]['updated_at'] = datetime.now().isoformat()
                 self._save_json(self.forum_posts_file, posts)
+                updated_post = posts[i]
+                self._bump_forum_version(lambda index: index.index_post(updated_post))
                 return True
         
         return False
     
     def delete_forum_post(self, post_id):
-        posts = self._load_json(self.forum_posts_file)
-        posts = [p for p in posts if p['id'] != post_id]
-        self._save_json(self.forum_posts_file, posts)
+        with file_lock(self.forum_posts_file):
+            posts = self._load_json(self.forum_posts_file)
+            posts = [p for p in posts if p['id'] != post_id]
+            self._save_json(self.forum_posts_file, posts)
         
-        comments = self._load_json(self.forum_comments_file)
-        comments = [c for c in comments if c['post_id'] != post_id]
-        self._save_json(self.forum_comments_file, comments)
+        with file_lock(self.forum_comments_file):
+            previous = self._load_json_shared(self.forum_comments_file)
+            self._comments_by_post()
+            comments = [_copy_json(c) for c in previous if c['post_id'] != post_id]
+            self._save_json(self.forum_comments_file, comments)
+            self._carry_derived(
+                self.forum_comments_file, previous,
+                {'by_post': lambda by_post: {k: v for k, v in by_post.items() if k != post_id}}
+            )
+        self._bump_forum_version(lambda index: index.remove_post(post_id))
         
         return True
     
     def increment_post_views(self, post_id):
-        posts = self._load_json(self.forum_posts_file)
-        
-        for i, post in enumerate(posts):
-            if post['id'] == post_id:
-                posts[i]['views'] = posts[i].get('views', 0) + 1
+        # Chỉ cộng trong bộ nhớ, ghi xuống file theo lô (xem ViewCounter)
+        if post_id not in self._load_id_map_shared(self.forum_posts_file):
+            return False
+        self.view_counter.increment(post_id)
+        return True
+
+    def _apply_view_deltas(self, deltas):
+        """Cộng dồn lượt xem của một lô vào file; đọc-sửa-ghi trong file_lock nên các worker không ghi đè nhau"""
+        with file_lock(self.forum_posts_file):
+            posts = self._load_json(self.forum_posts_file)
+            changed = False
+            for post in posts:
+                delta = deltas.get(post['id'])
+                if delta:
+                    post['views'] = post.get('views', 0) + delta
+                    changed = True
+            if changed:
                 self._save_json(self.forum_posts_file, posts)
-                return True
-        
-        return False
     
+    def _read_forum_version(self):
+        data = self._load_json_shared(self.forum_version_file)
+        return data.get('version', 0) if isinstance(data, dict) else 0
+
+    def _bump_forum_version(self, update):
+        """
+        Tăng phiên bản nội dung diễn đàn (bài viết / bình luận, không tính lượt xem)
+        và cập nhật tăng dần chỉ mục tìm kiếm của tiến trình này.
+        Worker khác thấy phiên bản lệch sẽ tự dựng lại chỉ mục khi tìm kiếm.
+        """
+        with file_lock(self.forum_version_file):
+            version = self._read_forum_version() + 1
+            self._save_json(self.forum_version_file, {'version': version})
+            self.forum_index.apply(version, update)
+
+    def _ensure_forum_index(self):
+        # Đọc phiên bản trước rồi mới đọc dữ liệu: nếu có ghi xen giữa thì lần sau sẽ dựng lại
+        version = self._read_forum_version()
+        if self.forum_index.version != version:
+            self.forum_index.rebuild(
+                self._load_json_shared(self.forum_posts_file),
+                self._load_json_shared(self.forum_comments_file),
+                version
+            )
+        return self.forum_index
+
     def search_forum_posts(self, keyword):
-        posts = self.get_all_forum_posts()
-        keyword_lower = keyword.lower()
-        
-        return [
-            p for p in posts 
-            if keyword_lower in p['title'].lower() 
-            or keyword_lower in p['content'].lower()
-        ]
+        """Tìm bài viết theo tiêu đề, nội dung, tag và bình luận (không dấu, theo tiền tố, BM25)"""
+        matches = self._ensure_forum_index().search(keyword)
+        posts_by_id = self._load_id_map_shared(self.forum_posts_file)
+        posts = [_copy_json(posts_by_id[post_id]) for post_id, _ in matches if post_id in posts_by_id]
+        return self.view_counter.merge_into(posts)
     
+    def _comments_by_post(self):
+        return self._load_derived_shared(self.forum_comments_file, 'by_post', _build_comments_by_post)
+
     def get_comments_by_post(self, post_id):
-        comments = self._load_json(self.forum_comments_file)
-        post_comments = [c for c in comments if c['post_id'] == post_id]
-        post_comments.sort(key=lambda x: x.get('created_at', ''))
-        return post_comments
+        _, post_comments = self._comments_by_post().get(post_id, ([], []))
+        return [_copy_json(c) for c in post_comments]
+    
+    def get_comment_by_id(self, comment_id):
+        return _copy_json(self._load_id_map_shared(self.forum_comments_file).get(comment_id))
     
     def add_comment(self, comment_data):
-        comments = self._load_json(self.forum_comments_file)
-        comment_id = f"comment_{len(comments) + 1:04d}"
+        with file_lock(self.forum_comments_file):
+            comment_id, new_comment = self._add_comment(comment_data)
+        self._bump_forum_version(lambda index: index.index_comment(new_comment))
+        self._adjust_comments_count(new_comment['post_id'], 1)
+        return comment_id
+
+    def _add_comment(self, comment_data):
+        previous = self._load_json_shared(self.forum_comments_file)
+        self._comments_by_post()
+        comments = _copy_json(previous)
+        seq = self.sequences.next('forum_comments', seed=lambda: max(map(id_seq, comments), default=0))
+        comment_id = f"comment_{seq:04d}"
         
         new_comment = {
             'id': comment_id,
@@ -368,89 +884,163 @@ class Database:
             'author_name': comment_data['author_name'],
             'author_role': comment_data.get('author_role', 'student'),
             'content': comment_data['content'],
+            'parent_id': comment_data.get('parent_id'),
             'created_at': datetime.now().isoformat(),
             'attachments': comment_data.get('attachments', [])
         }
         
         comments.append(new_comment)
         self._save_json(self.forum_comments_file, comments)
-        
-        self._update_comments_count(comment_data['post_id'])
-        
-        return comment_id
+
+        def insert(by_post):
+            keys, post_comments = by_post.get(new_comment['post_id'], ([], []))
+            # Bình luận mới thường có thời điểm lớn nhất -> chèn cuối
+            position = bisect.bisect_right(keys, forum_comment_key(new_comment))
+            updated = dict(by_post)
+            updated[new_comment['post_id']] = (
+                keys[:position] + [forum_comment_key(new_comment)] + keys[position:],
+                post_comments[:position] + [new_comment] + post_comments[position:]
+            )
+            return updated
+
+        self._carry_derived(self.forum_comments_file, previous, {'by_post': insert})
+        return comment_id, new_comment
     
     def delete_comment(self, comment_id):
-        comments = self._load_json(self.forum_comments_file)
-        
-        comment = next((c for c in comments if c['id'] == comment_id), None)
-        if not comment:
-            return False
-        
-        post_id = comment['post_id']
-        
-        comments = [c for c in comments if c['id'] != comment_id]
-        self._save_json(self.forum_comments_file, comments)
-        
-        self._update_comments_count(post_id)
+        with file_lock(self.forum_comments_file):
+            comment = self.get_comment_by_id(comment_id)
+            if not comment:
+                return False
+            
+            post_id = comment['post_id']
+            previous = self._load_json_shared(self.forum_comments_file)
+            self._comments_by_post()
+            comments = [_copy_json(c) for c in previous if c['id'] != comment_id]
+            self._save_json(self.forum_comments_file, comments)
+
+            def remove(by_post):
+                keys, post_comments = by_post.get(post_id, ([], []))
+                position = next((i for i, c in enumerate(post_comments) if c['id'] == comment_id), None)
+                if position is None:
+                    return by_post
+                updated = dict(by_post)
+                updated[post_id] = (keys[:position] + keys[position + 1:],
+                                    post_comments[:position] + post_comments[position + 1:])
+                return updated
+
+            self._carry_derived(self.forum_comments_file, previous, {'by_post': remove})
+
+        self._bump_forum_version(lambda index: index.remove_comment(comment))
+        self._adjust_comments_count(post_id, -1)
         
         return True
     
-    def _update_comments_count(self, post_id):
-        posts = self._load_json(self.forum_posts_file)
-        comments = self.get_comments_by_post(post_id)
-        
-        for i, post in enumerate(posts):
-            if post['id'] == post_id:
-                posts[i]['comments_count'] = len(comments)
-                self._save_json(self.forum_posts_file, posts)
-                break
+    def _adjust_comments_count(self, post_id, delta):
+        """Cộng/trừ trực tiếp số bình luận của bài, không đếm lại toàn bộ bình luận"""
+        if post_id not in self._load_id_map_shared(self.forum_posts_file):
+            return
+        with file_lock(self.forum_posts_file):
+            posts = self._load_json(self.forum_posts_file)
+            for post in posts:
+                if post['id'] == post_id:
+                    post['comments_count'] = max(post.get('comments_count', 0) + delta, 0)
+                    self._save_json(self.forum_posts_file, posts)
+                    break
     
+    def _chat_seqs(self):
+        """Số thứ tự của các tin đang sống để tìm nhị phân; None nếu dữ liệu cũ không tăng dần"""
+        def build(messages):
+            seqs = [id_seq(m) for m in messages]
+            return seqs if _is_sorted(seqs) else None
+        return self._load_derived_shared(self.chat_messages_file, 'seqs', build)
+
     def get_all_chat_messages(self):
-        messages = self._load_json(self.chat_messages_file)
-        messages.sort(key=lambda x: x.get('created_at', ''))
-        return messages
+        """Các tin còn trong phòng chat (tối đa khoảng CHAT_LIVE_LIMIT tin), đã theo thứ tự thời gian"""
+        return self._load_json(self.chat_messages_file)
+
+    def get_recent_chat_messages(self, limit):
+        messages = self._load_json_shared(self.chat_messages_file)
+        recent = [_copy_json(m) for m in messages[-limit:]] if limit > 0 else []
+        if 0 < len(recent) < limit:
+            recent = _copy_json(self.chat_archive.messages_before(id_seq(recent[0]), limit - len(recent))) + recent
+        return recent
+
+    def get_chat_messages_before(self, before_id, limit):
+        """Tối đa `limit` tin cũ hơn tin `before_id` (theo thứ tự thời gian), đọc tiếp sang lưu trữ khi cần"""
+        before_seq = id_seq(before_id)
+        live = self._load_json_shared(self.chat_messages_file)
+        seqs = self._chat_seqs()
+        if seqs is not None:
+            end = bisect.bisect_left(seqs, before_seq)
+            older = [_copy_json(m) for m in live[max(0, end - limit):end]]
+        else:
+            older = [_copy_json(m) for m in live if id_seq(m) < before_seq][-limit:]
+        if len(older) < limit:
+            older = _copy_json(self.chat_archive.messages_before(before_seq, limit - len(older))) + older
+        return older
+
+    def iter_chat_messages(self):
+        """Toàn bộ lịch sử chat: các đoạn lưu trữ rồi tới các tin đang sống"""
+        yield from self.chat_archive.iter_messages()
+        yield from self.get_all_chat_messages()
 
     def get_chat_message_by_id(self, message_id):
-        messages = self._load_json(self.chat_messages_file)
-        return next((m for m in messages if m['id'] == message_id), None)
+        messages = self._load_json_shared(self.chat_messages_file)
+        message = next((m for m in reversed(messages) if m['id'] == message_id), None)
+        if message is None:
+            message = self.chat_archive.get(message_id)
+        return _copy_json(message)
 
     def add_chat_message(self, message_data):
-        messages = self._load_json(self.chat_messages_file)
-        message_id = f"msg_{len(messages) + 1:06d}"
-        
-        new_message = {
-            'id': message_id,
-            'content': message_data['content'],
-            'author_id': message_data['author_id'],
-            'author_name': message_data['author_name'],
-            'author_role': message_data.get('author_role', 'student'),
-            'created_at': datetime.now().isoformat(),
-            'reply_to': message_data.get('reply_to')
-        }
-        
-        messages.append(new_message)
-        self._save_json(self.chat_messages_file, messages)
+        with file_lock(self.chat_messages_file):
+            messages = self._load_json(self.chat_messages_file)
+            seq = self.sequences.next('chat_messages', seed=lambda: max(
+                max(map(id_seq, messages), default=0), self.chat_archive.last_seq()
+            ))
+            message_id = f"msg_{seq:06d}"
+            
+            new_message = {
+                'id': message_id,
+                'content': message_data['content'],
+                'author_id': message_data['author_id'],
+                'author_name': message_data['author_name'],
+                'author_role': message_data.get('author_role', 'student'),
+                'created_at': datetime.now().isoformat(),
+                'reply_to': message_data.get('reply_to')
+            }
+            
+            messages.append(new_message)
+            if len(messages) > CHAT_LIVE_LIMIT + CHAT_ARCHIVE_BATCH:
+                self.chat_archive.append(messages[:-CHAT_LIVE_LIMIT])
+                messages = messages[-CHAT_LIVE_LIMIT:]
+            self._save_json(self.chat_messages_file, messages)
+        self.chat_broadcaster.publish('message', new_message)
         return message_id
 
     def delete_chat_message(self, message_id):
-        messages = self._load_json(self.chat_messages_file)
-        messages = [m for m in messages if m['id'] != message_id]
-        self._save_json(self.chat_messages_file, messages)
+        with file_lock(self.chat_messages_file):
+            messages = self._load_json(self.chat_messages_file)
+            remaining = [m for m in messages if m['id'] != message_id]
+            if len(remaining) != len(messages):
+                self._save_json(self.chat_messages_file, remaining)
+            else:
+                self.chat_archive.delete(message_id)
+        self.chat_broadcaster.publish('delete', {'id': message_id})
         return True
 
     def get_chat_messages_after(self, last_id):
-        messages = self.get_all_chat_messages()
-        
+        """
+        Các tin có số thứ tự lớn hơn last_id - tìm nhị phân, vẫn đúng khi tin last_id đã bị xóa.
+        last_id cũ hơn cả phòng chat thì trả về toàn bộ các tin đang sống.
+        """
         if not last_id:
-            return messages[-50:] if len(messages) > 50 else messages
+            return self.get_recent_chat_messages(50)
         
-        last_index = -1
-        for i, msg in enumerate(messages):
-            if msg['id'] == last_id:
-                last_index = i
-                break
-        
-        if last_index == -1:
-            return []
-        
-        return messages[last_index + 1:]
\ No newline at end of file
+        messages = self._load_json_shared(self.chat_messages_file)
+        seqs = self._chat_seqs()
+        if seqs is not None:
+            start = bisect.bisect_right(seqs, id_seq(last_id))
+        else:
+            # Dữ liệu cũ có id cấp theo len + 1 (có thể trùng, không tăng dần) -> dò theo id
+            start = next((i + 1 for i in range(len(messages) - 1, -1, -1) if messages[i]['id'] == last_id), len(messages))
+        return [_copy_json(m) for m in messages[start:]]
\ No newline at end of file
@@ -0,0 +1,148 @@
+import numpy as np
+
+from utils.regrade import encode_text_column
+
+CHOICE_LETTERS = ('A', 'B', 'C', 'D')
+# Phổ điểm theo thang 10: [0,1), [1,2), ..., [9,10]
+SCORE_BINS = np.arange(0, 11)
+
+
+def build_result_matrix(exam, results):
+    """
+    Dựng ma trận học sinh × câu hỏi từ 'details' của các bài nộp.
+    Trả về dict gồm: question_ids, scores (điểm từng câu), correct (bool),
+    answers (list cột câu trả lời) và total (điểm thang 10 của từng bài).
+    Bài nộp định dạng cũ không có 'details' bị bỏ qua.
+    """
+    question_ids = [str(q.get('id')) for q in exam.get('questions', [])]
+    rows = []
+    totals = []
+    for result in results:
+        details = result.get('details')
+        if not isinstance(details, list):
+            continue
+        rows.append({str(d.get('question_id')): d for d in details if isinstance(d, dict)})
+        totals.append(float(result.get('score') or 0))
+
+    empty = {}
+    columns = [[row.get(q_id, empty) for row in rows] for q_id in question_ids]
+    n, q = len(rows), len(question_ids)
+    scores = np.zeros((n, q), dtype=np.float64)
+    correct = np.zeros((n, q), dtype=bool)
+    for j, column in enumerate(columns):
+        scores[:, j] = [d.get('score') or 0.0 for d in column]
+        correct[:, j] = [bool(d.get('is_correct')) for d in column]
+
+    return {
+        'question_ids': question_ids,
+        'scores': scores,
+        'correct': correct,
+        'answers': [[d.get('user_answer') for d in column] for column in columns],
+        'total': np.array(totals, dtype=np.float64)
+    }
+
+
+def point_biserial(scores):
+    """
+    Độ phân biệt của từng câu: hệ số tương quan giữa điểm câu đó và tổng điểm bài
+    (với câu đúng/sai chính là hệ số point-biserial). Câu không phân hóa trả về NaN.
+    """
+    n = scores.shape[0]
+    if n < 2:
+        return np.full(scores.shape[1], np.nan)
+    totals = scores.sum(axis=1)
+    item_dev = scores - scores.mean(axis=0)
+    total_dev = totals - totals.mean()
+    covariance = item_dev.T @ total_dev / n
+    denominator = scores.std(axis=0) * totals.std()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, covariance / denominator, np.nan)
+
+
+def choice_counts(column):
+    """Đếm số lượt chọn A-D của một câu (câu nhiều đáp án tính từng lựa chọn) và số bài bỏ trống"""
+    letter_index = {letter: i for i, letter in enumerate(CHOICE_LETTERS)}
+    text_answers = []
+    counts = np.zeros(len(CHOICE_LETTERS), dtype=np.int64)
+    blank = 0
+    for answer in column:
+        if answer is None or answer == '' or answer == []:
+            blank += 1
+        elif isinstance(answer, list):
+            for element in set(str(a).strip().upper() for a in answer):
+                if element in letter_index:
+                    counts[letter_index[element]] += 1
+        else:
+            text_answers.append(answer)
+
+    if text_answers:
+        codes, vocab = encode_text_column('', text_answers)
+        per_code = np.bincount(codes, minlength=len(vocab))
+        for code, value in enumerate(vocab):
+            if value in letter_index:
+                counts[letter_index[value]] += per_code[code]
+    return counts, blank
+
+
+def score_histogram(total):
+    counts, _ = np.histogram(total, bins=SCORE_BINS)
+    labels = [f'{low}-{low + 1}' for low in SCORE_BINS[:-1]]
+    return [{'label': label, 'count': int(count)} for label, count in zip(labels, counts)]
+
+
+def _round(value, digits=2):
+    return None if value is None or np.isnan(value) else round(float(value), digits)
+
+
+def analyze_exam(exam, results):
+    """
+    Phân tích câu hỏi của một đề: độ khó (p-value), độ phân biệt (point-biserial),
+    tần suất chọn A-D và phổ điểm.
+    """
+    matrix = build_result_matrix(exam, results)
+    scores, correct, total = matrix['scores'], matrix['correct'], matrix['total']
+    attempts = scores.shape[0]
+
+    p_values = scores.mean(axis=0) if attempts else np.full(scores.shape[1], np.nan)
+    discrimination = point_biserial(scores)
+
+    questions = []
+    for j, question in enumerate(exam.get('questions', [])):
+        q_type = question.get('type', 'tl1')
+        correct_answer = question.get('correct_answer')
+        if not isinstance(correct_answer, list):
+            correct_answer = [] if correct_answer is None else [correct_answer]
+        item = {
+            'id': matrix['question_ids'][j],
+            'number': question.get('number', j + 1),
+            'question': question.get('question', ''),
+            'type': q_type,
+            'correct_answers': [str(a).strip().upper() for a in correct_answer],
+            'correct_count': int(correct[:, j].sum()),
+            'p_value': _round(p_values[j]),
+            'discrimination': _round(discrimination[j]),
+            'choices': None,
+            'blank': None
+        }
+        # Câu TL2 trả lời dạng "1_D"/"2_S" nên không có phương án nhiễu A-D
+        if q_type != 'tl2':
+            counts, blank = choice_counts(matrix['answers'][j])
+            item['choices'] = [
+                {
+                    'letter': letter,
+                    'count': count,
+                    'percent': round(count / attempts * 100, 1) if attempts else 0.0
+                }
+                for letter, count in zip(CHOICE_LETTERS, counts.tolist())
+            ]
+            item['blank'] = blank
+        questions.append(item)
+
+    return {
+        'attempts': attempts,
+        'mean_score': _round(total.mean()) if attempts else None,
+        'median_score': _round(np.median(total)) if attempts else None,
+        'std_score': _round(total.std()) if attempts else None,
+        'histogram': score_histogram(total),
+        'questions': questions
+    }
@@ -58,17 +58,41 @@ def parse_docx_exam(file_path: str, allow_multiple_answers: bool = False) -> Lis
         'explanation': str
     }
     """
+    questions = [block['question'] for block in _parse_document(_open_document(file_path), allow_multiple_answers, strict=True)]
+
+    if not questions:
+        raise ExamParseError('Không tìm thấy câu hỏi trắc nghiệm hợp lệ trong file.')
+
+    return questions
+
+
+def parse_docx_exam_partial(file_path: str, allow_multiple_answers: bool = True) -> List[Dict]:
+    """
+    Như parse_docx_exam nhưng không dừng ở câu lỗi: trả về danh sách khối theo thứ tự trong đề,
+    mỗi khối là {'question': {...}} (câu đọc được trọn vẹn) hoặc {'text': '...'} (nội dung câu
+    không phân loại được - câu tự luận, thiếu đáp án... - để chuyển cho AI).
+    Phần mở đầu trước câu đầu tiên (tiêu đề, hướng dẫn) bị bỏ qua.
+    """
+    return _parse_document(_open_document(file_path), allow_multiple_answers, strict=False)
+
+
+def _open_document(file_path: str):
     if not os.path.exists(file_path):
         raise ExamParseError('File đề thi không tồn tại.')
 
     try:
-        document = Document(file_path)
+        return Document(file_path)
     except Exception as exc:
         raise ExamParseError(f'Không thể mở file Word: {exc}') from exc
 
+
+def _parse_document(document, allow_multiple_answers: bool, strict: bool) -> List[Dict]:
+    blocks: List[Dict] = []
     questions: List[Dict] = []
     current_question: Dict = {}
     current_option_letter: Optional[str] = None
+    current_lines: List[str] = []
+    current_broken = False
 
     def finalize_current():
         nonlocal current_question, current_option_letter
@@ -105,8 +129,105 @@ def parse_docx_exam(file_path: str, allow_multiple_answers: bool = False) -> Lis
                 answers = answers[0]
             current_question['correct_answer'] = answers
         questions.append(current_question.copy())
+        blocks.append({'question': questions[-1]})
         current_option_letter = None
 
+    def close_current():
+        nonlocal current_question, current_lines, current_broken
+        try:
+            if not current_broken:
+                finalize_current()
+        except ExamParseError:
+            if strict:
+                raise
+            current_broken = True
+        if current_broken and current_lines:
+            blocks.append({'text': '\n'.join(current_lines)})
+        current_question = {}
+        current_lines = []
+        current_broken = False
+
+    def parse_line(normalized, question_match, paragraph):
+        nonlocal current_question, current_option_letter
+        answer_line = ANSWER_PATTERN.match(normalized)
+        if answer_line and current_question:
+            answer_letter = answer_line.group(1).upper()
+            if answer_letter not in current_question.get('options', {}):
+                raise ExamParseError(f"Đáp án '{answer_letter}' không khớp với lựa chọn của câu {current_question.get('number', len(questions) + 1)}.")
+            current_answer = current_question.get('correct_answer')
+            if allow_multiple_answers:
+                answers_list = list(current_answer or [])
+                if answer_letter not in answers_list:
+                    answers_list.append(answer_letter)
+                current_question['correct_answer'] = answers_list
+            else:
+                if current_answer and current_answer != answer_letter:
+                    raise ExamParseError(f"Câu {current_question.get('number', len(questions) + 1)} bị đánh dấu nhiều đáp án đúng.")
+                current_question['correct_answer'] = answer_letter
+            current_option_letter = None
+            return
+
+        explanation_match = EXPLANATION_PATTERN.match(normalized)
+        if explanation_match and current_question:
+            current_question['explanation'] = explanation_match.group(2).strip()
+            current_option_letter = None
+            return
+
+        if question_match:
+            # Câu trước đã được close_current() chốt lại
+            number = int(question_match.group(1))
+            content = question_match.group(2).strip()
+            question_type = 'tl1'
+            if '[tl2]' in content.lower():
+                question_type = 'tl2'
+                content = re.sub(r'\[tl2\]\s*', '', content, flags=re.IGNORECASE).strip()
+            current_question = {
+                'number': number,
+                'question': content,
+                'options': {},
+                'correct_answer': None,
+                'explanation': '',
+                'type': question_type
+            }
+            return
+
+        option_match = OPTION_PATTERN.match(normalized)
+        if option_match and current_question:
+            letter = option_match.group(1).upper()
+            option_text = option_match.group(2).strip()
+            option_text_lower = option_text.lower()
+            is_marked_correct = any(marker in option_text_lower for marker in CORRECT_MARKERS_LOWER)
+
+            if _paragraph_has_underlined_letter(paragraph, letter):
+                is_marked_correct = True
+
+            cleaned_text = _strip_correct_markers(option_text)
+            current_question.setdefault('options', {})[letter] = cleaned_text
+            current_option_letter = letter
+
+            if is_marked_correct:
+                existing_answer = current_question.get('correct_answer')
+                if allow_multiple_answers:
+                    answers_list = list(existing_answer or [])
+                    if letter not in answers_list:
+                        answers_list.append(letter)
+                    current_question['correct_answer'] = answers_list
+                else:
+                    if existing_answer and existing_answer != letter:
+                        raise ExamParseError(
+                            f"Câu {current_question.get('number', len(questions) + 1)} bị đánh dấu nhiều đáp án đúng."
+                        )
+                    current_question['correct_answer'] = letter
+            return
+
+        if current_question:
+            if current_option_letter and current_option_letter in current_question.get('options', {}):
+                current_question['options'][current_option_letter] = (
+                    f"{current_question['options'][current_option_letter]} {normalized}"
+                ).strip()
+            else:
+                current_question['question'] = f"{current_question['question']} {normalized}".strip()
+
     for paragraph in document.paragraphs:
         raw_text = (paragraph.text or '').replace('\xa0', ' ')
         if not raw_text.strip():
@@ -121,90 +242,21 @@ def parse_docx_exam(file_path: str, allow_multiple_answers: bool = False) -> Lis
             if not normalized:
                 continue
 
-            answer_line = ANSWER_PATTERN.match(normalized)
-            if answer_line and current_question:
-                answer_letter = answer_line.group(1).upper()
-                if answer_letter not in current_question.get('options', {}):
-                    raise ExamParseError(f"Đáp án '{answer_letter}' không khớp với lựa chọn của câu {current_question.get('number', len(questions) + 1)}.")
-                current_answer = current_question.get('correct_answer')
-                if allow_multiple_answers:
-                    answers_list = list(current_answer or [])
-                    if answer_letter not in answers_list:
-                        answers_list.append(answer_letter)
-                    current_question['correct_answer'] = answers_list
-                else:
-                    if current_answer and current_answer != answer_letter:
-                        raise ExamParseError(f"Câu {current_question.get('number', len(questions) + 1)} bị đánh dấu nhiều đáp án đúng.")
-                    current_question['correct_answer'] = answer_letter
-                current_option_letter = None
-                continue
+            question_start = QUESTION_PATTERN.match(normalized)
+            if question_start:
+                close_current()
+            if current_question or question_start:
+                current_lines.append(normalized)
+            if current_broken:
+                continue  # Câu đã lỗi: chỉ gom nội dung lại cho AI
 
-            explanation_match = EXPLANATION_PATTERN.match(normalized)
-            if explanation_match and current_question:
-                current_question['explanation'] = explanation_match.group(2).strip()
-                current_option_letter = None
-                continue
+            try:
+                parse_line(normalized, question_start, paragraph)
+            except ExamParseError:
+                if strict:
+                    raise
+                current_broken = True
 
-            question_match = QUESTION_PATTERN.match(normalized)
-            if question_match:
-                finalize_current()
-                current_option_letter = None
-                number = int(question_match.group(1))
-                content = question_match.group(2).strip()
-                question_type = 'tl1'
-                if '[tl2]' in content.lower():
-                    question_type = 'tl2'
-                    content = re.sub(r'\[tl2\]\s*', '', content, flags=re.IGNORECASE).strip()
-                current_question = {
-                    'number': number,
-                    'question': content,
-                    'options': {},
-                    'correct_answer': None,
-                    'explanation': '',
-                    'type': question_type
-                }
-                continue
-
-            option_match = OPTION_PATTERN.match(normalized)
-            if option_match and current_question:
-                letter = option_match.group(1).upper()
-                option_text = option_match.group(2).strip()
-                option_text_lower = option_text.lower()
-                is_marked_correct = any(marker in option_text_lower for marker in CORRECT_MARKERS_LOWER)
-
-                if _paragraph_has_underlined_letter(paragraph, letter):
-                    is_marked_correct = True
-
-                cleaned_text = _strip_correct_markers(option_text)
-                current_question.setdefault('options', {})[letter] = cleaned_text
-                current_option_letter = letter
-
-                if is_marked_correct:
-                    existing_answer = current_question.get('correct_answer')
-                    if allow_multiple_answers:
-                        answers_list = list(existing_answer or [])
-                        if letter not in answers_list:
-                            answers_list.append(letter)
-                        current_question['correct_answer'] = answers_list
-                    else:
-                        if existing_answer and existing_answer != letter:
-                            raise ExamParseError(
-                                f"Câu {current_question.get('number', len(questions) + 1)} bị đánh dấu nhiều đáp án đúng."
-                            )
-                        current_question['correct_answer'] = letter
-                continue
-
-            if current_question:
-                if current_option_letter and current_option_letter in current_question.get('options', {}):
-                    current_question['options'][current_option_letter] = (
-                        f"{current_question['options'][current_option_letter]} {normalized}"
-                    ).strip()
-                else:
-                    current_question['question'] = f"{current_question['question']} {normalized}".strip()
+    close_current()
+    return blocks
 
-    finalize_current()
-
-    if not questions:
-        raise ExamParseError('Không tìm thấy câu hỏi trắc nghiệm hợp lệ trong file.')
-
-    return questions
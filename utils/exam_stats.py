@@ -0,0 +1,85 @@
+from datetime import datetime
+
+# Phổ điểm 10 cột: [0,1), [1,2), ..., [9,10]
+HISTOGRAM_BINS = 10
+
+
+def empty_stats(grade, exam_id):
+    """
+    Bảng tổng hợp của một đề. Điểm lưu theo đơn vị 0.1 (số nguyên)
+    để cộng/trừ nhiều lần không bị sai số float.
+    questions: question_id -> [số bài đúng, số bài có câu này]
+    """
+    return {
+        'grade': str(grade),
+        'exam_id': exam_id,
+        'attempts': 0,
+        'score_tenths': 0,
+        'histogram': [0] * HISTOGRAM_BINS,
+        'questions': {},
+        'updated_at': None
+    }
+
+
+def apply_result(stats, result, sign=1):
+    """Cộng (sign=1) hoặc trừ (sign=-1) một bài nộp vào bảng tổng hợp - O(số câu)"""
+    tenths = int(round(float(result.get('score') or 0) * 10))
+    stats['attempts'] += sign
+    stats['score_tenths'] += sign * tenths
+    stats['histogram'][min(max(tenths // 10, 0), HISTOGRAM_BINS - 1)] += sign
+
+    questions = stats['questions']
+    for detail in result.get('details') or []:
+        if not isinstance(detail, dict):
+            continue
+        counts = questions.setdefault(str(detail.get('question_id')), [0, 0])
+        if detail.get('is_correct'):
+            counts[0] += sign
+        counts[1] += sign
+    stats['updated_at'] = datetime.now().isoformat()
+    return stats
+
+
+def aggregate_results(results):
+    """Tính lại toàn bộ bảng tổng hợp từ danh sách kết quả, trả về dict (khối, mã đề) -> stats"""
+    aggregates = {}
+    for result in results:
+        exam_id = result.get('exam_id')
+        if not exam_id:
+            continue
+        grade = str(result.get('grade'))
+        stats = aggregates.get((grade, exam_id))
+        if stats is None:
+            stats = aggregates[(grade, exam_id)] = empty_stats(grade, exam_id)
+        apply_result(stats, result)
+    return aggregates
+
+
+def summarize_stats(stats):
+    """Số liệu hiển thị: lượt làm, điểm trung bình, phổ điểm, tỉ lệ đúng từng câu"""
+    attempts = stats.get('attempts', 0) if stats else 0
+    if not attempts:
+        return {
+            'attempts': 0, 'mean_score': None, 'histogram': [0] * HISTOGRAM_BINS,
+            'correct_rates': {}, 'hardest_questions': []
+        }
+    correct_rates = {
+        question_id: round(correct / answered, 2)
+        for question_id, (correct, answered) in stats['questions'].items()
+        if answered > 0
+    }
+    return {
+        'attempts': attempts,
+        'mean_score': round(stats['score_tenths'] / attempts / 10, 2),
+        'histogram': list(stats['histogram']),
+        'correct_rates': correct_rates,
+        'hardest_questions': sorted(correct_rates.items(), key=lambda item: item[1])[:3]
+    }
+
+
+if __name__ == '__main__':
+    # python -m utils.exam_stats  -> dựng lại toàn bộ bảng tổng hợp từ kết quả gốc
+    from utils.database import create_database
+
+    rebuilt = create_database().rebuild_exam_stats()
+    print(f'✓ Rebuilt statistics for {rebuilt} exams')
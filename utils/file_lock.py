@@ -0,0 +1,51 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ khóa được giữa các thread trong cùng tiến trình
+    fcntl = None
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+_held = threading.local()
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Khóa độc quyền theo đường dẫn, có hiệu lực giữa các thread và giữa các worker gunicorn
+    (flock trên file <path>.lock). Gọi lồng nhau trong cùng thread là an toàn.
+    """
+    lock_path = f'{path}.lock'
+    depth = getattr(_held, 'depth', None)
+    if depth is None:
+        depth = _held.depth = {}
+
+    if depth.get(lock_path):
+        depth[lock_path] += 1
+        try:
+            yield
+        finally:
+            depth[lock_path] -= 1
+        return
+
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(lock_path, threading.Lock())
+
+    with thread_lock:
+        depth[lock_path] = 1
+        try:
+            if fcntl is None:
+                yield
+            else:
+                os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+                with open(lock_path, 'a') as handle:
+                    fcntl.flock(handle, fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(handle, fcntl.LOCK_UN)
+        finally:
+            depth[lock_path] = 0
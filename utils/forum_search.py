@@ -0,0 +1,186 @@
+import bisect
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+TITLE_WEIGHT = 2          # từ trong tiêu đề được tính gấp đôi
+MIN_PREFIX_LENGTH = 2     # từ khóa từ 2 ký tự trở lên mới được mở rộng theo tiền tố
+PREFIX_MATCH_WEIGHT = 0.5 # khớp tiền tố ("thu" -> "thuat") được nửa điểm so với khớp trọn từ
+
+_TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def fold_text(text):
+    """Chữ thường, bỏ dấu tiếng Việt: 'Thuật Toán Đệ Quy' -> 'thuat toan de quy'"""
+    text = (text or '').lower().replace('đ', 'd')
+    decomposed = unicodedata.normalize('NFD', text)
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def tokenize(text):
+    return _TOKEN_PATTERN.findall(fold_text(text))
+
+
+def _post_terms(post):
+    tokens = tokenize(post.get('title')) * TITLE_WEIGHT
+    tokens += tokenize(post.get('content'))
+    for tag in post.get('tags') or []:
+        tokens += tokenize(str(tag))
+    return Counter(tokens)
+
+
+class ForumSearchIndex:
+    """
+    Chỉ mục ngược cho diễn đàn: mỗi bài viết là một tài liệu gồm tiêu đề, nội dung, tag
+    và nội dung các bình luận của nó. Xếp hạng bằng BM25.
+
+    Cập nhật tăng dần theo từng phần (bài viết / từng bình luận), nên chi phí tìm kiếm
+    chỉ phụ thuộc số tài liệu khớp. `version` là phiên bản dữ liệu mà chỉ mục đang phản ánh.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.version = None
+        self._reset()
+
+    def _reset(self):
+        self._postings = {}   # từ -> {post_id: tần suất}
+        self._terms = []      # danh sách từ đã sắp xếp, dùng bisect để tìm theo tiền tố
+        self._parts = {}      # post_id -> {'post' / comment_id: Counter}
+        self._doc_terms = {}  # post_id -> Counter tổng của mọi phần
+        self._doc_len = {}
+        self._total_len = 0
+
+    def rebuild(self, posts, comments, version):
+        with self._lock:
+            self._reset()
+            for post in posts:
+                self.index_post(post)
+            for comment in comments:
+                self.index_comment(comment)
+            self.version = version
+
+    def apply(self, version, update):
+        """
+        Áp dụng một thay đổi của chính tiến trình này. Chỉ cập nhật tăng dần khi chỉ mục
+        đang ở ngay phiên bản trước; nếu đã lỡ thay đổi của worker khác thì đánh dấu cần dựng lại.
+        """
+        with self._lock:
+            if self.version is not None and self.version == version - 1:
+                update(self)
+                self.version = version
+            else:
+                self.version = None
+
+    def _set_part(self, post_id, part_key, terms):
+        parts = self._parts.setdefault(post_id, {})
+        delta = Counter()
+        old_terms = parts.pop(part_key, None)
+        if old_terms:
+            delta.subtract(old_terms)
+        if terms is not None:
+            parts[part_key] = terms
+            delta.update(terms)
+
+        doc_terms = self._doc_terms.setdefault(post_id, Counter())
+        length_change = 0
+        for term, change in delta.items():
+            if not change:
+                continue
+            length_change += change
+            frequency = doc_terms[term] + change
+            postings = self._postings.get(term)
+            if frequency > 0:
+                doc_terms[term] = frequency
+                if postings is None:
+                    postings = self._postings[term] = {}
+                    bisect.insort(self._terms, term)
+                postings[post_id] = frequency
+            else:
+                doc_terms.pop(term, None)
+                if postings is not None:
+                    postings.pop(post_id, None)
+                    if not postings:
+                        del self._postings[term]
+                        del self._terms[bisect.bisect_left(self._terms, term)]
+
+        self._doc_len[post_id] = self._doc_len.get(post_id, 0) + length_change
+        self._total_len += length_change
+
+    def index_post(self, post):
+        with self._lock:
+            self._set_part(post['id'], 'post', _post_terms(post))
+
+    def index_comment(self, comment):
+        with self._lock:
+            post_id = comment.get('post_id')
+            # Bỏ qua bình luận của bài viết không còn tồn tại
+            if 'post' not in self._parts.get(post_id, {}):
+                return
+            self._set_part(post_id, comment['id'], Counter(tokenize(comment.get('content'))))
+
+    def remove_comment(self, comment):
+        with self._lock:
+            post_id = comment.get('post_id')
+            if comment.get('id') in self._parts.get(post_id, {}):
+                self._set_part(post_id, comment['id'], None)
+
+    def remove_post(self, post_id):
+        with self._lock:
+            for part_key in list(self._parts.get(post_id, {})):
+                self._set_part(post_id, part_key, None)
+            self._parts.pop(post_id, None)
+            self._doc_terms.pop(post_id, None)
+            self._doc_len.pop(post_id, None)
+
+    def _expand(self, token):
+        """Các từ trong chỉ mục khớp với từ khóa: trùng khớp hoặc bắt đầu bằng từ khóa"""
+        if token in self._postings:
+            yield token, 1.0
+        if len(token) < MIN_PREFIX_LENGTH:
+            return
+        terms = self._terms
+        i = bisect.bisect_right(terms, token)
+        while i < len(terms) and terms[i].startswith(token):
+            yield terms[i], PREFIX_MATCH_WEIGHT
+            i += 1
+
+    def search(self, query):
+        """Trả về [(post_id, điểm)] theo thứ tự điểm giảm dần; bài phải khớp mọi từ khóa"""
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return []
+
+        with self._lock:
+            doc_count = len(self._doc_len)
+            if not doc_count:
+                return []
+            avg_len = (self._total_len / doc_count) or 1.0
+            scores = None
+
+            for token in tokens:
+                token_scores = {}
+                for term, weight in self._expand(token):
+                    postings = self._postings[term]
+                    idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for post_id, frequency in postings.items():
+                        norm = BM25_K1 * (1 - BM25_B + BM25_B * self._doc_len[post_id] / avg_len)
+                        score = weight * idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+                        if score > token_scores.get(post_id, 0.0):
+                            token_scores[post_id] = score
+
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {
+                        post_id: score + token_scores[post_id]
+                        for post_id, score in scores.items() if post_id in token_scores
+                    }
+                if not scores:
+                    return []
+
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -2,6 +2,9 @@ import os
 import re
 import google.generativeai as genai
 
+from utils.gemini_client import GeminiBusyError, gemini_client, is_transient_error
+from utils.response_cache import ResponseCache
+
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 if GEMINI_API_KEY:
@@ -10,12 +13,13 @@ else:
     print("  CẢNH BÁO: Thiếu GEMINI_API_KEY trong file .env")
 
 
-def remove_markdown_formatting(text):
-    """
-    Loại bỏ các ký tự định dạng Markdown
-    """
-    # Loại bỏ headers (#, ##, ###)
-    text = re.sub(r'#+\s*', '', text)
+def _strip_headers(text):
+    # Loại bỏ headers (#, ##, ###) - \s* có thể nuốt cả xuống dòng, nối dòng sau vào dòng trước
+    return re.sub(r'#+\s*', '', text)
+
+
+def _strip_inline(text):
+    # Các mẫu dưới đây không vượt quá một dòng (``` chỉ lấy thêm dấu xuống dòng ngay sau nó)
     
     # Loại bỏ bold/italic (**text**, *text*, __text__, _text_)
     text = re.sub(r'\*\*(.+?)\*\*', r'\1', text)
@@ -30,63 +34,175 @@ def remove_markdown_formatting(text):
     # Loại bỏ inline code (`code`)
     text = re.sub(r'`(.+?)`', r'\1', text)
     
-    return text.strip()
+    return text
 
 
-def chat_with_gemini(user_message):
-    if not GEMINI_API_KEY:
-        return "Xin lỗi, dịch vụ AI chưa được cấu hình. Vui lòng liên hệ quản trị viên để bổ sung GEMINI_API_KEY."
+def _strip_markdown(text):
+    return _strip_inline(_strip_headers(text))
+
+
+def remove_markdown_formatting(text):
+    """
+    Loại bỏ các ký tự định dạng Markdown
+    """
+    return _strip_markdown(text).strip()
+
+
+_INLINE_MARKDOWN_CHARS = re.compile(r'[*_`]')
+_TRAILING_HEADER = re.compile(r'#+\s*$')
+
+
+class MarkdownStripper:
+    """
+    remove_markdown_formatting cho câu trả lời dạng stream: feed() từng đoạn, nhận lại phần
+    văn bản đã chắc chắn sạch, finish() khi hết. Ghép các phần trả về cho đúng kết quả của
+    remove_markdown_formatting trên toàn bộ văn bản.
+    Header được bỏ trước (giữ lại '#' ở cuối vì nó còn nuốt khoảng trắng/xuống dòng của đoạn sau);
+    các mẫu còn lại chỉ nằm trong một dòng trừ ``` (nuốt dấu xuống dòng ngay sau nó), nên chỉ phải
+    giữ các dòng có '`' chưa khép và phần dòng dở dang kể từ ký tự định dạng đầu tiên.
+    """
     
-    try:
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',
-            generation_config={
-                'temperature': 0.7,
-                'top_p': 0.95,
-                'top_k': 40,
-                'max_output_tokens': 2048,
-            }
-            # ← XÓA system_instruction
-        )
+    def __init__(self):
+        self._raw = ''          # '#...' ở cuối, chưa biết header kéo dài tới đâu
+        self._pending = ''      # đã bỏ header, chờ đủ dòng mới bỏ được định dạng
+        self._pending_space = ''
+        self._started = False
+    
+    def feed(self, chunk):
+        raw = self._raw + chunk
+        header = _TRAILING_HEADER.search(raw)
+        cut = header.start() if header else len(raw)
+        self._raw = raw[cut:]
+        self._pending += _strip_headers(raw[:cut])
         
-        # Nhúng system instruction vào prompt
-        full_prompt = f"""Bạn là trợ lý AI cho học sinh THCS ôn thi môn Tin học.
+        line_start = self._pending.rfind('\n') + 1
+        safe_end = self._safe_line_end()
+        if safe_end == line_start:
+            # Phần đầu dòng dở dang chưa có ký tự định dạng nào thì không mẫu nào chạm tới được
+            marker = _INLINE_MARKDOWN_CHARS.search(self._pending, line_start)
+            ready_end = marker.start() if marker else len(self._pending)
+        else:
+            ready_end = safe_end
+        ready, self._pending = self._pending[:ready_end], self._pending[ready_end:]
+        return self._emit(_strip_inline(ready))
+    
+    def _safe_line_end(self):
+        # Dấu xuống dòng sau '```py' bị xóa, nối dòng sau vào dòng có '`' -> chỉ cắt sau dòng không có '`'
+        end = self._pending.rfind('\n')
+        while end >= 0:
+            start = self._pending.rfind('\n', 0, end)
+            if '`' not in self._pending[start + 1:end]:
+                return end + 1
+            end = start
+        return 0
+    
+    def finish(self):
+        text = self._pending + _strip_headers(self._raw)
+        self._raw = self._pending = ''
+        return self._emit(_strip_inline(text))
+    
+    def _emit(self, text):
+        # Tương đương strip(): bỏ khoảng trắng đầu, giữ khoảng trắng cuối tới khi có chữ tiếp theo
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return ''
+            self._started = True
+        body = text.rstrip()
+        if not body:
+            self._pending_space += text
+            return ''
+        output = self._pending_space + body
+        self._pending_space = text[len(body):]
+        return output
+
+
+CHAT_MODEL = 'gemini-2.5-flash'
+CHAT_GENERATION_CONFIG = {
+    'temperature': 0.7,
+    'top_p': 0.95,
+    'top_k': 40,
+    'max_output_tokens': 2048,
+}
+
+CHAT_SYSTEM_PROMPT = """Bạn là trợ lý AI cho học sinh THCS ôn thi môn Tin học.
 Nhiệm vụ của bạn là:
 - Giải đáp thắc mắc về lập trình, thuật toán, cấu trúc dữ liệu
 - Hướng dẫn học sinh giải bài tập tin học
 - Giải thích các khái niệm tin học một cách dễ hiểu
 - Trả lời bằng tiếng Việt, ngắn gọn và rõ ràng
 
-QUAN TRỌNG: Trả lời bằng văn bản thuần túy, KHÔNG sử dụng bất kỳ ký tự định dạng nào như #, **, *, ```.
+QUAN TRỌNG: Trả lời bằng văn bản thuần túy, KHÔNG sử dụng bất kỳ ký tự định dạng nào như #, **, *, ```."""
+
+# Học sinh hay hỏi lại cùng một câu -> trả lời từ cache thay vì gọi Gemini
+response_cache = ResponseCache()
+
+
+# Đổi system prompt hay cấu hình sinh thì khóa cache cũng đổi theo
+CHAT_CACHE_CONFIG = dict(CHAT_GENERATION_CONFIG, system_prompt=CHAT_SYSTEM_PROMPT)
+
+
+def _chat_prompt(user_message):
+    # Nhúng system instruction vào prompt
+    return f"""{CHAT_SYSTEM_PROMPT}
 
 Câu hỏi: {user_message}
 
 Trả lời:"""
-        
-        response = model.generate_content(full_prompt)
-        clean_text = remove_markdown_formatting(response.text)
-        return clean_text
+
+
+def chat_with_gemini(user_message):
+    if not GEMINI_API_KEY:
+        return "Xin lỗi, dịch vụ AI chưa được cấu hình. Vui lòng liên hệ quản trị viên để bổ sung GEMINI_API_KEY."
+    
+    def generate():
+        response = gemini_client.generate(_chat_prompt(user_message), CHAT_MODEL, CHAT_GENERATION_CONFIG)
+        return remove_markdown_formatting(response.text)
     
+    try:
+        return response_cache.get_or_create(user_message, CHAT_MODEL, CHAT_CACHE_CONFIG, generate)
+    
+    except GeminiBusyError as e:
+        return f"Xin lỗi! {e}"
     except Exception as e:
         return f"Xin lỗi, có lỗi xảy ra: {str(e)}"
 
 
+def stream_chat_with_gemini(user_message):
+    """
+    Như chat_with_gemini nhưng sinh từng đoạn câu trả lời (đã bỏ Markdown) ngay khi Gemini
+    trả về. Câu đã có trong cache được trả nguyên trong một đoạn; lỗi được ném ra cho nơi gọi.
+    """
+    if not GEMINI_API_KEY:
+        yield "Xin lỗi, dịch vụ AI chưa được cấu hình. Vui lòng liên hệ quản trị viên để bổ sung GEMINI_API_KEY."
+        return
+    
+    key, cached = response_cache.lookup(user_message, CHAT_MODEL, CHAT_CACHE_CONFIG)
+    if cached is not None:
+        yield cached
+        return
+    
+    stripper = MarkdownStripper()
+    parts = []
+    for chunk in gemini_client.generate_stream(_chat_prompt(user_message), CHAT_MODEL, CHAT_GENERATION_CONFIG):
+        text = stripper.feed(chunk)
+        if text:
+            parts.append(text)
+            yield text
+    text = stripper.finish()
+    if text:
+        parts.append(text)
+        yield text
+    
+    # Chỉ lưu câu trả lời đã stream trọn vẹn (client ngắt giữa chừng thì không tới đây)
+    response_cache.store(key, CHAT_MODEL, user_message, ''.join(parts))
+
+
 def chat_with_context(user_message, chat_history=[]):
     if not GEMINI_API_KEY:
         return "Xin lỗi, dịch vụ AI chưa được cấu hình."
     
     try:
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',
-            generation_config={
-                'temperature': 0.7,
-                'top_p': 0.95,
-                'top_k': 40,
-                'max_output_tokens': 2048,
-            }
-            # ← XÓA system_instruction
-        )
-        
         # Thêm system instruction vào đầu history
         gemini_history = [
             {
@@ -112,39 +228,38 @@ def chat_with_context(user_message, chat_history=[]):
                     'parts': [msg.get('content', msg.get('parts', [''])[0])]
                 })
         
-        chat = model.start_chat(history=gemini_history)
-        response = chat.send_message(user_message)
+        response = gemini_client.send_message(gemini_history, user_message, CHAT_MODEL, CHAT_GENERATION_CONFIG)
         clean_text = remove_markdown_formatting(response.text)
         return clean_text
     
+    except GeminiBusyError as e:
+        return f"Xin lỗi! {e}"
     except Exception as e:
         return f"Xin lỗi, có lỗi xảy ra: {str(e)}"
 
 
-def get_gemini_response(prompt, temperature=0.7, max_tokens=4096):
+def get_gemini_response(prompt, temperature=0.7, max_tokens=4096, timeout=None, queue_timeout=None):
     """
     Lấy response từ Gemini với config tùy chỉnh
     Dùng cho convert đề thi và các task phức tạp
+    Lỗi tạm thời (GeminiBusyError, hết hạn...) được ném nguyên dạng để nơi gọi chờ rồi thử lại
     """
     if not GEMINI_API_KEY:
         raise Exception("Thiếu GEMINI_API_KEY. Vui lòng cấu hình trong file .env")
     
     try:
-        model = genai.GenerativeModel(
-            'gemini-2.5-flash',
-            generation_config={
-                'temperature': temperature,
-                'max_output_tokens': max_tokens,
-                'top_p': 0.95,
-                'top_k': 40,
-            }
-        )
-        
-        response = model.generate_content(prompt)
+        response = gemini_client.generate(prompt, CHAT_MODEL, {
+            'temperature': temperature,
+            'max_output_tokens': max_tokens,
+            'top_p': 0.95,
+            'top_k': 40,
+        }, timeout=timeout, queue_timeout=queue_timeout)
         
         return response.text
     
     except Exception as e:
+        if is_transient_error(e):
+            raise
         raise Exception(f"Lỗi khi gọi Gemini API: {str(e)}")
 
 
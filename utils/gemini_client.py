@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+# Thời hạn mỗi lần gọi Gemini (giây) - mặc định cho lời gọi tương tác (chatbot, phân tích kết quả)
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', '30'))
+# Việc chạy nền sinh câu trả lời dài (chuyển đổi đề thi) được chờ lâu hơn cả khi gọi lẫn khi xếp hàng
+GEMINI_BATCH_TIMEOUT = float(os.getenv('GEMINI_BATCH_TIMEOUT', '180'))
+GEMINI_BATCH_QUEUE_TIMEOUT = float(os.getenv('GEMINI_BATCH_QUEUE_TIMEOUT', '120'))
+# Số lời gọi Gemini đồng thời tối đa trong một worker (gthread có 32 thread, phần còn lại cho nộp bài...)
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '4'))
+# Số yêu cầu được xếp hàng chờ lượt, và thời gian chờ tối đa (giây)
+GEMINI_MAX_QUEUE = int(os.getenv('GEMINI_MAX_QUEUE', '16'))
+GEMINI_QUEUE_TIMEOUT = float(os.getenv('GEMINI_QUEUE_TIMEOUT', '10'))
+
+
+class GeminiBusyError(Exception):
+    """
+    Quá nhiều yêu cầu AI đang chạy/chờ - từ chối ngay thay vì giữ thread của worker.
+    Lỗi tạm thời: yêu cầu của người dùng thì báo "thử lại sau"; việc chạy nền thì để lỗi đi ra ngoài
+    (hoặc chờ rồi thử lại) và KHÔNG lưu kết quả dự phòng như thể đó là kết quả cuối cùng.
+    """
+
+
+def is_transient_error(exc):
+    """Lỗi tạm thời (quá tải, hết hạn chờ, Gemini báo bận/hết hạn mức) - thử lại sau có thể thành công"""
+    return isinstance(exc, (
+        GeminiBusyError,
+        TimeoutError,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.ResourceExhausted,
+    ))
+
+
+class GeminiClientManager:
+    """
+    Dùng chung GenerativeModel theo (model, cấu hình) trong mỗi worker: model giữ client
+    (kết nối tới Gemini) nên các lời gọi sau không phải tạo lại.
+    Mọi lời gọi đi qua một semaphore có hàng đợi giới hạn và có thời hạn riêng,
+    nên Gemini chậm chỉ chiếm tối đa `max_concurrency` thread của worker.
+    `timeout` / `queue_timeout` của từng lời gọi ghi đè mặc định, để việc nền sinh nội dung dài
+    không bị áp thời hạn của chatbot.
+    """
+
+    def __init__(self, timeout=GEMINI_TIMEOUT, max_concurrency=GEMINI_MAX_CONCURRENCY,
+                 max_queue=GEMINI_MAX_QUEUE, queue_timeout=GEMINI_QUEUE_TIMEOUT):
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._models = {}
+        self._pid = os.getpid()
+        self._waiting = 0
+
+    def model(self, model_name, generation_config):
+        key = (model_name, json.dumps(generation_config, sort_keys=True))
+        with self._lock:
+            # Client gRPC không dùng được sau fork -> worker mới tạo model riêng
+            if self._pid != os.getpid():
+                self._models = {}
+                self._pid = os.getpid()
+            model = self._models.get(key)
+            if model is None:
+                model = genai.GenerativeModel(model_name, generation_config=generation_config)
+                self._models[key] = model
+            return model
+
+    @contextmanager
+    def slot(self, queue_timeout=None):
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                raise GeminiBusyError('Hệ thống AI đang quá tải, vui lòng thử lại sau ít phút')
+            self._waiting += 1
+        try:
+            acquired = self._slots.acquire(timeout=queue_timeout or self.queue_timeout)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        if not acquired:
+            raise GeminiBusyError('Hệ thống AI đang bận, vui lòng thử lại sau ít phút')
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def _request_options(self, timeout):
+        return {'timeout': timeout or self.timeout}
+
+    def generate(self, prompt, model_name, generation_config, timeout=None, queue_timeout=None):
+        """generate_content có giới hạn đồng thời và thời hạn; trả về response của Gemini"""
+        model = self.model(model_name, generation_config)
+        with self.slot(queue_timeout):
+            return model.generate_content(prompt, request_options=self._request_options(timeout))
+
+    def generate_stream(self, prompt, model_name, generation_config, timeout=None, queue_timeout=None):
+        """Sinh từng đoạn văn bản ngay khi Gemini trả về; giữ lượt gọi tới khi stream kết thúc hoặc bị đóng"""
+        model = self.model(model_name, generation_config)
+        with self.slot(queue_timeout):
+            response = model.generate_content(prompt, stream=True, request_options=self._request_options(timeout))
+            for chunk in response:
+                # Đoạn cuối có thể chỉ mang finish_reason, không có nội dung
+                if chunk.parts:
+                    yield chunk.text
+
+    def send_message(self, history, message, model_name, generation_config, timeout=None, queue_timeout=None):
+        """Gửi một tin trong phiên chat dựng từ `history`; trả về response của Gemini"""
+        chat = self.model(model_name, generation_config).start_chat(history=history)
+        with self.slot(queue_timeout):
+            return chat.send_message(message, request_options=self._request_options(timeout))
+
+
+gemini_client = GeminiClientManager()
@@ -0,0 +1,122 @@
+import threading
+from collections import OrderedDict
+
+# Điểm câu TL2 theo số ý sai: 0 sai = 1 điểm, 1 sai = 0.5, 2 sai = 0.25, 3 sai = 0.1, từ 4 sai = 0
+TL2_SCORE_TABLE = (1.0, 0.5, 0.25, 0.1)
+
+# Cách chấm của từng câu, xác định một lần khi biên dịch đáp án
+KIND_TEXT = 0      # TL1 một đáp án: so sánh chuỗi đã strip().upper()
+KIND_SET = 1       # TL1 nhiều đáp án: so sánh tập hợp
+KIND_TL2 = 2       # TL2: tính điểm theo số ý sai
+KIND_TL2_INVALID = 3  # TL2 nhưng đáp án đúng không phải list -> luôn 0 điểm
+
+ANSWER_KEY_CACHE_SIZE = 256
+
+
+class AnswerKey:
+    """
+    Đáp án đã được "biên dịch" của một phiên bản đề thi.
+    Mọi chuẩn hóa (loại câu, frozenset đáp án, chuỗi upper) làm một lần khi tạo,
+    grade() chỉ còn một vòng lặp gọn cho mỗi bài nộp.
+    """
+
+    __slots__ = ('exam_id', 'version', 'title', 'items', 'total_questions')
+
+    def __init__(self, exam, version=None):
+        self.exam_id = exam.get('id')
+        self.version = version
+        self.title = exam.get('title', 'Đề thi')
+        items = []
+        for question in exam.get('questions', []):
+            q_type = question.get('type', 'tl1')
+            correct_answer = question.get('correct_answer')
+            if q_type == 'tl2':
+                if isinstance(correct_answer, list):
+                    kind, expected = KIND_TL2, frozenset(correct_answer)
+                else:
+                    kind, expected = KIND_TL2_INVALID, None
+            elif isinstance(correct_answer, list):
+                kind, expected = KIND_SET, frozenset(correct_answer)
+            else:
+                kind, expected = KIND_TEXT, str(correct_answer).strip().upper()
+            items.append((str(question.get('id')), q_type, kind, expected, correct_answer))
+        self.items = tuple(items)
+        self.total_questions = len(items)
+
+    def grade(self, answers):
+        """
+        Chấm một bài nộp (dict question_id -> câu trả lời).
+        Trả về dict score / correct_count / total_questions / details giống cách chấm cũ.
+        """
+        get_answer = answers.get
+        tl2_scores = TL2_SCORE_TABLE
+        tl2_levels = len(tl2_scores)
+        correct_count = 0
+        total_score_float = 0.0
+        details = []
+
+        for q_id, q_type, kind, expected, correct_answer in self.items:
+            user_answer = get_answer(q_id)
+            is_correct = False
+            score_for_question = 0.0
+
+            if kind == KIND_TEXT:
+                is_correct = str(user_answer).strip().upper() == expected
+            elif kind == KIND_SET:
+                is_correct = isinstance(user_answer, list) and expected == set(user_answer)
+            elif kind == KIND_TL2 and isinstance(user_answer, list):
+                mistakes = len(expected.symmetric_difference(user_answer))
+                score_for_question = tl2_scores[mistakes] if mistakes < tl2_levels else 0.0
+                is_correct = mistakes == 0
+
+            if is_correct:
+                correct_count += 1
+                if kind != KIND_TL2:
+                    score_for_question = 1.0
+            total_score_float += score_for_question
+
+            details.append({
+                'question_id': q_id,
+                'user_answer': user_answer,
+                'correct_answer': correct_answer,
+                'is_correct': is_correct,
+                'score': score_for_question,
+                'type': q_type
+            })
+
+        total_questions = self.total_questions
+        return {
+            'score': round((total_score_float / total_questions * 10) if total_questions > 0 else 0, 1),
+            'correct_count': correct_count,
+            'total_questions': total_questions,
+            'details': details
+        }
+
+
+_answer_keys = OrderedDict()
+_answer_keys_lock = threading.Lock()
+
+
+def get_answer_key(grade, exam_id, version, load_exam):
+    """
+    Lấy AnswerKey theo (khối, mã đề, phiên bản) từ cache LRU.
+    load_exam() chỉ được gọi khi chưa có trong cache; trả về None nếu đề không tồn tại.
+    """
+    cache_key = (str(grade), exam_id, version)
+    with _answer_keys_lock:
+        answer_key = _answer_keys.get(cache_key)
+        if answer_key is not None:
+            _answer_keys.move_to_end(cache_key)
+            return answer_key
+
+    exam = load_exam()
+    if not exam:
+        return None
+    answer_key = AnswerKey(exam, version)
+
+    with _answer_keys_lock:
+        _answer_keys[cache_key] = answer_key
+        _answer_keys.move_to_end(cache_key)
+        while len(_answer_keys) > ANSWER_KEY_CACHE_SIZE:
+            _answer_keys.popitem(last=False)
+    return answer_key
@@ -0,0 +1,288 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_JOBS_PATH = 'data/jobs.sqlite3'
+# Số thread xử lý job trong mỗi worker
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+# Job "running" không được gia hạn quá thời hạn này (worker chạy nó đã chết) được giao lại cho worker khác (giây).
+# Trong lúc job chạy, thread heartbeat gia hạn sau mỗi JOB_LEASE / 4 giây nên job dài không bị chạy trùng
+JOB_LEASE = int(os.getenv('JOB_LEASE', '120'))
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 5  # giây, nhân đôi sau mỗi lần lỗi
+JOB_POLL_INTERVAL = 1.0
+# Job đã kết thúc được giữ lại để client đọc kết quả (giây)
+JOB_RETENTION = 24 * 3600
+
+FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    owner TEXT,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_after REAL NOT NULL,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, run_after);
+"""
+
+
+class JobQueue:
+    """
+    Hàng đợi job bền vững trong SQLite: job còn nguyên sau khi worker khởi động lại.
+    Mỗi worker gunicorn chạy vài thread lấy job; việc nhận job nằm trong BEGIN IMMEDIATE nên
+    hai worker không chạy trùng một job. Job lỗi được thử lại (tối đa max_attempts lần, chờ
+    tăng dần), job có thể bị hủy - kết quả của job đã hủy mà vẫn chạy xong sẽ bị bỏ.
+    Số lần thử (attempts) đóng vai trò mã lượt nhận job: worker chỉ gia hạn/ghi kết quả cho đúng
+    lượt mình nhận, nên kết quả muộn của lượt đã bị giao lại cũng bị bỏ.
+    """
+
+    def __init__(self, path=None, workers=JOB_WORKERS, lease=JOB_LEASE):
+        self.path = path or os.getenv('JOBS_PATH', DEFAULT_JOBS_PATH)
+        self.workers = workers
+        self.lease = lease
+        self._handlers = {}
+        self._local = threading.local()
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._running = {}  # job_id -> attempts của các job tiến trình này đang chạy
+        self._running_lock = threading.Lock()
+        self._fork_hook = False
+
+    def register(self, kind, handler):
+        """handler(payload) -> kết quả JSON được; ném exception để báo lỗi (sẽ được thử lại)"""
+        self._handlers[kind] = handler
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # Sau khi gunicorn fork, tiến trình con phải mở kết nối riêng
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self, work):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            value = work(conn)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return value
+
+    def start(self):
+        """Khởi động thread xử lý job của tiến trình này (gọi khi nạp app; gọi lại không sao)"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if not self._fork_hook:
+                # Thread không sống sót qua fork: app nạp trước khi fork (gunicorn --preload)
+                # thì worker con tự khởi động lại ngay, không chờ tới lần enqueue/get đầu tiên
+                os.register_at_fork(after_in_child=self._after_fork)
+                self._fork_hook = True
+            self._wakeup = threading.Event()
+            self._running = {}
+            for _ in range(self.workers):
+                threading.Thread(target=self._run, daemon=True).start()
+            threading.Thread(target=self._heartbeat, daemon=True).start()
+            self._pid = os.getpid()
+
+    def _after_fork(self):
+        if self._pid is not None:
+            self._start_lock = threading.Lock()
+            self._running_lock = threading.Lock()
+            self.start()
+
+    def enqueue(self, kind, payload, owner=None, max_attempts=JOB_MAX_ATTEMPTS):
+        self.start()
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        self._connect().execute(
+            'INSERT INTO jobs (id, kind, owner, status, payload, max_attempts, run_after, created_at, updated_at) '
+            "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?)",
+            (job_id, kind, owner, json.dumps(payload, ensure_ascii=False), max_attempts, now, now, now)
+        )
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """Trạng thái job (không kèm payload), hoặc None"""
+        self.start()
+        row = self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'owner': row['owner'],
+            'status': row['status'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'attempts': row['attempts'],
+            'max_attempts': row['max_attempts'],
+            'created_at': row['created_at'],
+            'updated_at': row['updated_at']
+        }
+
+    def cancel(self, job_id):
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE id = ? AND status IN ('queued', 'running')",
+            (time.time(), job_id)
+        )
+        return cursor.rowcount > 0
+
+    def retry(self, job_id):
+        """Cho job đã lỗi/đã hủy chạy lại từ đầu với đủ số lần thử"""
+        now = time.time()
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = 'queued', attempts = 0, error = NULL, run_after = ?, updated_at = ? "
+            "WHERE id = ? AND status IN ('failed', 'cancelled')",
+            (now, now, job_id)
+        )
+        self._wakeup.set()
+        return cursor.rowcount > 0
+
+    def _claim(self):
+        now = time.time()
+
+        def claim(conn):
+            # Job "running" hết hạn mà đã dùng hết lượt thử thì kết thúc luôn
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = COALESCE(error, 'Quá thời gian xử lý'), updated_at = ? "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts",
+                (now, now)
+            )
+            row = conn.execute(
+                "SELECT id, kind, payload FROM jobs "
+                "WHERE (status = 'queued' AND run_after <= ?) OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ? "
+                "WHERE id = ?",
+                (now + self.lease, now, row['id'])
+            )
+            attempts = conn.execute('SELECT attempts FROM jobs WHERE id = ?', (row['id'],)).fetchone()[0]
+            return row['id'], attempts, row['kind'], json.loads(row['payload'])
+
+        return self._transaction(claim)
+
+    def _renew(self, job_id, attempts):
+        """Gia hạn lease của lượt đang chạy; False nếu job đã bị hủy hoặc giao cho lượt khác"""
+        cursor = self._connect().execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+            (time.time() + self.lease, job_id, attempts)
+        )
+        return cursor.rowcount > 0
+
+    def _finish(self, job_id, attempts, result):
+        self._connect().execute(
+            "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_until = NULL, updated_at = ? "
+            "WHERE id = ? AND status = 'running' AND attempts = ?",
+            (json.dumps(result, ensure_ascii=False), time.time(), job_id, attempts)
+        )
+
+    def _fail(self, job_id, attempts, error):
+        now = time.time()
+
+        def fail(conn):
+            row = conn.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND status = 'running' AND attempts = ?",
+                (job_id, attempts)
+            ).fetchone()
+            if row is None:
+                return  # đã bị hủy (hoặc bị giao lại) trong lúc chạy
+            if row['attempts'] < row['max_attempts']:
+                delay = JOB_RETRY_DELAY * 2 ** (row['attempts'] - 1)
+                conn.execute(
+                    "UPDATE jobs SET status = 'queued', error = ?, run_after = ?, lease_until = NULL, updated_at = ? "
+                    "WHERE id = ?",
+                    (error, now + delay, now, job_id)
+                )
+            else:
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, lease_until = NULL, updated_at = ? WHERE id = ?",
+                    (error, now, job_id)
+                )
+
+        self._transaction(fail)
+
+    def _purge(self):
+        placeholders = ', '.join('?' for _ in FINISHED_STATUSES)
+        self._connect().execute(
+            f'DELETE FROM jobs WHERE status IN ({placeholders}) AND updated_at < ?',
+            (*FINISHED_STATUSES, time.time() - JOB_RETENTION)
+        )
+
+    def _run(self):
+        last_purge = 0
+        while True:
+            try:
+                if time.time() - last_purge > 3600:
+                    self._purge()
+                    last_purge = time.time()
+                job = self._claim()
+            except sqlite3.Error as exc:
+                print(f"⚠️ Job queue error: {exc}")
+                job = None
+            if job is None:
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+
+            job_id, attempts, kind, payload = job
+            with self._running_lock:
+                self._running[job_id] = attempts
+            try:
+                handler = self._handlers.get(kind)
+                if handler is None:
+                    raise LookupError(f'Không có handler cho job {kind}')
+                self._finish(job_id, attempts, handler(payload))
+            except Exception as exc:
+                print(f"⚠️ Job {kind} {job_id} failed: {exc}")
+                try:
+                    self._fail(job_id, attempts, str(exc))
+                except sqlite3.Error as db_exc:
+                    print(f"⚠️ Job queue error: {db_exc}")
+            finally:
+                with self._running_lock:
+                    self._running.pop(job_id, None)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease / 4)
+            with self._running_lock:
+                running = list(self._running.items())
+            for job_id, attempts in running:
+                try:
+                    self._renew(job_id, attempts)
+                except sqlite3.Error as exc:
+                    print(f"⚠️ Job queue error: {exc}")
@@ -0,0 +1,355 @@
+import atexit
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+# CHAT_BUS: unix (mặc định, một hoặc nhiều worker trên cùng máy), redis (nhiều máy),
+# local (chỉ khi chắc chắn chạy đúng một worker - tin không tới worker khác)
+DEFAULT_CHAT_BUS = 'unix'
+DEFAULT_BUS_DIR = 'data/chat_bus'
+DEFAULT_REDIS_CHANNEL = 'websitetinhoc:chat'
+MAX_DATAGRAM_SIZE = 256 * 1024
+
+
+def create_message_bus():
+    kind = os.getenv('CHAT_BUS', DEFAULT_CHAT_BUS).strip().lower()
+    if kind == 'unix':
+        return UnixSocketBus(os.getenv('CHAT_BUS_DIR', DEFAULT_BUS_DIR))
+    if kind == 'redis':
+        return RedisBus(os.getenv('CHAT_BUS_URL', 'redis://localhost:6379/0'),
+                        os.getenv('CHAT_BUS_CHANNEL', DEFAULT_REDIS_CHANNEL))
+    return LocalBus()
+
+
+class LocalBus:
+    """
+    Bus trong tiến trình: sự kiện chỉ tới chính worker đã phát.
+    Các bus khác cùng giao diện: start(handler) rồi publish(event) với event là dict JSON được.
+    start() được gọi khi tạo ChatBroadcaster và gọi lại mỗi lần dùng, nên phải rẻ, an toàn khi
+    gọi nhiều lần và không bao giờ ném lỗi.
+    """
+
+    def __init__(self):
+        self._handler = None
+
+    def start(self, handler):
+        self._handler = handler
+
+    def publish(self, event):
+        self._handler(event)
+
+
+class _ProcessBus(LocalBus):
+    """Phần chung của bus nhiều tiến trình: giao ngay cho worker hiện tại, gửi kèm mã nguồn phát để bỏ qua tin của chính mình"""
+
+    def __init__(self):
+        super().__init__()
+        self._origin = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._fork_hook = False
+        self._local_only = False
+
+    def start(self, handler):
+        # Thread/socket không sống sót qua fork -> mỗi worker gunicorn tự khởi động phần nhận
+        self._handler = handler
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if not self._fork_hook:
+                # Giống JobQueue.start: app nạp trước khi fork (gunicorn --preload) thì worker con
+                # khởi động bus ngay sau fork, không chờ tới lần publish đầu tiên
+                os.register_at_fork(after_in_child=self._after_fork)
+                self._fork_hook = True
+            self._origin = uuid.uuid4().hex
+            try:
+                self._listen()
+                self._local_only = False
+            except (OSError, AttributeError) as exc:
+                # AttributeError: nền tảng không có AF_UNIX. Tin vẫn được lưu và giao cho worker này,
+                # client ở worker khác nhận bù qua polling
+                print(f"⚠️ Chat bus unavailable, falling back to local delivery: {exc}")
+                self._local_only = True
+            self._pid = os.getpid()
+
+    def _after_fork(self):
+        if self._pid is not None:
+            self._start_lock = threading.Lock()
+            self.start(self._handler)
+
+    def _receive(self, payload):
+        try:
+            envelope = json.loads(payload)
+        except (ValueError, UnicodeDecodeError):
+            return
+        if envelope.get('origin') != self._origin:
+            self._handler(envelope['event'])
+
+    def _encode(self, event):
+        return json.dumps({'origin': self._origin, 'event': event}, ensure_ascii=False).encode('utf-8')
+
+    def publish(self, event):
+        self._handler(event)
+        if self._local_only:
+            return
+        try:
+            self._send(self._encode(event))
+        except OSError as exc:
+            print(f"⚠️ Chat bus publish failed: {exc}")
+
+
+class UnixSocketBus(_ProcessBus):
+    """
+    Bus không cần broker cho nhiều worker trên cùng máy: mỗi worker mở một Unix datagram
+    socket trong `directory`, phát = gửi datagram tới mọi socket khác trong thư mục.
+    Socket của worker đã chết (không còn ai nhận) bị xóa khi gửi lỗi.
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        self._path = None
+        self._sender = None
+
+    def _listen(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._path = os.path.join(self.directory, f'{os.getpid()}-{self._origin[:8]}.sock')
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(self._path)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # Không chờ khi hàng đợi của worker nhận bị đầy: bỏ tin đó, client sẽ nhận bù qua polling/reset
+        self._sender.setblocking(False)
+        atexit.register(self._cleanup_own, self._path, os.getpid())
+        threading.Thread(target=self._run, args=(receiver,), daemon=True).start()
+
+    def _run(self, receiver):
+        while True:
+            try:
+                self._receive(receiver.recv(MAX_DATAGRAM_SIZE))
+            except Exception as exc:
+                print(f"⚠️ Chat bus receive failed: {exc}")
+
+    @classmethod
+    def _cleanup_own(cls, path, pid):
+        # Handler atexit được kế thừa qua fork: worker con không được xóa socket của tiến trình cha
+        if os.getpid() == pid:
+            cls._cleanup(path)
+
+    @staticmethod
+    def _cleanup(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _send(self, payload):
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.sock') or entry.path == self._path:
+                continue
+            try:
+                self._sender.sendto(payload, entry.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                self._cleanup(entry.path)
+            except BlockingIOError:
+                print(f"⚠️ Chat bus queue full, dropped event for {entry.name}")
+
+
+class RedisBus(_ProcessBus):
+    """
+    Bus qua Redis PUBLISH/SUBSCRIBE, tự cài đặt giao thức RESP trên socket nên không cần
+    thêm thư viện. Mất kết nối thì thread nhận tự kết nối lại sau 1 giây.
+    """
+
+    def __init__(self, url, channel=DEFAULT_REDIS_CHANNEL):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.channel = channel
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+
+    def _connect(self):
+        conn = socket.create_connection((self.host, self.port), timeout=5)
+        reader = conn.makefile('rb')
+        if self.password:
+            self._command(conn, reader, 'AUTH', self.password)
+        return conn, reader
+
+    @staticmethod
+    def _encode_command(*args):
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        return b''.join(parts)
+
+    @classmethod
+    def _read_reply(cls, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError('Redis connection closed')
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            return body.decode()
+        if kind == b'-':
+            raise ConnectionError(body.decode())
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            length = int(body)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            return [cls._read_reply(reader) for _ in range(int(body))]
+        raise ConnectionError(f'Unexpected Redis reply: {line!r}')
+
+    def _command(self, conn, reader, *args):
+        conn.sendall(self._encode_command(*args))
+        return self._read_reply(reader)
+
+    def _listen(self):
+        self._publisher = None
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                conn, reader = self._connect()
+                conn.settimeout(None)
+                conn.sendall(self._encode_command('SUBSCRIBE', self.channel))
+                while True:
+                    reply = self._read_reply(reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b'message':
+                        self._receive(reply[2])
+            except Exception as exc:
+                print(f"⚠️ Chat bus subscriber disconnected: {exc}")
+                time.sleep(1)
+
+    def _send(self, payload):
+        with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect()
+                    self._command(*self._publisher, 'PUBLISH', self.channel, payload)
+                    return
+                except (OSError, ConnectionError):
+                    # Kết nối cũ có thể đã bị Redis đóng -> thử lại một lần với kết nối mới
+                    self._publisher = None
+                    if attempt:
+                        raise
+
+
+class _FakeRedis:
+    """Máy chủ RESP tối giản (AUTH, SUBSCRIBE, PUBLISH) để tự kiểm tra RedisBus khi không có Redis"""
+
+    def __init__(self):
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(16)
+        self.port = self._server.getsockname()[1]
+        self._clients = []
+        self._subscribers = []
+        self._lock = threading.Lock()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self._server.accept()
+            with self._lock:
+                self._clients.append(conn)
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        reader = conn.makefile('rb')
+        try:
+            while True:
+                args = RedisBus._read_reply(reader)
+                command = args[0].upper()
+                if command == b'AUTH':
+                    conn.sendall(b'+OK\r\n')
+                elif command == b'SUBSCRIBE':
+                    with self._lock:
+                        self._subscribers.append((conn, args[1]))
+                    conn.sendall(RedisBus._encode_command(b'subscribe', args[1], 1))
+                elif command == b'PUBLISH':
+                    with self._lock:
+                        targets = [sub for sub, channel in self._subscribers if channel == args[1]]
+                    for target in targets:
+                        target.sendall(RedisBus._encode_command(b'message', args[1], args[2]))
+                    conn.sendall(b':%d\r\n' % len(targets))
+        except (OSError, ConnectionError):
+            pass
+
+    def drop_connections(self):
+        """Đóng mọi kết nối như khi Redis khởi động lại"""
+        with self._lock:
+            clients, self._clients, self._subscribers = self._clients, [], []
+        for conn in clients:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+
+
+def _check_delivery(name, sender, inbox, event):
+    # Chờ tin tới receiver: subscriber Redis kết nối (lại) trong nền nên có thể phải phát lại
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        sender.publish(event)
+        if inbox.wait(0.3):
+            print(f'✓ {name}')
+            return
+    raise SystemExit(f'❌ {name}: event not delivered')
+
+
+if __name__ == '__main__':
+    # python -m utils.message_bus: tự kiểm tra các bus mà không cần Redis thật
+    import tempfile
+
+    def make_bus(factory):
+        bus, received, inbox = factory(), [], threading.Event()
+
+        def handler(event):
+            received.append(event)
+            inbox.set()
+        bus.start(handler)
+        return bus, received, inbox
+
+    fake = _FakeRedis()
+    url = f'redis://:secret@127.0.0.1:{fake.port}/0'
+    sender, sent, _ = make_bus(lambda: RedisBus(url))
+    _, got, inbox = make_bus(lambda: RedisBus(url))
+    _check_delivery('RedisBus delivers between instances', sender, inbox, {'n': 1})
+    assert got[-1] == {'n': 1} and sent[0] == {'n': 1}, (got, sent)
+
+    fake.drop_connections()
+    inbox.clear()
+    _check_delivery('RedisBus reconnects after the server drops connections', sender, inbox, {'n': 2})
+    assert got[-1] == {'n': 2}, got
+
+    with tempfile.TemporaryDirectory() as directory:
+        sender, sent, _ = make_bus(lambda: UnixSocketBus(directory))
+        _, got, inbox = make_bus(lambda: UnixSocketBus(directory))
+        _check_delivery('UnixSocketBus delivers between instances', sender, inbox, {'n': 3})
+        assert got == [{'n': 3}] and sent == [{'n': 3}], (got, sent)
+
+        # Thư mục bus không tạo được -> chỉ cảnh báo, publish vẫn giao tin cho worker hiện tại
+        blocker = os.path.join(directory, 'not-a-directory')
+        open(blocker, 'w').close()
+        bus, received, _ = make_bus(lambda: UnixSocketBus(os.path.join(blocker, 'bus')))
+        bus.publish({'n': 4})
+        assert received == [{'n': 4}], received
+        print('✓ UnixSocketBus falls back to local delivery when it cannot start')
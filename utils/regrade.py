@@ -0,0 +1,246 @@
+import gc
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+from utils.grading import AnswerKey, KIND_TEXT, KIND_SET, KIND_TL2, TL2_SCORE_TABLE
+
+# Điểm TL2 tra theo min(số ý sai, 4): từ 4 ý sai trở lên là 0 điểm (giống TL2_SCORE_TABLE trong utils.grading)
+TL2_SCORES = np.array(TL2_SCORE_TABLE + (0.0,), dtype=np.float64)
+MAX_MASK_BITS = 64
+
+_BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(masks):
+    """Đếm số bit 1 của mảng uint64"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(masks).astype(np.int64)
+    masks = np.ascontiguousarray(masks, dtype=np.uint64)
+    return _BYTE_POPCOUNT[masks.view(np.uint8)].reshape(masks.shape + (8,)).sum(axis=-1, dtype=np.int64)
+
+
+def encode_text_column(expected, column):
+    """
+    Mã hóa câu trả lời dạng chuỗi (strip().upper()) thành số nguyên.
+    Mã 0 luôn là đáp án đúng; trả về (codes, vocab) với vocab[mã] = chuỗi.
+    """
+    vocab = {expected: 0}
+    setdefault = vocab.setdefault
+    # Học sinh thường chọn cùng vài chuỗi -> nhớ mã theo chuỗi gốc, khỏi strip().upper() lại
+    seen = {}
+    codes = []
+    for answer in column:
+        if answer.__class__ is str:
+            code = seen.get(answer)
+            if code is None:
+                code = seen[answer] = setdefault(answer.strip().upper(), len(vocab))
+        else:
+            code = setdefault(str(answer).strip().upper(), len(vocab))
+        codes.append(code)
+    return np.array(codes, dtype=np.int32), list(vocab)
+
+
+def encode_set_column(expected, column):
+    """
+    Mã hóa câu trả lời dạng list thành bitmask (mỗi lựa chọn một bit).
+    Trả về (is_list, masks, expected_mask) hoặc None nếu câu có quá 64 lựa chọn khác nhau.
+    """
+    bits = {}
+    for element in expected:
+        bits[element] = 1 << len(bits)
+    expected_mask = sum(bits.values())
+
+    # Cùng một tổ hợp lựa chọn lặp lại rất nhiều -> nhớ mask theo tuple(câu trả lời)
+    seen = {}
+    is_list = []
+    masks = []
+    for answer in column:
+        if not isinstance(answer, list):
+            is_list.append(False)
+            masks.append(0)
+            continue
+        key = tuple(answer)
+        mask = seen.get(key)
+        if mask is None:
+            mask = 0
+            for element in answer:
+                bit = bits.get(element)
+                if bit is None:
+                    if len(bits) >= MAX_MASK_BITS:
+                        return None
+                    bit = bits[element] = 1 << len(bits)
+                mask |= bit
+            seen[key] = mask
+        is_list.append(True)
+        masks.append(mask)
+    return np.array(is_list, dtype=bool), np.array(masks, dtype=np.uint64), np.uint64(expected_mask)
+
+
+def _score_column_slow(kind, expected, column):
+    """Chấm từng ô bằng set của Python - chỉ dùng khi không mã hóa được bằng bitmask"""
+    correct = np.zeros(len(column), dtype=bool)
+    scores = np.zeros(len(column), dtype=np.float64)
+    for row, answer in enumerate(column):
+        if not isinstance(answer, list):
+            continue
+        mistakes = len(expected.symmetric_difference(answer))
+        correct[row] = mistakes == 0
+        if kind == KIND_SET:
+            scores[row] = 1.0 if mistakes == 0 else 0.0
+        else:
+            scores[row] = TL2_SCORES[min(mistakes, len(TL2_SCORES) - 1)]
+    return correct, scores
+
+
+def score_column(kind, expected, column):
+    """Chấm một câu cho mọi học sinh; trả về (is_correct[n], score[n])"""
+    n = len(column)
+    if kind == KIND_TEXT:
+        codes, _ = encode_text_column(expected, column)
+        correct = codes == 0
+        return correct, correct.astype(np.float64)
+
+    if kind not in (KIND_SET, KIND_TL2):
+        # TL2 có đáp án đúng không hợp lệ -> luôn 0 điểm
+        return np.zeros(n, dtype=bool), np.zeros(n, dtype=np.float64)
+
+    encoded = encode_set_column(expected, column)
+    if encoded is None:
+        return _score_column_slow(kind, expected, column)
+    is_list, masks, expected_mask = encoded
+
+    if kind == KIND_SET:
+        correct = is_list & (masks == expected_mask)
+        return correct, correct.astype(np.float64)
+
+    mistakes = _popcount(masks ^ expected_mask)
+    correct = is_list & (mistakes == 0)
+    scores = np.where(is_list, TL2_SCORES[np.minimum(mistakes, len(TL2_SCORES) - 1)], 0.0)
+    return correct, scores
+
+
+def grade_matrix(answer_key, answer_dicts):
+    """
+    Chấm cả loạt bài nộp theo AnswerKey.
+    Trả về (correct, scores) là hai ma trận học sinh × câu hỏi.
+    """
+    n, q = len(answer_dicts), answer_key.total_questions
+    correct = np.zeros((n, q), dtype=bool)
+    scores = np.zeros((n, q), dtype=np.float64)
+    for j, (q_id, _q_type, kind, expected, _correct_answer) in enumerate(answer_key.items):
+        column = [answers.get(q_id) for answers in answer_dicts]
+        correct[:, j], scores[:, j] = score_column(kind, expected, column)
+    return correct, scores
+
+
+@contextmanager
+def _gc_paused():
+    """Tạm tắt GC khi tạo hàng triệu dict details - GC chạy liên tục làm chậm gấp đôi"""
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+def regrade_records(answer_key, records):
+    """
+    Chấm lại danh sách kết quả theo đáp án mới, trả về (bản ghi mới, thống kê).
+    Bản ghi không lưu 'answers' (định dạng cũ) được giữ nguyên.
+    """
+    positions = [i for i, record in enumerate(records) if isinstance(record.get('answers'), dict)]
+    answer_dicts = [records[i]['answers'] for i in positions]
+    correct, scores = grade_matrix(answer_key, answer_dicts)
+
+    total_questions = answer_key.total_questions
+    # cumsum cộng lần lượt từ trái sang phải -> tổng float trùng khớp với cách chấm từng bài
+    totals = np.cumsum(scores, axis=1)[:, -1] if total_questions else np.zeros(len(positions))
+    correct_counts = correct.sum(axis=1)
+
+    heads = [(q_id, correct_answer, q_type) for q_id, q_type, _kind, _expected, correct_answer in answer_key.items]
+    q_ids = [q_id for q_id, _correct_answer, _q_type in heads]
+    regraded_at = datetime.now().isoformat()
+    updated = list(records)
+    changed = 0
+    for row, i in enumerate(positions):
+        record = records[i]
+        get_answer = answer_dicts[row].get
+        score = round((float(totals[row]) / total_questions * 10) if total_questions > 0 else 0, 1)
+        details = [
+            {
+                'question_id': q_id,
+                'user_answer': user_answer,
+                'correct_answer': correct_answer,
+                'is_correct': is_correct,
+                'score': score_for_question,
+                'type': q_type
+            }
+            for (q_id, correct_answer, q_type), user_answer, is_correct, score_for_question in zip(
+                heads, map(get_answer, q_ids), correct[row].tolist(), scores[row].tolist()
+            )
+        ]
+        new_record = dict(record)
+        new_record.update({
+            'score': score,
+            'correct_count': int(correct_counts[row]),
+            'total_questions': total_questions,
+            'details': details
+        })
+        if record.get('score') != score or record.get('correct_count') != new_record['correct_count']:
+            changed += 1
+            new_record['regraded_at'] = regraded_at
+        updated[i] = new_record
+
+    return updated, {
+        'total': len(records),
+        'regraded': len(positions),
+        'changed': changed,
+        'skipped': len(records) - len(positions)
+    }
+
+
+def regrade_exam(db, grade, exam_id):
+    """
+    Chấm lại mọi kết quả của một đề theo đáp án hiện tại và ghi lại trong một lượt.
+    Trả về thống kê, hoặc None nếu đề không tồn tại.
+    """
+    exam = db.get_exam(grade, exam_id)
+    if not exam:
+        return None
+    answer_key = AnswerKey(exam, db.get_exam_version(grade, exam_id))
+    stats = {'total': 0, 'regraded': 0, 'changed': 0, 'skipped': 0}
+
+    def transform(records):
+        updated, result_stats = regrade_records(answer_key, records)
+        stats.update(result_stats)
+        return updated
+
+    with _gc_paused():
+        db.rewrite_exam_results(exam_id, grade, transform)
+    return stats
+
+
+if __name__ == '__main__':
+    # python -m utils.regrade <khối> <mã đề>
+    if len(sys.argv) != 3:
+        print('Usage: python -m utils.regrade <grade> <exam_id>')
+        sys.exit(1)
+
+    from utils.database import create_database
+
+    started = time.perf_counter()
+    result = regrade_exam(create_database(), sys.argv[1], sys.argv[2])
+    if result is None:
+        print(f'❌ Exam {sys.argv[2]} (grade {sys.argv[1]}) not found')
+        sys.exit(1)
+    print(
+        f"✓ Regraded {result['regraded']}/{result['total']} results "
+        f"({result['changed']} changed, {result['skipped']} skipped) "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from utils.forum_search import fold_text
+
+DEFAULT_CACHE_PATH = 'data/ai_cache.sqlite3'
+CACHE_MAX_ENTRIES = int(os.getenv('AI_CACHE_MAX_ENTRIES', '5000'))
+CACHE_TTL = int(os.getenv('AI_CACHE_TTL', str(7 * 24 * 3600)))  # giây
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used);
+
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+_TRAILING_PUNCTUATION = re.compile(r'[\s?.!…]+$')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_prompt(text):
+    """Chuẩn hóa câu hỏi để 'Thuật toán  nổi bọt là gì?' và 'thuat toan noi bot la gi' dùng chung một mục"""
+    folded = _WHITESPACE.sub(' ', fold_text(text)).strip()
+    return _TRAILING_PUNCTUATION.sub('', folded)
+
+
+def cache_key(prompt, model, config):
+    payload = json.dumps([model, config, normalize_prompt(prompt)], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache câu trả lời AI lưu trong SQLite (WAL) nên còn sau khi khởi động lại và dùng chung
+    giữa các worker gunicorn. Hết hạn sau `ttl` giây; quá `max_entries` mục thì bỏ các mục
+    lâu không dùng nhất (LRU theo last_used). Số lần trúng/trượt được đếm ngay trong CSDL.
+    """
+
+    def __init__(self, path=None, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.path = path or os.getenv('AI_CACHE_PATH', DEFAULT_CACHE_PATH)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # Sau khi gunicorn fork, tiến trình con phải mở kết nối riêng
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, conn, name):
+        conn.execute(
+            'INSERT INTO counters (name, value) VALUES (?, 1) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + 1', (name,)
+        )
+
+    def get(self, key):
+        now = time.time()
+        conn = self._connect()
+        row = conn.execute('SELECT response, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+        if row and now - row[1] <= self.ttl:
+            conn.execute('UPDATE responses SET last_used = ?, hits = hits + 1 WHERE key = ?', (now, key))
+            self._count(conn, 'hits')
+            return row[0]
+        if row:
+            conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+        self._count(conn, 'misses')
+        return None
+
+    def put(self, key, model, prompt, response):
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO responses (key, model, prompt, response, created_at, last_used, hits) '
+                'VALUES (?, ?, ?, ?, ?, ?, 0)',
+                (key, model, prompt, response, now, now)
+            )
+            conn.execute('DELETE FROM responses WHERE created_at < ?', (now - self.ttl,))
+            conn.execute(
+                'DELETE FROM responses WHERE key IN '
+                '(SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def lookup(self, prompt, model, config):
+        """(khóa, câu trả lời đã cache hoặc None) - lỗi của cache được coi như trượt"""
+        key = cache_key(prompt, model, config)
+        try:
+            return key, self.get(key)
+        except sqlite3.Error as exc:
+            # Cache hỏng/bị khóa không được làm hỏng câu trả lời -> gọi AI như bình thường
+            print(f"⚠️ AI cache read failed: {exc}")
+            return key, None
+
+    def store(self, key, model, prompt, response):
+        try:
+            self.put(key, model, prompt, response)
+        except sqlite3.Error as exc:
+            print(f"⚠️ AI cache write failed: {exc}")
+
+    def get_or_create(self, prompt, model, config, create):
+        """Trả về câu trả lời đã cache, hoặc gọi create() rồi lưu lại kết quả"""
+        key, cached = self.lookup(prompt, model, config)
+        if cached is not None:
+            return cached
+        response = create()
+        self.store(key, model, prompt, response)
+        return response
+
+    def stats(self):
+        conn = self._connect()
+        counters = dict(conn.execute('SELECT name, value FROM counters').fetchall())
+        hits, misses = counters.get('hits', 0), counters.get('misses', 0)
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / total, 4) if total else 0.0,
+            'entries': conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0],
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl
+        }
@@ -0,0 +1,174 @@
+import json
+import os
+import threading
+
+from utils.file_lock import file_lock
+
+
+class ResultJournal:
+    """
+    Nhật ký kết quả bài thi dạng JSON Lines, chỉ ghi nối thêm (append-only).
+
+    - append(): ghi đúng một dòng rồi fsync -> chi phí O(1), không phụ thuộc lịch sử.
+    - delete(): chỉ ghi một "tombstone" nhỏ, việc dọn file (compaction) chạy nền.
+    - iter_records(): đọc tuần tự từng dòng, không nạp cả file vào bộ nhớ.
+    """
+
+    def __init__(self, path, legacy_path=None):
+        self.path = path
+        self.tombstones_path = f'{path}.deleted.json'
+        self._compacting = False
+        self._compact_guard = threading.Lock()
+        self._migrate_legacy(legacy_path)
+
+    def _migrate_legacy(self, legacy_path):
+        """
+        Chuyển file exam_results.json (mảng JSON) cũ sang JSONL - chỉ chạy một lần.
+        File cũ chỉ được đọc (là dữ liệu mẫu có trong git); file JSONL là dữ liệu lúc chạy, không commit.
+        """
+        with file_lock(self.path):
+            if os.path.exists(self.path):
+                return
+            records = []
+            if legacy_path and os.path.exists(legacy_path):
+                try:
+                    with open(legacy_path, 'r', encoding='utf-8') as f:
+                        records = json.load(f)
+                except json.JSONDecodeError:
+                    records = []
+            self._write_all(records if isinstance(records, list) else [])
+            if records:
+                print(f"✓ Migrated {len(records)} exam results from {legacy_path} to {self.path}")
+
+    def _write_all(self, records):
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def _load_tombstones(self):
+        try:
+            with open(self.tombstones_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
+
+    def _save_tombstones(self, tombstones):
+        if not tombstones:
+            if os.path.exists(self.tombstones_path):
+                os.remove(self.tombstones_path)
+            return
+        temp_path = f'{self.tombstones_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(tombstones, f, ensure_ascii=False)
+        os.replace(temp_path, self.tombstones_path)
+
+    @staticmethod
+    def _matches(record, exam_id, grade):
+        return record.get('exam_id') == exam_id and (grade is None or str(record.get('grade')) == str(grade))
+
+    def _is_deleted(self, record, offset, tombstones):
+        # Tombstone chỉ áp dụng cho các dòng nằm trước vị trí ghi tombstone
+        return any(
+            offset < t['offset'] and self._matches(record, t['exam_id'], t.get('grade'))
+            for t in tombstones
+        )
+
+    def append(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with file_lock(self.path):
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _iter_with_offsets(self, handle, tombstones):
+        offset = 0
+        for raw_line in handle:
+            line_offset = offset
+            offset += len(raw_line)
+            # Bỏ qua dòng cuối chưa ghi xong (thiếu ký tự xuống dòng)
+            if not raw_line.endswith(b'\n'):
+                break
+            if not raw_line.strip():
+                continue
+            try:
+                record = json.loads(raw_line)
+            except json.JSONDecodeError:
+                continue
+            if tombstones and self._is_deleted(record, line_offset, tombstones):
+                continue
+            yield record
+
+    def iter_records(self):
+        # Mở file và đọc tombstone trong cùng một lần khóa để có ảnh chụp nhất quán;
+        # compaction dùng os.replace nên file đang mở vẫn đọc tiếp được bình thường
+        with file_lock(self.path):
+            tombstones = self._load_tombstones()
+            try:
+                handle = open(self.path, 'rb')
+            except FileNotFoundError:
+                return
+        with handle:
+            yield from self._iter_with_offsets(handle, tombstones)
+
+    def delete(self, exam_id, grade=None):
+        with file_lock(self.path):
+            removed = sum(1 for record in self.iter_records() if self._matches(record, exam_id, grade))
+            if not removed:
+                return 0
+            tombstones = self._load_tombstones()
+            tombstones.append({
+                'exam_id': exam_id,
+                'grade': None if grade is None else str(grade),
+                'offset': os.path.getsize(self.path)
+            })
+            self._save_tombstones(tombstones)
+        self.schedule_compaction()
+        return removed
+
+    def rewrite(self, exam_id, grade, transform):
+        """
+        Thay các bản ghi của một đề bằng transform(danh_sách_bản_ghi) trong một lần ghi lại file.
+        transform phải trả về danh sách cùng độ dài, cùng thứ tự. Tombstone cũ được dọn luôn.
+        """
+        with file_lock(self.path):
+            records = list(self.iter_records())
+            positions = [i for i, record in enumerate(records) if self._matches(record, exam_id, grade)]
+            if not positions:
+                return 0
+            updated = transform([records[i] for i in positions])
+            for i, record in zip(positions, updated):
+                records[i] = record
+            self._write_all(records)
+            self._save_tombstones([])
+        return len(positions)
+
+    def schedule_compaction(self):
+        with self._compact_guard:
+            if self._compacting:
+                return
+            self._compacting = True
+        threading.Thread(target=self._compact_in_background, daemon=True).start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as exc:
+            print(f"⚠️ Exam result journal compaction failed: {exc}")
+        finally:
+            with self._compact_guard:
+                self._compacting = False
+
+    def compact(self):
+        """Ghi lại file, bỏ hẳn các bản ghi đã bị tombstone che; giữ khóa suốt quá trình"""
+        with file_lock(self.path):
+            if not self._load_tombstones():
+                return
+            self._write_all(list(self.iter_records()))
+            self._save_tombstones([])
@@ -0,0 +1,48 @@
+import json
+import os
+import threading
+
+from utils.file_lock import file_lock
+
+
+def id_seq(record_or_id):
+    """Số thứ tự trong id dạng '<tiền tố>_<số>': 'msg_000123' -> 123; không đúng dạng -> 0"""
+    record_id = record_or_id.get('id') if isinstance(record_or_id, dict) else record_or_id
+    _, _, number = str(record_id or '').rpartition('_')
+    return int(number) if number.isdigit() else 0
+
+
+class SequenceAllocator:
+    """
+    Bộ cấp số thứ tự tăng dần, lưu bền trong một file JSON {tên dãy: số đã cấp gần nhất}.
+    Số đã cấp không bao giờ được dùng lại, kể cả khi bản ghi bị xóa hay dữ liệu bị cắt bớt,
+    nên id sinh ra luôn tăng theo thời gian và có thể dùng để tìm kiếm nhị phân.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, FileNotFoundError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def next(self, name, seed=None):
+        """
+        Cấp số tiếp theo của dãy `name`. Lần đầu dãy chưa có thì bắt đầu sau `seed()`
+        (số lớn nhất đang có trong dữ liệu cũ) để không trùng id đã cấp theo cách cũ.
+        """
+        with file_lock(self.path):
+            counters = self._load()
+            if name not in counters:
+                counters[name] = seed() if seed else 0
+            counters[name] += 1
+
+            temp_file = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(counters, f, indent=2)
+            os.replace(temp_file, self.path)
+            return counters[name]
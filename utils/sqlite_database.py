@@ -0,0 +1,932 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from utils.chat_broadcaster import ChatBroadcaster
+from utils.database import SUPPORTED_GRADES, exam_summary, normalize_exam
+from utils.exam_stats import aggregate_results, apply_result, empty_stats
+from utils.forum_search import ForumSearchIndex
+from utils.sequence import id_seq
+from utils.view_counter import ViewCounter
+
+DEFAULT_SQLITE_PATH = 'data/websitetinhoc.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    username TEXT NOT NULL UNIQUE,
+    email TEXT NOT NULL,
+    role TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
+CREATE INDEX IF NOT EXISTS idx_users_email_lower ON users(lower(email));
+
+CREATE TABLE IF NOT EXISTS courses (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    teacher_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_courses_teacher ON courses(teacher_id);
+
+CREATE TABLE IF NOT EXISTS exercises (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS progress (
+    user_id TEXT NOT NULL,
+    course_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, course_id)
+);
+CREATE INDEX IF NOT EXISTS idx_progress_course ON progress(course_id);
+
+CREATE TABLE IF NOT EXISTS submissions (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    user_id TEXT,
+    course_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_submissions_user ON submissions(user_id);
+CREATE INDEX IF NOT EXISTS idx_submissions_course ON submissions(course_id);
+
+CREATE TABLE IF NOT EXISTS documents (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS forum_posts (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    author_id TEXT,
+    created_at TEXT,
+    views INTEGER NOT NULL DEFAULT 0,
+    comments_count INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_forum_posts_created ON forum_posts(created_at);
+CREATE INDEX IF NOT EXISTS idx_forum_posts_author ON forum_posts(author_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_forum_posts_keyset ON forum_posts(created_at, id);
+CREATE INDEX IF NOT EXISTS idx_forum_posts_author_keyset ON forum_posts(author_id, created_at, id);
+
+CREATE TABLE IF NOT EXISTS forum_comments (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    post_id TEXT NOT NULL,
+    created_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_forum_comments_post ON forum_comments(post_id, created_at);
+
+CREATE TABLE IF NOT EXISTS chat_messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    created_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chat_messages_created ON chat_messages(created_at);
+
+CREATE TABLE IF NOT EXISTS exams (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL,
+    grade TEXT NOT NULL,
+    created_by TEXT,
+    summary TEXT NOT NULL,
+    data TEXT NOT NULL,
+    UNIQUE (grade, id)
+);
+CREATE INDEX IF NOT EXISTS idx_exams_created_by ON exams(created_by);
+
+CREATE TABLE IF NOT EXISTS exam_results (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT,
+    user_id TEXT,
+    grade TEXT,
+    exam_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_exam_results_exam ON exam_results(exam_id, grade);
+CREATE INDEX IF NOT EXISTS idx_exam_results_user ON exam_results(user_id);
+
+CREATE TABLE IF NOT EXISTS result_analyses (
+    result_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS exam_stats (
+    grade TEXT NOT NULL,
+    exam_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (grade, exam_id)
+);
+"""
+
+
+def _dumps(record):
+    return json.dumps(record, ensure_ascii=False)
+
+
+class SQLiteDatabase:
+    """
+    Backend SQLite (WAL) có cùng bộ phương thức với Database (JSON).
+    Mỗi bảng có các cột cần đánh chỉ mục, toàn bộ bản ghi nằm trong cột data (JSON).
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv('SQLITE_PATH', DEFAULT_SQLITE_PATH)
+        self._local = threading.local()
+        self.forum_index = ForumSearchIndex()
+        self.view_counter = ViewCounter(self._apply_view_deltas)
+        self.chat_broadcaster = ChatBroadcaster()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connect().executescript(SCHEMA)
+        self._init_exam_stats()
+
+    def _init_exam_stats(self):
+        # CSDL tạo trước khi có bảng exam_stats: dựng bảng tổng hợp một lần từ exam_results
+        conn = self._connect()
+        if conn.execute('SELECT 1 FROM exam_stats LIMIT 1').fetchone():
+            return
+        if conn.execute('SELECT 1 FROM exam_results LIMIT 1').fetchone():
+            self.rebuild_exam_stats()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # Sau khi gunicorn fork, tiến trình con phải mở kết nối riêng
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _write(self):
+        """Giao dịch ghi - BEGIN IMMEDIATE để các worker ghi tuần tự, không mất cập nhật"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _fetch(self, sql, params=()):
+        return [json.loads(row['data']) for row in self._connect().execute(sql, params)]
+
+    def _fetch_one(self, sql, params=()):
+        row = self._connect().execute(sql, params).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def _next_id(self, conn, table, id_format):
+        """Cấp id mới theo seq kế tiếp (giống len + 1 của bản JSON nhưng không bị trùng sau khi xóa)"""
+        row = conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+        seq = (row[0] if row else 0) + 1
+        while conn.execute(f'SELECT 1 FROM {table} WHERE id = ?', (id_format.format(seq),)).fetchone():
+            seq += 1
+        return seq, id_format.format(seq)
+
+    # ==================== USERS ====================
+
+    def load_users(self):
+        return self._fetch('SELECT data FROM users ORDER BY seq')
+
+    def save_users(self, users):
+        with self._write() as conn:
+            conn.execute('DELETE FROM users')
+            conn.executemany(
+                'INSERT INTO users (id, username, email, role, data) VALUES (?, ?, ?, ?, ?)',
+                [(u['id'], u['username'], u.get('email', ''), u.get('role', 'student'), _dumps(u)) for u in users]
+            )
+
+    def get_user_by_id(self, user_id):
+        return self._fetch_one('SELECT data FROM users WHERE id = ?', (user_id,))
+
+    def get_user_by_username(self, username):
+        return self._fetch_one('SELECT data FROM users WHERE username = ?', (username,))
+
+    def create_user(self, user_data):
+        """
+        Thêm user mới trong một giao dịch.
+        Trả về (user_id, None) hoặc (None, 'username' / 'email') nếu bị trùng.
+        """
+        with self._write() as conn:
+            if conn.execute('SELECT 1 FROM users WHERE username = ?', (user_data['username'],)).fetchone():
+                return None, 'username'
+            # Email không phân biệt hoa thường, giống chỉ mục của UserDirectory
+            if conn.execute(
+                'SELECT 1 FROM users WHERE lower(email) = lower(?)', (user_data['email'].strip(),)
+            ).fetchone():
+                return None, 'email'
+            seq, user_id = self._next_id(conn, 'users', '{}')
+            user = dict(user_data, id=user_id)
+            conn.execute(
+                'INSERT INTO users (seq, id, username, email, role, data) VALUES (?, ?, ?, ?, ?, ?)',
+                (seq, user_id, user['username'], user['email'], user.get('role', 'student'), _dumps(user))
+            )
+        return user_id, None
+
+    # ==================== EXAMS ====================
+
+    def load_exam_bank(self, grade):
+        exams = self._fetch('SELECT data FROM exams WHERE grade = ? ORDER BY seq', (str(grade),))
+        return {'exams': [normalize_exam(exam) for exam in exams if isinstance(exam, dict)]}
+
+    def save_exam_bank(self, grade, data):
+        if not isinstance(data, dict):
+            data = {'exams': data or []}
+        with self._write() as conn:
+            conn.execute('DELETE FROM exams WHERE grade = ?', (str(grade),))
+            for exam in data.get('exams', []):
+                self._insert_exam(conn, grade, exam)
+
+    def _insert_exam(self, conn, grade, exam):
+        conn.execute(
+            'INSERT INTO exams (id, grade, created_by, summary, data) VALUES (?, ?, ?, ?, ?)',
+            (exam.get('id'), str(grade), exam.get('created_by'), _dumps(exam_summary(exam)), _dumps(exam))
+        )
+
+    def add_exam(self, grade, exam_data):
+        with self._write() as conn:
+            self._insert_exam(conn, grade, exam_data)
+        return exam_data.get('id')
+
+    def delete_exam(self, grade, exam_id):
+        with self._write() as conn:
+            cursor = conn.execute('DELETE FROM exams WHERE grade = ? AND id = ?', (str(grade), exam_id))
+        return cursor.rowcount > 0
+
+    def get_exam_manifest(self, grade):
+        rows = self._connect().execute('SELECT summary FROM exams WHERE grade = ? ORDER BY seq', (str(grade),))
+        return [json.loads(row['summary']) for row in rows]
+
+    def get_exam(self, grade, exam_id):
+        exam = self._fetch_one('SELECT data FROM exams WHERE grade = ? AND id = ?', (str(grade), exam_id))
+        return normalize_exam(exam) if exam else None
+
+    def get_exam_version(self, grade, exam_id):
+        # save_exam_bank xóa và chèn lại nên seq đổi mỗi khi đề được ghi lại
+        row = self._connect().execute(
+            'SELECT seq FROM exams WHERE grade = ? AND id = ?', (str(grade), exam_id)
+        ).fetchone()
+        return row['seq'] if row else None
+
+    def get_exams_by_teacher(self, teacher_id):
+        exams_by_grade = {}
+        rows = self._connect().execute(
+            'SELECT grade, data FROM exams WHERE created_by = ? ORDER BY seq', (teacher_id,)
+        )
+        for row in rows:
+            exams_by_grade.setdefault(row['grade'], []).append(normalize_exam(json.loads(row['data'])))
+        return {grade: exams_by_grade[grade] for grade in SUPPORTED_GRADES if grade in exams_by_grade}
+
+    # Bảng tổng hợp exam_stats được cập nhật trong cùng giao dịch với exam_results
+
+    def _load_exam_stats(self, conn, grade, exam_id):
+        row = conn.execute(
+            'SELECT data FROM exam_stats WHERE grade = ? AND exam_id = ?', (str(grade), exam_id)
+        ).fetchone()
+        return json.loads(row['data']) if row else empty_stats(grade, exam_id)
+
+    def _save_exam_stats(self, conn, stats):
+        conn.execute(
+            'INSERT OR REPLACE INTO exam_stats (grade, exam_id, data) VALUES (?, ?, ?)',
+            (stats['grade'], stats['exam_id'], _dumps(stats))
+        )
+
+    def get_exam_stats(self, grade, exam_id):
+        return self._load_exam_stats(self._connect(), grade, exam_id)
+
+    def delete_exam_results(self, exam_id, grade=None):
+        with self._write() as conn:
+            if grade is None:
+                cursor = conn.execute('DELETE FROM exam_results WHERE exam_id = ?', (exam_id,))
+                conn.execute('DELETE FROM exam_stats WHERE exam_id = ?', (exam_id,))
+            else:
+                cursor = conn.execute(
+                    'DELETE FROM exam_results WHERE exam_id = ? AND grade = ?', (exam_id, str(grade))
+                )
+                conn.execute('DELETE FROM exam_stats WHERE exam_id = ? AND grade = ?', (exam_id, str(grade)))
+        return cursor.rowcount
+
+    def add_exam_result(self, result_record):
+        grade = str(result_record.get('grade'))
+        with self._write() as conn:
+            conn.execute(
+                'INSERT INTO exam_results (id, user_id, grade, exam_id, data) VALUES (?, ?, ?, ?, ?)',
+                (
+                    result_record.get('id'),
+                    result_record.get('user_id'),
+                    grade,
+                    result_record.get('exam_id'),
+                    _dumps(result_record)
+                )
+            )
+            stats = self._load_exam_stats(conn, grade, result_record.get('exam_id'))
+            self._save_exam_stats(conn, apply_result(stats, result_record))
+        return result_record.get('id')
+
+    def rewrite_exam_results(self, exam_id, grade, transform):
+        with self._write() as conn:
+            rows = conn.execute(
+                'SELECT seq, data FROM exam_results WHERE exam_id = ? AND grade = ? ORDER BY seq',
+                (exam_id, str(grade))
+            ).fetchall()
+            if not rows:
+                return 0
+            updated = transform([json.loads(row['data']) for row in rows])
+            conn.executemany(
+                'UPDATE exam_results SET data = ? WHERE seq = ?',
+                [(_dumps(record), row['seq']) for row, record in zip(rows, updated)]
+            )
+            conn.execute('DELETE FROM exam_stats WHERE exam_id = ? AND grade = ?', (exam_id, str(grade)))
+            for stats in aggregate_results(updated).values():
+                self._save_exam_stats(conn, stats)
+        return len(rows)
+
+    def _replace_all_exam_stats(self, conn, results):
+        aggregates = aggregate_results(results)
+        conn.execute('DELETE FROM exam_stats')
+        for stats in aggregates.values():
+            self._save_exam_stats(conn, stats)
+        return len(aggregates)
+
+    def rebuild_exam_stats(self):
+        """Dựng lại bảng exam_stats từ exam_results"""
+        with self._write() as conn:
+            rows = conn.execute('SELECT data FROM exam_results ORDER BY seq')
+            return self._replace_all_exam_stats(conn, (json.loads(row['data']) for row in rows))
+
+    def iter_exam_results(self):
+        for row in self._connect().execute('SELECT data FROM exam_results ORDER BY seq'):
+            yield json.loads(row['data'])
+
+    def get_exam_results(self, user_id=None, exam_id=None, grade=None):
+        conditions, params = [], []
+        for column, value in (('user_id', user_id), ('exam_id', exam_id), ('grade', grade)):
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                params.append(str(value) if column == 'grade' else value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self._fetch(f'SELECT data FROM exam_results {where} ORDER BY seq', params)
+
+    def get_result_analysis(self, result_id):
+        return self._fetch_one('SELECT data FROM result_analyses WHERE result_id = ?', (result_id,))
+
+    def save_result_analysis(self, result_id, record):
+        with self._write() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO result_analyses (result_id, data) VALUES (?, ?)', (result_id, _dumps(record))
+            )
+
+    def claim_result_analysis(self, result_id, pending_record, stale_after):
+        with self._write() as conn:
+            row = conn.execute('SELECT data FROM result_analyses WHERE result_id = ?', (result_id,)).fetchone()
+            current = json.loads(row['data']) if row else None
+            if current and (current.get('status') == 'ready'
+                            or pending_record['requested_at'] - current.get('requested_at', 0) < stale_after):
+                return False
+            conn.execute(
+                'INSERT OR REPLACE INTO result_analyses (result_id, data) VALUES (?, ?)',
+                (result_id, _dumps(pending_record))
+            )
+        return True
+
+    # ==================== COURSES ====================
+
+    def get_all_courses(self):
+        return self._fetch('SELECT data FROM courses ORDER BY seq')
+
+    def get_course_by_id(self, course_id):
+        return self._fetch_one('SELECT data FROM courses WHERE id = ?', (course_id,))
+
+    def get_courses_by_teacher(self, teacher_id):
+        return self._fetch('SELECT data FROM courses WHERE teacher_id = ? ORDER BY seq', (teacher_id,))
+
+    def create_course(self, course_data, teacher_id):
+        with self._write() as conn:
+            seq, course_id = self._next_id(conn, 'courses', 'course_{}')
+            new_course = {
+                'id': course_id,
+                'teacher_id': teacher_id,
+                'title': course_data['title'],
+                'description': course_data.get('description', ''),
+                'lessons': course_data.get('lessons', []),
+                'created_at': datetime.now().isoformat()
+            }
+            conn.execute(
+                'INSERT INTO courses (seq, id, teacher_id, data) VALUES (?, ?, ?, ?)',
+                (seq, course_id, teacher_id, _dumps(new_course))
+            )
+        return course_id
+
+    def update_course(self, course_id, course_data):
+        with self._write() as conn:
+            row = conn.execute('SELECT data FROM courses WHERE id = ?', (course_id,)).fetchone()
+            if not row:
+                return False
+            course = json.loads(row['data'])
+            course.update(course_data)
+            course['updated_at'] = datetime.now().isoformat()
+            conn.execute(
+                'UPDATE courses SET teacher_id = ?, data = ? WHERE id = ?',
+                (course.get('teacher_id'), _dumps(course), course_id)
+            )
+        return True
+
+    def delete_course(self, course_id):
+        with self._write() as conn:
+            cursor = conn.execute('DELETE FROM courses WHERE id = ?', (course_id,))
+        return cursor.rowcount > 0
+
+    def get_all_exercises(self):
+        return self._fetch('SELECT data FROM exercises ORDER BY seq')
+
+    def save_exercise_submission(self, user_id, submission_data):
+        with self._write() as conn:
+            seq, submission_id = self._next_id(conn, 'submissions', 'sub_{}')
+            submission = {
+                'id': submission_id,
+                'user_id': user_id,
+                'course_id': submission_data.get('course_id'),
+                'exercise_id': submission_data['exercise_id'],
+                'answers': submission_data['answers'],
+                'submitted_at': submission_data.get('submitted_at', datetime.now().isoformat())
+            }
+            conn.execute(
+                'INSERT INTO submissions (seq, id, user_id, course_id, data) VALUES (?, ?, ?, ?, ?)',
+                (seq, submission_id, user_id, submission['course_id'], _dumps(submission))
+            )
+        return submission_id
+
+    # ==================== PROGRESS ====================
+
+    def get_all_progress(self):
+        return self._fetch('SELECT data FROM progress ORDER BY rowid')
+
+    def get_student_progress(self, user_id):
+        return self._fetch('SELECT data FROM progress WHERE user_id = ? ORDER BY rowid', (user_id,))
+
+    def get_course_progress(self, user_id, course_id):
+        return self._fetch_one(
+            'SELECT data FROM progress WHERE user_id = ? AND course_id = ?', (user_id, course_id)
+        )
+
+    def update_progress(self, user_id, course_id, lesson_id, completed, **kwargs):
+        timestamp = kwargs.get('timestamp', datetime.now().isoformat())
+
+        with self._write() as conn:
+            row = conn.execute(
+                'SELECT data FROM progress WHERE user_id = ? AND course_id = ?', (user_id, course_id)
+            ).fetchone()
+            if row:
+                progress = json.loads(row['data'])
+                if completed and lesson_id not in progress['completed_lessons']:
+                    progress['completed_lessons'].append(lesson_id)
+                progress['last_updated'] = timestamp
+            else:
+                progress = {
+                    'user_id': user_id,
+                    'course_id': course_id,
+                    'completed_lessons': [lesson_id] if completed else [],
+                    'last_updated': timestamp
+                }
+            conn.execute(
+                'INSERT INTO progress (user_id, course_id, data) VALUES (?, ?, ?) '
+                'ON CONFLICT (user_id, course_id) DO UPDATE SET data = excluded.data',
+                (user_id, course_id, _dumps(progress))
+            )
+        return True
+
+    # ==================== DOCUMENTS & SUBMISSIONS ====================
+
+    def get_all_documents(self):
+        return self._fetch('SELECT data FROM documents ORDER BY seq')
+
+    def add_document(self, doc_data):
+        url = doc_data.get('url') or doc_data.get('link', '')
+
+        with self._write() as conn:
+            seq, doc_id = self._next_id(conn, 'documents', 'doc_{}')
+            new_doc = {
+                'id': doc_id,
+                'title': doc_data['title'],
+                'url': url,
+                'description': doc_data.get('description', ''),
+                'grade': doc_data.get('grade', '12'),
+                'doc_type': doc_data.get('doc_type', 'document'),
+                'link_type': doc_data.get('link_type', 'other'),
+                'category': doc_data.get('category', ''),
+                'created_at': datetime.now().isoformat()
+            }
+            conn.execute('INSERT INTO documents (seq, id, data) VALUES (?, ?, ?)', (seq, doc_id, _dumps(new_doc)))
+        return doc_id
+
+    def delete_document(self, doc_id):
+        with self._write() as conn:
+            cursor = conn.execute('DELETE FROM documents WHERE id = ?', (doc_id,))
+        return cursor.rowcount > 0
+
+    def get_all_submissions(self):
+        return self._fetch('SELECT data FROM submissions ORDER BY seq')
+
+    def get_submissions_by_course(self, course_id):
+        return self._fetch('SELECT data FROM submissions WHERE course_id = ? ORDER BY seq', (course_id,))
+
+    # ==================== FORUM ====================
+
+    def _post_from_row(self, row):
+        post = json.loads(row['data'])
+        # Cộng thêm lượt xem còn chờ ghi của tiến trình này
+        post['views'] = row['views'] + self.view_counter.pending(post['id'])
+        post['comments_count'] = row['comments_count']
+        return post
+
+    def _fetch_posts(self, sql, params=()):
+        return [self._post_from_row(row) for row in self._connect().execute(sql, params)]
+
+    def get_all_forum_posts(self):
+        return self._fetch_posts(
+            'SELECT data, views, comments_count FROM forum_posts ORDER BY created_at DESC, id DESC'
+        )
+
+    def get_forum_posts_page(self, before=None, limit=20, author_id=None):
+        conditions, params = [], []
+        if author_id is not None:
+            conditions.append('author_id = ?')
+            params.append(author_id)
+        if before:
+            conditions.append('(created_at, id) < (?, ?)')
+            params.extend(before)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        # Lấy dư một bài để biết còn trang sau hay không
+        posts = self._fetch_posts(
+            f'SELECT data, views, comments_count FROM forum_posts {where} '
+            'ORDER BY created_at DESC, id DESC LIMIT ?',
+            params + [limit + 1]
+        )
+        if len(posts) > limit:
+            posts = posts[:limit]
+            return posts, (posts[-1].get('created_at') or '', posts[-1]['id'])
+        return posts, None
+
+    def get_forum_post_by_id(self, post_id):
+        posts = self._fetch_posts(
+            'SELECT data, views, comments_count FROM forum_posts WHERE id = ?', (post_id,)
+        )
+        return posts[0] if posts else None
+
+    def get_forum_posts_by_user(self, user_id):
+        return self._fetch_posts(
+            'SELECT data, views, comments_count FROM forum_posts WHERE author_id = ? '
+            'ORDER BY created_at DESC, id DESC',
+            (user_id,)
+        )
+
+    def create_forum_post(self, post_data):
+        with self._write() as conn:
+            seq, post_id = self._next_id(conn, 'forum_posts', 'post_{:04d}')
+            new_post = {
+                'id': post_id,
+                'title': post_data['title'],
+                'content': post_data['content'],
+                'author_id': post_data['author_id'],
+                'author_name': post_data['author_name'],
+                'author_role': post_data.get('author_role', 'student'),
+                'created_at': datetime.now().isoformat(),
+                'updated_at': None,
+                'attachments': post_data.get('attachments', []),
+                'tags': post_data.get('tags', []),
+                'views': 0,
+                'comments_count': 0
+            }
+            conn.execute(
+                'INSERT INTO forum_posts (seq, id, author_id, created_at, data) VALUES (?, ?, ?, ?, ?)',
+                (seq, post_id, new_post['author_id'], new_post['created_at'], _dumps(new_post))
+            )
+            version = self._bump_forum_version(conn)
+        self.forum_index.apply(version, lambda index: index.index_post(new_post))
+        return post_id
+
+    def update_forum_post(self, post_id, post_data):
+        with self._write() as conn:
+            row = conn.execute('SELECT data FROM forum_posts WHERE id = ?', (post_id,)).fetchone()
+            if not row:
+                return False
+            post = json.loads(row['data'])
+            for field in ('title', 'content', 'attachments', 'tags'):
+                if field in post_data:
+                    post[field] = post_data[field]
+            post['updated_at'] = datetime.now().isoformat()
+            conn.execute('UPDATE forum_posts SET data = ? WHERE id = ?', (_dumps(post), post_id))
+            version = self._bump_forum_version(conn)
+        self.forum_index.apply(version, lambda index: index.index_post(post))
+        return True
+
+    def delete_forum_post(self, post_id):
+        with self._write() as conn:
+            conn.execute('DELETE FROM forum_posts WHERE id = ?', (post_id,))
+            conn.execute('DELETE FROM forum_comments WHERE post_id = ?', (post_id,))
+            version = self._bump_forum_version(conn)
+        self.forum_index.apply(version, lambda index: index.remove_post(post_id))
+        return True
+
+    def increment_post_views(self, post_id):
+        # Chỉ cộng trong bộ nhớ, ghi xuống CSDL theo lô (xem ViewCounter)
+        if not self._connect().execute('SELECT 1 FROM forum_posts WHERE id = ?', (post_id,)).fetchone():
+            return False
+        self.view_counter.increment(post_id)
+        return True
+
+    def _apply_view_deltas(self, deltas):
+        with self._write() as conn:
+            conn.executemany(
+                'UPDATE forum_posts SET views = views + ? WHERE id = ?',
+                [(delta, post_id) for post_id, delta in deltas.items()]
+            )
+
+    def _bump_forum_version(self, conn):
+        """Tăng phiên bản nội dung diễn đàn trong giao dịch đang mở; chỉ mục được cập nhật sau COMMIT"""
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('forum_version', 1) "
+            "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+        )
+        return conn.execute("SELECT value FROM meta WHERE key = 'forum_version'").fetchone()['value']
+
+    def _ensure_forum_index(self):
+        conn = self._connect()
+        row = conn.execute("SELECT value FROM meta WHERE key = 'forum_version'").fetchone()
+        version = row['value'] if row else 0
+        if self.forum_index.version != version:
+            conn.execute('BEGIN')
+            try:
+                # Đọc phiên bản và dữ liệu trong cùng một giao dịch đọc để có ảnh chụp nhất quán
+                row = conn.execute("SELECT value FROM meta WHERE key = 'forum_version'").fetchone()
+                version = row['value'] if row else 0
+                posts = [json.loads(r['data']) for r in conn.execute('SELECT data FROM forum_posts')]
+                comments = [json.loads(r['data']) for r in conn.execute('SELECT data FROM forum_comments')]
+            finally:
+                conn.execute('COMMIT')
+            self.forum_index.rebuild(posts, comments, version)
+        return self.forum_index
+
+    def search_forum_posts(self, keyword):
+        matches = self._ensure_forum_index().search(keyword)
+        if not matches:
+            return []
+        posts_by_id = {}
+        post_ids = [post_id for post_id, _ in matches]
+        # Giới hạn số tham số của SQLite -> truy vấn theo từng đợt
+        for start in range(0, len(post_ids), 500):
+            chunk = post_ids[start:start + 500]
+            rows = self._connect().execute(
+                f"SELECT data, views, comments_count FROM forum_posts WHERE id IN ({', '.join('?' for _ in chunk)})",
+                chunk
+            )
+            for row in rows:
+                post = self._post_from_row(row)
+                posts_by_id[post['id']] = post
+        return [posts_by_id[post_id] for post_id in post_ids if post_id in posts_by_id]
+
+    def get_comments_by_post(self, post_id):
+        return self._fetch(
+            'SELECT data FROM forum_comments WHERE post_id = ? ORDER BY created_at, seq', (post_id,)
+        )
+
+    def get_comment_by_id(self, comment_id):
+        return self._fetch_one('SELECT data FROM forum_comments WHERE id = ?', (comment_id,))
+
+    def add_comment(self, comment_data):
+        with self._write() as conn:
+            seq, comment_id = self._next_id(conn, 'forum_comments', 'comment_{:04d}')
+            new_comment = {
+                'id': comment_id,
+                'post_id': comment_data['post_id'],
+                'author_id': comment_data['author_id'],
+                'author_name': comment_data['author_name'],
+                'author_role': comment_data.get('author_role', 'student'),
+                'content': comment_data['content'],
+                'parent_id': comment_data.get('parent_id'),
+                'created_at': datetime.now().isoformat(),
+                'attachments': comment_data.get('attachments', [])
+            }
+            conn.execute(
+                'INSERT INTO forum_comments (seq, id, post_id, created_at, data) VALUES (?, ?, ?, ?, ?)',
+                (seq, comment_id, new_comment['post_id'], new_comment['created_at'], _dumps(new_comment))
+            )
+            conn.execute(
+                'UPDATE forum_posts SET comments_count = comments_count + 1 WHERE id = ?',
+                (new_comment['post_id'],)
+            )
+            version = self._bump_forum_version(conn)
+        self.forum_index.apply(version, lambda index: index.index_comment(new_comment))
+        return comment_id
+
+    def delete_comment(self, comment_id):
+        with self._write() as conn:
+            row = conn.execute('SELECT post_id FROM forum_comments WHERE id = ?', (comment_id,)).fetchone()
+            if not row:
+                return False
+            conn.execute('DELETE FROM forum_comments WHERE id = ?', (comment_id,))
+            conn.execute(
+                'UPDATE forum_posts SET comments_count = MAX(comments_count - 1, 0) WHERE id = ?',
+                (row['post_id'],)
+            )
+            version = self._bump_forum_version(conn)
+        comment = {'id': comment_id, 'post_id': row['post_id']}
+        self.forum_index.apply(version, lambda index: index.remove_comment(comment))
+        return True
+
+    # ==================== CHAT ====================
+
+    def get_all_chat_messages(self):
+        return self._fetch('SELECT data FROM chat_messages ORDER BY seq')
+
+    def get_recent_chat_messages(self, limit):
+        messages = self._fetch(
+            'SELECT data FROM chat_messages ORDER BY seq DESC LIMIT ?', (limit,)
+        )
+        messages.reverse()
+        return messages
+
+    def get_chat_messages_before(self, before_id, limit):
+        anchor = self._connect().execute(
+            'SELECT seq FROM chat_messages WHERE id = ?', (before_id,)
+        ).fetchone()
+        anchor_seq = anchor['seq'] if anchor else id_seq(before_id)
+
+        messages = self._fetch(
+            'SELECT data FROM chat_messages WHERE seq < ? ORDER BY seq DESC LIMIT ?', (anchor_seq, limit)
+        )
+        messages.reverse()
+        return messages
+
+    def iter_chat_messages(self):
+        return iter(self.get_all_chat_messages())
+
+    def get_chat_message_by_id(self, message_id):
+        return self._fetch_one('SELECT data FROM chat_messages WHERE id = ?', (message_id,))
+
+    def add_chat_message(self, message_data):
+        with self._write() as conn:
+            seq, message_id = self._next_id(conn, 'chat_messages', 'msg_{:06d}')
+            new_message = {
+                'id': message_id,
+                'content': message_data['content'],
+                'author_id': message_data['author_id'],
+                'author_name': message_data['author_name'],
+                'author_role': message_data.get('author_role', 'student'),
+                'created_at': datetime.now().isoformat(),
+                'reply_to': message_data.get('reply_to')
+            }
+            conn.execute(
+                'INSERT INTO chat_messages (seq, id, created_at, data) VALUES (?, ?, ?, ?)',
+                (seq, message_id, new_message['created_at'], _dumps(new_message))
+            )
+        self.chat_broadcaster.publish('message', new_message)
+        return message_id
+
+    def delete_chat_message(self, message_id):
+        with self._write() as conn:
+            conn.execute('DELETE FROM chat_messages WHERE id = ?', (message_id,))
+        self.chat_broadcaster.publish('delete', {'id': message_id})
+        return True
+
+    def get_chat_messages_after(self, last_id):
+        if not last_id:
+            return self.get_recent_chat_messages(50)
+
+        # seq là khóa chính AUTOINCREMENT (không cấp lại) -> tìm theo chỉ mục khóa chính.
+        # Tin last_id đã bị xóa thì dùng số trong id (id mới được cấp đúng bằng seq)
+        anchor = self._connect().execute(
+            'SELECT seq FROM chat_messages WHERE id = ?', (last_id,)
+        ).fetchone()
+        anchor_seq = anchor['seq'] if anchor else id_seq(last_id)
+
+        return self._fetch('SELECT data FROM chat_messages WHERE seq > ? ORDER BY seq', (anchor_seq,))
+
+
+_sqlite_database = None
+_sqlite_database_lock = threading.Lock()
+
+
+def get_sqlite_database():
+    """Một SQLiteDatabase dùng chung cho cả app và utils.auth trong mỗi tiến trình"""
+    global _sqlite_database
+    with _sqlite_database_lock:
+        if _sqlite_database is None:
+            _sqlite_database = SQLiteDatabase()
+        return _sqlite_database
+
+
+def import_json_data(target, force=False):
+    """
+    Nhập một lần toàn bộ dữ liệu data/*.json vào SQLite.
+    Trả về số bản ghi đã nhập của từng bảng.
+    """
+    from utils.auth import USERS_FILE
+    from utils.database import Database
+
+    conn = target._connect()
+    if not force and conn.execute('SELECT 1 FROM users LIMIT 1').fetchone():
+        raise RuntimeError('Cơ sở dữ liệu SQLite đã có dữ liệu, dùng --force để nhập lại')
+
+    source = Database()
+    users = []
+    if os.path.exists(USERS_FILE):
+        with open(USERS_FILE, 'r', encoding='utf-8') as f:
+            users = json.load(f)
+
+    counts = {}
+
+    def insert_all(conn, table, columns, rows):
+        placeholders = ', '.join('?' for _ in columns)
+        # OR IGNORE: bản JSON cũ có thể chứa id trùng (id = len + 1 sau khi xóa)
+        cursor = conn.executemany(
+            f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows
+        )
+        counts[table] = cursor.rowcount
+
+    with target._write() as conn:
+        for table in ('users', 'courses', 'exercises', 'progress', 'submissions', 'documents',
+                      'forum_posts', 'forum_comments', 'chat_messages', 'exams', 'exam_results'):
+            conn.execute(f'DELETE FROM {table}')
+
+        insert_all(conn, 'users', ('id', 'username', 'email', 'role', 'data'), [
+            (u['id'], u['username'], u.get('email', ''), u.get('role', 'student'), _dumps(u)) for u in users
+        ])
+        insert_all(conn, 'courses', ('id', 'teacher_id', 'data'), [
+            (c['id'], c.get('teacher_id'), _dumps(c)) for c in source.get_all_courses()
+        ])
+        insert_all(conn, 'exercises', ('data',), [(_dumps(e),) for e in source.get_all_exercises()])
+        insert_all(conn, 'progress', ('user_id', 'course_id', 'data'), [
+            (p['user_id'], p['course_id'], _dumps(p)) for p in source.get_all_progress()
+        ])
+        insert_all(conn, 'submissions', ('id', 'user_id', 'course_id', 'data'), [
+            (s['id'], s.get('user_id'), s.get('course_id'), _dumps(s)) for s in source.get_all_submissions()
+        ])
+        insert_all(conn, 'documents', ('id', 'data'), [(d['id'], _dumps(d)) for d in source.get_all_documents()])
+        insert_all(conn, 'forum_posts', ('id', 'author_id', 'created_at', 'views', 'comments_count', 'data'), [
+            # created_at NULL làm so sánh (created_at, id) < con trỏ luôn sai -> bài bị mất khỏi phân trang
+            (p['id'], p.get('author_id'), p.get('created_at') or '', p.get('views', 0), p.get('comments_count', 0), _dumps(p))
+            for p in sorted(source.get_all_forum_posts(), key=lambda x: x.get('created_at', ''))
+        ])
+        insert_all(conn, 'forum_comments', ('id', 'post_id', 'created_at', 'data'), [
+            (c['id'], c['post_id'], c.get('created_at'), _dumps(c))
+            for c in source._load_json(source.forum_comments_file)
+        ])
+        chat_messages = list(source.iter_chat_messages())
+        chat_seqs = [id_seq(m) for m in chat_messages]
+        if chat_seqs and chat_seqs[0] > 0 and all(a < b for a, b in zip(chat_seqs, chat_seqs[1:])):
+            # id do bộ cấp số sinh ra (tăng dần) -> giữ seq = số trong id, tra cứu theo id đã xóa vẫn đúng
+            insert_all(conn, 'chat_messages', ('seq', 'id', 'created_at', 'data'), [
+                (seq, m['id'], m.get('created_at'), _dumps(m)) for seq, m in zip(chat_seqs, chat_messages)
+            ])
+        else:
+            insert_all(conn, 'chat_messages', ('id', 'created_at', 'data'), [
+                (m['id'], m.get('created_at'), _dumps(m)) for m in chat_messages
+            ])
+        insert_all(conn, 'exams', ('id', 'grade', 'created_by', 'summary', 'data'), [
+            (exam.get('id'), grade, exam.get('created_by'), _dumps(exam_summary(exam)), _dumps(exam))
+            for grade in SUPPORTED_GRADES
+            for exam in source.load_exam_bank(grade).get('exams', [])
+        ])
+        insert_all(conn, 'exam_results', ('id', 'user_id', 'grade', 'exam_id', 'data'), [
+            (r.get('id'), r.get('user_id'), str(r.get('grade')), r.get('exam_id'), _dumps(r))
+            for r in source.get_exam_results()
+        ])
+        counts['exam_stats'] = target._replace_all_exam_stats(conn, source.iter_exam_results())
+        # Bài viết / bình luận đã thay toàn bộ -> chỉ mục tìm kiếm của mọi tiến trình phải dựng lại
+        target._bump_forum_version(conn)
+
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Nhập dữ liệu data/*.json vào SQLite')
+    parser.add_argument('--path', default=None, help=f'Đường dẫn file SQLite (mặc định {DEFAULT_SQLITE_PATH})')
+    parser.add_argument('--force', action='store_true', help='Xóa dữ liệu SQLite hiện có rồi nhập lại')
+    args = parser.parse_args()
+
+    imported = import_json_data(SQLiteDatabase(args.path), force=args.force)
+    for table, count in imported.items():
+        print(f"✓ {table}: {count} bản ghi")
@@ -0,0 +1,99 @@
+import json
+import os
+import threading
+
+from utils.database import _file_signature
+from utils.file_lock import file_lock
+
+
+class UserDirectory:
+    """
+    Danh bạ user giữ trong bộ nhớ, có chỉ mục theo id, username và email (chữ thường).
+    Tự nạp lại khi chữ ký của users.json đổi (xem _file_signature) nên vẫn thấy user do worker khác ghi.
+    Các hàm get_* trả về bản sao để nơi gọi có sửa cũng không làm hỏng chỉ mục.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = None
+        self._users = []
+        self._by_id = {}
+        self._by_username = {}
+        self._by_email = {}
+
+    @staticmethod
+    def _email_key(email):
+        return (email or '').strip().lower()
+
+    def _index(self, users, signature):
+        self._users = users
+        self._by_id = {str(u.get('id')): u for u in users}
+        self._by_username = {u.get('username'): u for u in users}
+        self._by_email = {self._email_key(u.get('email')): u for u in users if u.get('email')}
+        self._signature = signature
+
+    def _refresh(self):
+        signature = _file_signature(self.path)
+        with self._lock:
+            if signature == self._signature:
+                return
+            users = []
+            if signature is not None:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        users = json.load(f)
+                except (json.JSONDecodeError, FileNotFoundError):
+                    users = []
+            self._index(users if isinstance(users, list) else [], signature)
+
+    def get_by_id(self, user_id):
+        self._refresh()
+        user = self._by_id.get(str(user_id))
+        return dict(user) if user else None
+
+    def get_by_username(self, username):
+        self._refresh()
+        user = self._by_username.get(username)
+        return dict(user) if user else None
+
+    def get_by_email(self, email):
+        self._refresh()
+        user = self._by_email.get(self._email_key(email))
+        return dict(user) if user else None
+
+    def all(self):
+        self._refresh()
+        return [dict(u) for u in self._users]
+
+    def save(self, users):
+        """Ghi toàn bộ danh sách user (ghi file tạm rồi os.replace) và cập nhật chỉ mục"""
+        with file_lock(self.path):
+            self._write(users)
+
+    def _write(self, users):
+        temp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(users, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, self.path)
+        with self._lock:
+            self._index([dict(u) for u in users], _file_signature(self.path))
+
+    def create(self, user_data):
+        """
+        Thêm user mới nếu username / email chưa có.
+        Trả về (user_id, None) hoặc (None, 'username' / 'email') giống SQLiteDatabase.create_user.
+        """
+        with file_lock(self.path):
+            self._refresh()
+            if user_data['username'] in self._by_username:
+                return None, 'username'
+            if self._email_key(user_data.get('email')) in self._by_email:
+                return None, 'email'
+            # id = số lượng + 1 như trước, bỏ qua id đã có (sau khi xóa user)
+            next_id = len(self._users) + 1
+            while str(next_id) in self._by_id:
+                next_id += 1
+            user = {'id': str(next_id), **user_data}
+            self._write(self._users + [user])
+        return user['id'], None
@@ -0,0 +1,92 @@
+import atexit
+import os
+import threading
+import time
+from collections import Counter
+
+# Ghi lượt xem xuống storage sau mỗi N giây hoặc khi đã dồn N lượt, tùy điều kiện nào đến trước
+VIEW_FLUSH_INTERVAL = float(os.getenv('VIEW_FLUSH_INTERVAL', '5'))
+VIEW_FLUSH_BATCH = int(os.getenv('VIEW_FLUSH_BATCH', '50'))
+
+
+class ViewCounter:
+    """
+    Bộ đếm lượt xem ghi trễ (write-behind), an toàn giữa các thread.
+
+    increment() chỉ cộng vào bộ nhớ; flush() chuyển các phần chênh lệch cho hàm
+    `apply_deltas(dict id -> số lượt)` của backend, hàm này phải cộng dồn (không ghi đè)
+    để nhiều worker cùng flush không làm mất lượt xem của nhau.
+    """
+
+    def __init__(self, apply_deltas, interval=VIEW_FLUSH_INTERVAL, batch_size=VIEW_FLUSH_BATCH):
+        self._apply_deltas = apply_deltas
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = Counter()
+        self._pending_total = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._worker_pid = None
+        atexit.register(self.flush)
+
+    def _ensure_worker(self):
+        # Thread nền không sống sót qua fork -> mỗi worker gunicorn tự khởi động thread riêng
+        if self._worker_pid == os.getpid():
+            return
+        self._worker_pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as exc:
+                print(f"⚠️ View counter flush failed: {exc}")
+
+    def increment(self, key, amount=1):
+        with self._lock:
+            self._ensure_worker()
+            self._pending[key] += amount
+            self._pending_total += amount
+            due = (self._pending_total >= self.batch_size
+                   or time.monotonic() - self._last_flush >= self.interval)
+        if due:
+            self.flush()
+
+    def pending(self, key):
+        with self._lock:
+            return self._pending.get(key, 0)
+
+    def merge_into(self, records, field='views'):
+        """Cộng lượt xem chưa ghi của tiến trình này vào các bản ghi (bản sao) trước khi trả về"""
+        with self._lock:
+            if not self._pending:
+                return records
+            pending = dict(self._pending)
+        for record in records:
+            delta = pending.get(record.get('id'))
+            if delta:
+                record[field] = record.get(field, 0) + delta
+        return records
+
+    def flush(self):
+        # flush_lock: hai thread không cùng ghi một lúc, lượt xem vẫn được ghi theo đúng thứ tự
+        with self._flush_lock:
+            with self._lock:
+                deltas = dict(self._pending)
+                self._pending.clear()
+                self._pending_total = 0
+                self._last_flush = time.monotonic()
+            if not deltas:
+                return 0
+            try:
+                self._apply_deltas(deltas)
+            except Exception:
+                # Ghi lỗi -> trả lại để lần sau thử lại, không mất lượt xem
+                with self._lock:
+                    self._pending.update(deltas)
+                    self._pending_total += sum(deltas.values())
+                raise
+            return sum(deltas.values())